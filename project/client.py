@@ -110,3 +110,5 @@ if __name__ == '__main__':
     # Раз графическая оболочка закрылась, закрываем транспорт
     transport.transport_shutdown()
     transport.join()
+    # и дожидаемся сохранения уже принятых сообщений
+    main_window.receiver.close()
@@ -75,7 +75,7 @@ class AddContactDialog(QDialog):
         список известных пользователей и обносляет содержимое окна.
         '''
         try:
-            self.transport.user_list_update()
+            self.transport.lists_update()
         except OSError:
             pass
         else:
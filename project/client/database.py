@@ -1,11 +1,21 @@
-from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime
-from sqlalchemy.orm import mapper, sessionmaker
+from sqlalchemy import create_engine, Table, Column, Integer, String, Text, MetaData, DateTime, LargeBinary, \
+    and_, or_
+from sqlalchemy.orm import mapper, sessionmaker, scoped_session
 import os
 import sys
 sys.path.append('../')
 from common.variables import *
+from common.storage import apply_profile, create_indexes
+from common.utils import key_fingerprint
 import datetime
 
+# Вторичные индексы базы клиента: (имя индекса, таблица, столбцы).
+# Создаются при запуске, в том числе в уже существующей базе.
+INDEXES = (
+    ('ix_message_history_contact_date', 'message_history', ('contact', 'date')),
+    ('ix_known_users_username', 'known_users', ('username',)),
+)
+
 
 # Класс - база данных сервера.
 class ClientDatabase:
@@ -41,14 +51,47 @@ class ClientDatabase:
             self.id = None
             self.name = contact
 
+    class Outbox:
+        '''
+        Класс - отображение для таблицы исходящих сообщений, ещё не
+        подтверждённых сервером. Порядок отправки - по возрастанию id.
+        '''
+        def __init__(self, contact, message):
+            self.id = None
+            self.contact = contact
+            self.message = message
+            self.date = datetime.datetime.now()
+
+    class SyncState:
+        '''
+        Класс - отображение для таблицы состояния синхронизации:
+        версия справочника сервера, которой соответствуют списки
+        известных пользователей и контактов.
+        '''
+        def __init__(self, version):
+            self.id = None
+            self.version = version
+
+    class PublicKeys:
+        '''
+        Класс - отображение для таблицы открытых ключей собеседников,
+        полученных с сервера, с их отпечатками.
+        '''
+        def __init__(self, username, pubkey):
+            self.id = None
+            self.username = username
+            self.pubkey = pubkey
+            self.fingerprint = key_fingerprint(pubkey)
+
     # Конструктор класса:
-    def __init__(self, name):
+    def __init__(self, name, storage_profile=None, path=None):
         # Создаём движок базы данных, поскольку разрешено несколько
         # клиентов одновременно, каждый должен иметь свою БД
         # Поскольку клиент мультипоточный необходимо отключить
         # проверки на подключения с разных потоков,
         # иначе sqlite3.ProgrammingError
-        path = os.path.dirname(os.path.realpath(__file__))
+        # По умолчанию база лежит в каталоге модуля, path - другой каталог
+        path = path or os.path.dirname(os.path.realpath(__file__))
         filename = f'client_{name}.db3'
         self.database_engine = create_engine(
             f'sqlite:///{os.path.join(path, filename)}',
@@ -56,6 +99,8 @@ class ClientDatabase:
             pool_recycle=7200,
             connect_args={
                 'check_same_thread': False})
+        # Параметры SQLite (WAL, synchronous, кэш) для каждого подключения
+        apply_profile(self.database_engine, storage_profile)
 
         # Создаём объект MetaData
         self.metadata = MetaData()
@@ -81,22 +126,46 @@ class ClientDatabase:
                          Column('name', String, unique=True)
                          )
 
-        # Создаём таблицы
+        # Создаём таблицу исходящих сообщений (зашифрованный текст)
+        outbox = Table('outbox', self.metadata,
+                       Column('id', Integer, primary_key=True),
+                       Column('contact', String),
+                       Column('message', LargeBinary),
+                       Column('date', DateTime)
+                       )
+
+        # Создаём таблицу состояния синхронизации (одна строка)
+        sync_state = Table('sync_state', self.metadata,
+                           Column('id', Integer, primary_key=True),
+                           Column('version', Integer)
+                           )
+
+        # Создаём таблицу открытых ключей собеседников
+        public_keys = Table('public_keys', self.metadata,
+                            Column('id', Integer, primary_key=True),
+                            Column('username', String, unique=True),
+                            Column('pubkey', Text),
+                            Column('fingerprint', String)
+                            )
+
+        # Создаём таблицы и недостающие индексы
         self.metadata.create_all(self.database_engine)
+        create_indexes(self.database_engine, INDEXES)
 
         # Создаём отображения
         mapper(self.KnownUsers, users)
         mapper(self.MessageStat, history)
         mapper(self.Contacts, contacts)
+        mapper(self.Outbox, outbox)
+        mapper(self.SyncState, sync_state)
+        mapper(self.PublicKeys, public_keys)
 
-        # Создаём сессию
+        # Создаём сессию. С базой работают GUI и потоки транспорта,
+        # поэтому у каждого потока своя сессия (scoped_session).
         Session = sessionmaker(bind=self.database_engine)
-        self.session = Session()
-
-        # Необходимо очистить таблицу контактов, т.к. при запуске они
-        # подгружаются с сервера.
-        self.session.query(self.Contacts).delete()
-        self.session.commit()
+        self.session = scoped_session(Session)
+        # Таблицы контактов и пользователей при запуске не очищаются:
+        # с сервера подгружаются только изменения после сохранённой версии.
 
     def add_contact(self, contact):
         """ Метод добавляющий контакт в базу данных. """
@@ -125,11 +194,101 @@ class ClientDatabase:
             self.session.add(user_row)
         self.session.commit()
 
+    def get_version(self):
+        """ Метод, возвращающий версию справочника сервера (0 - списков ещё нет). """
+        return self.session.query(self.SyncState.version).scalar() or 0
+
+    def apply_changes(self, version, full, users, contacts):
+        """
+        Метод, применяющий изменения списков пользователей и контактов
+        одной транзакцией и сохраняющий новую версию справочника.
+        users и contacts - пары списков (добавленные, удалённые). При full
+        таблицы заполняются заново. Повторное применение тех же изменений
+        ничего не меняет. Сохранённые ключи затронутых пользователей
+        удаляются: сервер записывает смену ключа как изменение списка
+        пользователей.
+        """
+        for table, column, (added, removed) in (
+                (self.KnownUsers, self.KnownUsers.username, users),
+                (self.Contacts, self.Contacts.name, contacts)):
+            query = self.session.query(table)
+            if not full:
+                query = query.filter(column.in_(added + removed))
+            query.delete(synchronize_session=False)
+            self.session.bulk_insert_mappings(table, [{column.key: name} for name in added])
+        query = self.session.query(self.PublicKeys)
+        if not full:
+            query = query.filter(self.PublicKeys.username.in_(users[0] + users[1]))
+        query.delete(synchronize_session=False)
+        self.session.query(self.SyncState).delete()
+        self.session.add(self.SyncState(version))
+        self.session.commit()
+
     def save_message(self, contact, direction, message):
-        """ Метод, сохраняющий сообщение в базе данных. """
+        """
+        Метод, сохраняющий сообщение в базе данных.
+        Возвращает его строку истории (контакт, направление, сообщение, дата).
+        """
         message_row = self.MessageStat(contact, direction, message)
+        date = message_row.date
         self.session.add(message_row)
         self.session.commit()
+        return contact, direction, message, date
+
+    def save_messages(self, messages):
+        """
+        Метод, сохраняющий группу сообщений (контакт, направление, сообщение)
+        одной транзакцией. Возвращает их строки истории в том же порядке.
+        """
+        message_rows = [self.MessageStat(*message) for message in messages]
+        rows = [(row.contact, row.direction, row.message, row.date) for row in message_rows]
+        self.session.add_all(message_rows)
+        self.session.commit()
+        return rows
+
+    def get_pubkey(self, username):
+        """ Метод, возвращающий сохранённый открытый ключ пользователя или None. """
+        return self.session.query(self.PublicKeys.pubkey).filter_by(username=username).scalar()
+
+    def save_pubkey(self, username, pubkey):
+        """ Метод, сохраняющий открытый ключ пользователя, полученный с сервера. """
+        self.session.query(self.PublicKeys).filter_by(username=username).delete()
+        self.session.add(self.PublicKeys(username, pubkey))
+        self.session.commit()
+
+    def check_fingerprints(self, fingerprints):
+        """
+        Метод, удаляющий сохранённые ключи, отпечатки которых не совпадают
+        с присланными сервером {имя: отпечаток}.
+        """
+        if not fingerprints:
+            return
+        stale = [username for username, fingerprint in self.session.query(
+            self.PublicKeys.username, self.PublicKeys.fingerprint
+        ).filter(self.PublicKeys.username.in_(list(fingerprints)))
+            if fingerprints[username] != fingerprint]
+        if stale:
+            self.session.query(self.PublicKeys).filter(
+                self.PublicKeys.username.in_(stale)).delete(synchronize_session=False)
+            self.session.commit()
+
+    def outbox_add(self, contact, message):
+        """ Метод, добавляющий сообщение в очередь исходящих. Возвращает его id. """
+        message_row = self.Outbox(contact, message)
+        self.session.add(message_row)
+        self.session.commit()
+        return message_row.id
+
+    def outbox_remove(self, message_id):
+        """ Метод, удаляющий сообщение из очереди исходящих. """
+        self.session.query(self.Outbox).filter_by(id=message_id).delete()
+        self.session.commit()
+
+    def get_outbox(self):
+        """ Метод, возвращающий очередь исходящих сообщений: (id, контакт, сообщение). """
+        return self.session.query(
+            self.Outbox.id, self.Outbox.contact, self.Outbox.message
+        ).order_by(self.Outbox.id).all()
 
     def get_contacts(self):
         """ Метод, возвращающий список всех контактов. """
@@ -158,14 +317,44 @@ class ClientDatabase:
             return False
 
     def get_history(self, contact):
-        """ Метод, возвращающий историю сообщений с определённым пользователем. """
+        """ Метод, возвращающий историю сообщений с определённым пользователем по дате. """
+        query = self.session.query(
+            self.MessageStat.contact,
+            self.MessageStat.direction,
+            self.MessageStat.message,
+            self.MessageStat.date
+        ).filter_by(contact=contact).order_by(self.MessageStat.date, self.MessageStat.id)
+        return query.all()
+
+    def get_history_page(self, contact, limit=HISTORY_PAGE_SIZE, before=None):
+        """
+        Метод, возвращающий страницу истории сообщений с пользователем:
+        limit последних сообщений, а если передан курсор before - limit
+        сообщений, предшествующих ему. Страница читается по индексу
+        (contact, date) без просмотра остальной истории.
+        Возвращает (сообщения по возрастанию даты, курсор для следующей
+        страницы или None, если более ранних сообщений нет).
+        """
         query = self.session.query(
-            self.MessageStat).filter_by(
-            contact=contact)
-        return [(history_row.contact,
-                 history_row.direction,
-                 history_row.message,
-                 history_row.date) for history_row in query.all()]
+            self.MessageStat.contact,
+            self.MessageStat.direction,
+            self.MessageStat.message,
+            self.MessageStat.date,
+            self.MessageStat.id
+        ).filter(self.MessageStat.contact == contact)
+        if before is not None:
+            # Курсор (дата, id): у сообщений может совпадать время
+            date, message_id = before
+            query = query.filter(or_(
+                self.MessageStat.date < date,
+                and_(self.MessageStat.date == date, self.MessageStat.id < message_id)))
+        rows = query.order_by(
+            self.MessageStat.date.desc(), self.MessageStat.id.desc()).limit(limit + 1).all()
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = (rows[-1].date, rows[-1].id)
+        return [tuple(row[:4]) for row in reversed(rows)], cursor
 
 
 # отладка
@@ -181,6 +370,6 @@ if __name__ == '__main__':
     print(test_db.get_users())
     print(test_db.check_user('test1'))
     print(test_db.check_user('test10'))
-    print(sorted(test_db.get_history('test2'), key=lambda item: item[3]))
+    print(test_db.get_history('test2'))
     test_db.del_contact('test4')
     print(test_db.get_contacts())
@@ -0,0 +1,103 @@
+import sys
+
+sys.path.append('../')
+from PyQt5.QtCore import Qt, QAbstractListModel, QModelIndex
+from PyQt5.QtGui import QBrush, QColor
+from PyQt5.QtWidgets import QStyledItemDelegate
+from common.variables import HISTORY_PAGE_SIZE
+
+# Роль данных модели: направление сообщения ('in' или 'out')
+DIRECTION_ROLE = Qt.UserRole
+
+
+class HistoryModel(QAbstractListModel):
+    '''
+    Модель истории переписки с одним собеседником.
+    Хранит загруженные сообщения по возрастанию даты. Более ранние
+    сообщения подгружаются из базы страницами по курсору (canFetchMore,
+    fetchMore), новые добавляются в конец (append_messages).
+    QListView запрашивает подгрузку, когда прокручен к концу списка,
+    а ранние сообщения в чате - сверху, поэтому подгрузка разрешена
+    только пока окно сообщает, что прокручено к началу (at_top).
+    '''
+
+    def __init__(self, database, contact, parent=None):
+        super().__init__(parent)
+        self.database = database
+        self.contact = contact
+        self.rows, self.cursor = database.get_history_page(contact, HISTORY_PAGE_SIZE)
+        self.at_top = False
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        contact, direction, message, date = self.rows[index.row()]
+        if role == Qt.DisplayRole:
+            title = 'Входящее' if direction == 'in' else 'Исходящее'
+            return f'{title} от {date.replace(microsecond=0)}:\n {message}'
+        if role == DIRECTION_ROLE:
+            return direction
+        return None
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.at_top and self.cursor is not None
+
+    def fetchMore(self, parent=QModelIndex()):
+        '''Подгрузка страницы сообщений, предшествующих загруженным.'''
+        if not self.canFetchMore(parent):
+            return
+        rows, self.cursor = self.database.get_history_page(
+            self.contact, HISTORY_PAGE_SIZE, self.cursor)
+        if not rows:
+            return
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self.rows[0:0] = rows
+        self.endInsertRows()
+
+    def append_messages(self, rows):
+        '''Добавление новых сообщений (contact, direction, message, date) в конец.'''
+        if not rows:
+            return
+        position = len(self.rows)
+        self.beginInsertRows(QModelIndex(), position, position + len(rows) - 1)
+        self.rows.extend(rows)
+        self.endInsertRows()
+
+
+class HistoryDelegate(QStyledItemDelegate):
+    '''
+    Делегат отрисовки истории: входящие сообщения - слева на розовом фоне,
+    исходящие - справа на зелёном. Кисти общие для всех строк.
+    QListView при каждой вставке заново раскладывает все загруженные
+    строки, поэтому размеры строк (перенос текста по ширине окна)
+    запоминаются: повторная раскладка не пересчитывает текст.
+    '''
+    BRUSHES = {
+        'in': QBrush(QColor(255, 213, 213)),
+        'out': QBrush(QColor(204, 255, 204)),
+    }
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # {(строка модели, ширина): QSize}
+        self.sizes = dict()
+
+    def sizeHint(self, option, index):
+        key = (index.model().rows[index.row()], option.rect.width())
+        size = self.sizes.get(key)
+        if size is None:
+            size = self.sizes[key] = super().sizeHint(option, index)
+        return size
+
+    def clear(self):
+        '''Очистка запомненных размеров (смена собеседника).'''
+        self.sizes = dict()
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        direction = index.data(DIRECTION_ROLE)
+        option.backgroundBrush = self.BRUSHES.get(direction, option.backgroundBrush)
+        option.displayAlignment = Qt.AlignLeft if direction == 'in' else Qt.AlignRight
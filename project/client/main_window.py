@@ -1,17 +1,17 @@
-from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView
-from PyQt5.QtGui import QStandardItemModel, QStandardItem, QBrush, QColor
+from PyQt5.QtWidgets import QMainWindow, qApp, QMessageBox, QApplication, QListView, QAbstractItemView
+from PyQt5.QtGui import QStandardItemModel, QStandardItem, QFont
 from PyQt5.QtCore import pyqtSlot, QEvent, Qt
-from Cryptodome.Cipher import PKCS1_OAEP
-from Cryptodome.PublicKey import RSA
 import json
 import logging
-import base64
 import sys
 
 sys.path.append('../')
 from client.main_window_conv import Ui_MainClientWindow
 from client.add_contact import AddContactDialog
 from client.del_contact import DelContactDialog
+from client.history_model import HistoryModel, HistoryDelegate
+from client.receiver import MessageReceiver
+from client.session_keys import SessionKeys
 from common.errors import ServerError
 from common.variables import *
 
@@ -33,8 +33,10 @@ class ClientMainWindow(QMainWindow):
         self.database = database
         self.transport = transport
 
-        # объект - дешифорвщик сообщений с предзагруженным ключём
-        self.decrypter = PKCS1_OAEP.new(keys)
+        # Сеансовые ключи шифрования переписки
+        self.sessions = SessionKeys(keys)
+        # Расшифровка и сохранение входящих сообщений вне потока GUI
+        self.receiver = MessageReceiver(database, self.sessions)
 
         # Загружаем конфигурацию окна из дизайнера
         self.ui = Ui_MainClientWindow()
@@ -57,13 +59,22 @@ class ClientMainWindow(QMainWindow):
         # Дополнительные требующиеся атрибуты
         self.contacts_model = None
         self.history_model = None
+        # Флаг загрузки истории: изменения прокрутки в это время
+        # не должны запускать подгрузку
+        self.history_loading = False
         self.messages = QMessageBox()
         self.current_chat = None
         self.current_chat_key = None
-        self.encryptor = None
         self.ui.list_messages.setHorizontalScrollBarPolicy(
             Qt.ScrollBarAlwaysOff)
         self.ui.list_messages.setWordWrap(True)
+        # История: цвет и выравнивание рисует делегат, ранние сообщения
+        # подгружаются при прокрутке к началу
+        self.history_delegate = HistoryDelegate(self.ui.list_messages)
+        self.ui.list_messages.setItemDelegate(self.history_delegate)
+        self.ui.list_messages.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.ui.list_messages.verticalScrollBar().valueChanged.connect(self.history_scrolled)
+        self.ui.list_messages.verticalScrollBar().rangeChanged.connect(self.history_scrolled)
 
         # Даблклик по листу контактов отправляется в обработчик
         self.ui.list_contacts.doubleClicked.connect(self.select_active_user)
@@ -79,14 +90,14 @@ class ClientMainWindow(QMainWindow):
             'Для выбора получателя дважды кликните на нем в окне контактов.')
         self.ui.text_message.clear()
         if self.history_model:
-            self.history_model.clear()
+            self.history_model = None
+            self.ui.list_messages.setModel(None)
 
         # Поле ввода и кнопка отправки неактивны до выбора получателя.
         self.ui.btn_clear.setDisabled(True)
         self.ui.btn_send.setDisabled(True)
         self.ui.text_message.setDisabled(True)
 
-        self.encryptor = None
         self.current_chat = None
         self.current_chat_key = None
 
@@ -94,43 +105,50 @@ class ClientMainWindow(QMainWindow):
         '''
         Метод заполняющий соответствующий QListView
         историей переписки с текущим собеседником.
+        Загружается последняя страница истории, более ранние сообщения
+        подгружаются при прокрутке к началу (history_scrolled).
         '''
-        # Получаем историю сортированную по дате
-        list = sorted(
-            self.database.get_history(
-                self.current_chat),
-            key=lambda item: item[3])
-        # Если модель не создана, создадим.
-        if not self.history_model:
-            self.history_model = QStandardItemModel()
-            self.ui.list_messages.setModel(self.history_model)
-        # Очистим от старых записей
-        self.history_model.clear()
-        # Берём не более 20 последних записей.
-        length = len(list)
-        start_index = 0
-        if length > 20:
-            start_index = length - 20
-        # Заполнение модели записями, так-же стоит разделить входящие
-        # и исходящие выравниванием и разным фоном.
-        # отображает только последие 20 сообщений
-        for i in range(start_index, length):
-            item = list[i]
-            if item[1] == 'in':
-                mess = QStandardItem(
-                    f'Входящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setBackground(QBrush(QColor(255, 213, 213)))
-                mess.setTextAlignment(Qt.AlignLeft)
-                self.history_model.appendRow(mess)
-            else:
-                mess = QStandardItem(
-                    f'Исходящее от {item[3].replace(microsecond=0)}:\n {item[2]}')
-                mess.setEditable(False)
-                mess.setTextAlignment(Qt.AlignRight)
-                mess.setBackground(QBrush(QColor(204, 255, 204)))
-                self.history_model.appendRow(mess)
-        self.ui.list_messages.scrollToBottom()
+        self.history_model = HistoryModel(self.database, self.current_chat)
+        self.history_delegate.clear()
+        view = self.ui.list_messages
+        # Пока модель устанавливается, прокрутка находится в начале:
+        # подгрузка в этот момент не нужна
+        self.history_loading = True
+        try:
+            view.setModel(self.history_model)
+            view.scrollToBottom()
+        finally:
+            self.history_loading = False
+
+    def history_append(self, rows):
+        '''Метод добавления новых сообщений в конец открытой истории.'''
+        if self.history_model and rows:
+            self.history_model.append_messages(rows)
+            self.ui.list_messages.scrollToBottom()
+
+    def history_scrolled(self, *args):
+        '''
+        Метод подгрузки ранних сообщений при прокрутке истории к началу.
+        После подгрузки прежде первое сообщение остаётся вверху окна,
+        поэтому видимая часть истории не сдвигается.
+        '''
+        model = self.history_model
+        if not model or self.history_loading:
+            return
+        view = self.ui.list_messages
+        scrollbar = view.verticalScrollBar()
+        model.at_top = scrollbar.value() == scrollbar.minimum()
+        if not model.canFetchMore():
+            return
+        # Вставка строк и перенос прокрутки сами меняют полосу прокрутки
+        self.history_loading = True
+        try:
+            count = model.rowCount()
+            model.fetchMore()
+            model.at_top = False
+            view.scrollTo(model.index(model.rowCount() - count, 0), QAbstractItemView.PositionAtTop)
+        finally:
+            self.history_loading = False
 
     def select_active_user(self):
         '''Метод обработчик события двойного клика по списку контактов.'''
@@ -142,17 +160,17 @@ class ClientMainWindow(QMainWindow):
 
     def set_active_user(self):
         '''Метод активации чата с собеседником.'''
-        # Запрашиваем публичный ключ пользователя и создаём объект шифрования
+        # Получаем публичный ключ пользователя (из базы клиента, с сервера -
+        # только если ключ сменился) и готовим сеансовый ключ переписки:
+        # разбор ключа и шифрование RSA выполняются один раз на сеанс
         try:
             self.current_chat_key = self.transport.key_request(
                 self.current_chat)
             LOG.debug(f'Загружен открытый ключ для {self.current_chat}')
             if self.current_chat_key:
-                self.encryptor = PKCS1_OAEP.new(
-                    RSA.import_key(self.current_chat_key))
-        except (OSError, json.JSONDecodeError):
+                self.sessions.session(self.current_chat, self.current_chat_key)
+        except (OSError, ValueError, json.JSONDecodeError):
             self.current_chat_key = None
-            self.encryptor = None
             LOG.debug(f'Не удалось получить ключ для {self.current_chat}')
 
         # Если ключа нет то ошибка, что не удалось начать чат с пользователем
@@ -172,12 +190,17 @@ class ClientMainWindow(QMainWindow):
         self.history_list_update()
 
     def clients_list_update(self):
-        '''Метод обновляющий список контактов.'''
+        '''Метод обновляющий список контактов. Контакты в сети выделяются жирным.'''
         contacts_list = self.database.get_contacts()
+        online = self.transport.online
         self.contacts_model = QStandardItemModel()
+        bold = QFont()
+        bold.setBold(True)
         for i in sorted(contacts_list):
             item = QStandardItem(i)
             item.setEditable(False)
+            if i in online:
+                item.setFont(bold)
             self.contacts_model.appendRow(item)
         self.ui.list_contacts.setModel(self.contacts_model)
 
@@ -265,62 +288,49 @@ class ClientMainWindow(QMainWindow):
         self.ui.text_message.clear()
         if not message_text:
             return
-        # Шифруем сообщение ключом получателя и упаковываем в base64.
-        message_text_encrypted = self.encryptor.encrypt(
-            message_text.encode('utf8'))
-        message_text_encrypted_base64 = base64.b64encode(
-            message_text_encrypted)
+        # Шифруем сообщение сеансовым ключом переписки. Упаковку в base64
+        # для JSON выполняет кодек транспорта, двоичный кодек передаёт байты
+        # как есть.
+        message_text_encrypted = self.sessions.encrypt(
+            self.current_chat, self.current_chat_key, message_text.encode('utf8'))
         try:
-            self.transport.send_message(
-                self.current_chat,
-                message_text_encrypted_base64.decode('ascii'))
-            pass
+            delivered = self.transport.send_message(
+                self.current_chat, message_text_encrypted)
         except ServerError as err:
             self.messages.critical(self, 'Ошибка', err.text)
-        except OSError as err:
-            if err.errno:
-                self.messages.critical(
-                    self, 'Ошибка', 'Потеряно соединение с сервером!')
-                self.close()
-            self.messages.critical(self, 'Ошибка', 'Таймаут соединения!')
-        except (ConnectionResetError, ConnectionAbortedError):
-            self.messages.critical(
-                self, 'Ошибка', 'Потеряно соединение с сервером!')
-            self.close()
         else:
-            self.database.save_message(self.current_chat, 'out', message_text)
+            # Недоставленное сообщение хранится в очереди транспорта и будет
+            # отправлено после переподключения, в историю оно попадает сразу
+            row = self.database.save_message(self.current_chat, 'out', message_text)
             LOG.debug(
                 f'Отправлено сообщение для {self.current_chat}: {message_text}')
-            self.history_list_update()
+            if not delivered:
+                self.statusBar().showMessage(
+                    'Нет соединения с сервером. Сообщение будет отправлено после переподключения.')
+            self.history_append([row])
 
-    @pyqtSlot(dict)
-    def message(self, message):
+    @pyqtSlot(list, int)
+    def messages_received(self, rows, failed):
         '''
-        Слот обработчик поступаемых сообщений, выполняет дешифровку
-        поступаемых сообщений и их сохранение в истории сообщений.
-        Запрашивает пользователя если пришло сообщение не от текущего
-        собеседника. При необходимости меняет собеседника.
+        Слот обработчик группы входящих сообщений, уже расшифрованных
+        и сохранённых в истории (MessageReceiver). Добавляет сообщения
+        текущего собеседника в окно, по остальным отправителям
+        спрашивает пользователя и при необходимости меняет собеседника.
         '''
-        # Получаем строку байтов
-        encrypted_message = base64.b64decode(message[MESSAGE_TEXT])
-        # Декодируем строку, при ошибке выдаём сообщение и завершаем функцию
-        try:
-            decrypted_message = self.decrypter.decrypt(encrypted_message)
-        except (ValueError, TypeError):
+        if failed:
             self.messages.warning(
                 self, 'Ошибка', 'Не удалось декодировать сообщение.')
-            return
-        # Сохраняем сообщение в базу и обновляем историю сообщений или
-        # открываем новый чат.
-        self.database.save_message(
-            self.current_chat,
-            'in',
-            decrypted_message.decode('utf8'))
-
-        sender = message[SENDER]
-        if sender == self.current_chat:
-            self.history_list_update()
-        else:
+        self.history_append([row for row in rows if row[0] == self.current_chat])
+
+        senders = []
+        for sender, *_ in rows:
+            if sender not in senders:
+                senders.append(sender)
+        for sender in senders:
+            # Чат мог открыться ответом на предыдущий вопрос, тогда
+            # сообщения уже загружены из истории
+            if sender == self.current_chat:
+                continue
             # Проверим есть ли такой пользователь у нас в контактах:
             if self.database.check_contact(sender):
                 # Если есть, спрашиваем и желании открыть с ним чат и открываем
@@ -334,7 +344,6 @@ class ClientMainWindow(QMainWindow):
                     self.current_chat = sender
                     self.set_active_user()
             else:
-                print('NO')
                 # Раз нету,спрашиваем хотим ли добавить юзера в контакты.
                 if self.messages.question(
                     self,
@@ -344,23 +353,27 @@ class ClientMainWindow(QMainWindow):
                         QMessageBox.No) == QMessageBox.Yes:
                     self.add_contact(sender)
                     self.current_chat = sender
-                    # Нужно заново сохранить сообщение, иначе оно будет потеряно,
-                    # т.к. на момент предыдущего вызова контакта не было.
-                    self.database.save_message(
-                        self.current_chat, 'in', decrypted_message.decode('utf8'))
                     self.set_active_user()
 
     @pyqtSlot()
     def connection_lost(self):
         '''
         Слот обработчик потери соеднинения с сервером.
-        Выдаёт окно предупреждение и завершает работу приложения.
+        Транспорт переподключается сам, окно только сообщает об этом:
+        сообщения можно писать и дальше, они ждут в очереди исходящих.
+        '''
+        self.statusBar().showMessage(
+            'Потеряно соединение с сервером. Переподключение...')
+        self.clients_list_update()
+
+    @pyqtSlot()
+    def connection_restored(self):
+        '''
+        Слот обработчик восстановления соединения с сервером.
+        Списки пользователей и контактов к этому моменту уже обновлены.
         '''
-        self.messages.warning(
-            self,
-            'Сбой соединения',
-            'Потеряно соединение с сервером. ')
-        self.close()
+        self.statusBar().showMessage('Соединение с сервером восстановлено.', 5000)
+        self.sig_205()
 
     @pyqtSlot()
     def sig_205(self):
@@ -379,8 +392,13 @@ class ClientMainWindow(QMainWindow):
 
     def make_connection(self, trans_obj):
         '''Метод обеспечивающий соединение сигналов и слотов.'''
-        trans_obj.new_message.connect(self.message)
+        # Входящие сообщения попадают в очередь приёма прямо из потока
+        # транспорта, окно получает только готовые группы
+        trans_obj.new_message.connect(self.receiver.submit, Qt.DirectConnection)
+        self.receiver.messages_received.connect(self.messages_received)
         trans_obj.connection_lost.connect(self.connection_lost)
+        trans_obj.connection_restored.connect(self.connection_restored)
         trans_obj.message_205.connect(self.sig_205)
+        trans_obj.presence_changed.connect(self.clients_list_update)
 
 
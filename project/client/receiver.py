@@ -0,0 +1,93 @@
+import base64
+import logging
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append('../')
+from PyQt5.QtCore import pyqtSignal, QObject
+from common.variables import *
+
+LOG = logging.getLogger('app.client')
+
+
+class MessageReceiver(QObject):
+    '''
+    Обработка входящих сообщений вне потока GUI.
+    Сообщения от транспорта (submit) копятся в очереди, поток приёма
+    забирает их группами, расшифровывает группу параллельно пулом потоков
+    и сохраняет в историю одной транзакцией. Окно получает один сигнал
+    на группу: строки истории и число сообщений, которые не удалось
+    расшифровать. Математика RSA в PyCryptodome выполняется без GIL,
+    поэтому расшифровка занимает все ядра (а в гибридном режиме RSA
+    нужна только первому сообщению сеанса, см. SessionKeys).
+    '''
+    messages_received = pyqtSignal(list, int)
+
+    def __init__(self, database, sessions, workers=None):
+        super().__init__()
+        self.database = database
+        self.sessions = sessions
+        self.pool = ThreadPoolExecutor(workers or os.cpu_count())
+        # Очередь входящих сообщений и поток приёма
+        self.incoming = queue.Queue()
+        self.thread = threading.Thread(target=self.receive_loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, message):
+        '''Постановка входящего сообщения в очередь (из потока транспорта).'''
+        self.incoming.put(message)
+
+    def close(self):
+        '''Остановка потока приёма после обработки уже принятых сообщений.'''
+        self.incoming.put(None)
+        self.thread.join()
+        self.pool.shutdown()
+
+    def receive_loop(self):
+        '''Основной цикл потока приёма.'''
+        while True:
+            batch = [self.incoming.get()]
+            # Забираем всё, что успело накопиться, одной группой
+            while len(batch) < RECEIVE_BATCH_SIZE:
+                try:
+                    batch.append(self.incoming.get_nowait())
+                except queue.Empty:
+                    break
+            # None - сигнал остановки потока (close)
+            stop = None in batch
+            batch = [message for message in batch if message is not None]
+            if batch:
+                try:
+                    self.process_batch(batch)
+                except Exception as err:
+                    LOG.error(f'Не удалось сохранить входящие сообщения: {err}')
+            if stop:
+                return
+
+    def process_batch(self, batch):
+        '''Расшифровка и сохранение группы сообщений, сигнал окну.'''
+        rows = []
+        for message, text in zip(batch, self.pool.map(self.decrypt, batch)):
+            if text is not None:
+                rows.append((message[SENDER], 'in', text))
+        if rows:
+            rows = self.database.save_messages(rows)
+        self.messages_received.emit(rows, len(batch) - len(rows))
+
+    def decrypt(self, message):
+        '''
+        Расшифровка текста сообщения (в потоке пула).
+        Возвращает текст или None, если расшифровать не удалось.
+        '''
+        # Строка байтов: от двоичного кодека - как есть, от JSON - строкой base64
+        encrypted_message = message[MESSAGE_TEXT]
+        try:
+            if not isinstance(encrypted_message, bytes):
+                encrypted_message = base64.b64decode(encrypted_message)
+            return self.sessions.decrypt(message[SENDER], encrypted_message).decode('utf8')
+        except (ValueError, TypeError):
+            LOG.error(f'Не удалось расшифровать сообщение от {message[SENDER]}')
+            return None
@@ -0,0 +1,138 @@
+import os
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+sys.path.append('../')
+from Cryptodome.Cipher import AES, PKCS1_OAEP
+from Cryptodome.PublicKey import RSA
+from common.variables import *
+
+# Заголовок гибридного сообщения: признак формата, id сеансового ключа,
+# длина зашифрованного RSA сеансового ключа. Далее - сам ключ, nonce,
+# текст, зашифрованный AES-GCM, и метка аутентификации.
+HYBRID_MAGIC = b'JIMH'
+HYBRID_HEADER = struct.Struct('!4s8sH')
+SESSION_KEY_SIZE = 32
+NONCE_SIZE = 12
+TAG_SIZE = 16
+
+
+class OutgoingSession:
+    """
+    Сеансовый ключ исходящей переписки с одним собеседником.
+    wrapped - ключ, зашифрованный открытым ключом собеседника.
+    """
+    __slots__ = ('pubkey', 'key', 'key_id', 'wrapped', 'created', 'count')
+
+    def __init__(self, pubkey):
+        self.pubkey = pubkey
+        self.key = os.urandom(SESSION_KEY_SIZE)
+        self.key_id = os.urandom(8)
+        self.wrapped = PKCS1_OAEP.new(RSA.import_key(pubkey)).encrypt(self.key)
+        self.created = time.time()
+        self.count = 0
+
+    def expired(self, pubkey):
+        '''Нужна ли смена ключа: сменился ключ собеседника, ключ исчерпан или устарел.'''
+        return pubkey != self.pubkey or self.count >= SESSION_KEY_MESSAGES \
+            or time.time() - self.created > SESSION_KEY_LIFETIME
+
+
+class SessionKeys:
+    """
+    Гибридное шифрование сообщений: текст шифруется AES-GCM сеансовым
+    ключом переписки, сеансовый ключ - открытым ключом RSA собеседника.
+    Ключ создаётся и шифруется RSA один раз на сеанс и сменяется через
+    SESSION_KEY_MESSAGES сообщений или SESSION_KEY_LIFETIME секунд.
+    Зашифрованный ключ передаётся в каждом сообщении: сообщение не зависит
+    от доставки предыдущих (почтовый ящик сервера, очередь исходящих),
+    а получатель расшифровывает RSA только первое сообщение сеанса -
+    ключи принятых сеансов хранятся в памяти.
+    Сообщения старого формата (текст, зашифрованный RSA целиком)
+    по-прежнему расшифровываются.
+    Используется из потока GUI и потоков пула расшифровки.
+    """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.lock = threading.Lock()
+        # Исходящие сеансы: {собеседник: OutgoingSession}
+        self.outgoing = dict()
+        # Ключи принятых сеансов: {(отправитель, id ключа): ключ}
+        self.incoming = OrderedDict()
+        # Дешифровщик RSA у каждого потока свой
+        self.local = threading.local()
+
+    def decrypter(self):
+        '''Дешифровщик RSA текущего потока.'''
+        decrypter = getattr(self.local, 'decrypter', None)
+        if decrypter is None:
+            decrypter = self.local.decrypter = PKCS1_OAEP.new(self.keys)
+        return decrypter
+
+    def session(self, contact, pubkey):
+        '''
+        Исходящий сеанс переписки с contact, при необходимости - новый.
+        Неверный открытый ключ pubkey - ValueError.
+        '''
+        with self.lock:
+            session = self.outgoing.get(contact)
+            if session is None or session.expired(pubkey):
+                session = self.outgoing[contact] = OutgoingSession(pubkey)
+            return session
+
+    def encrypt(self, contact, pubkey, data):
+        '''Шифрование байтов data для собеседника contact с открытым ключом pubkey.'''
+        session = self.session(contact, pubkey)
+        with self.lock:
+            session.count += 1
+        header = HYBRID_HEADER.pack(HYBRID_MAGIC, session.key_id, len(session.wrapped)) \
+            + session.wrapped
+        nonce = os.urandom(NONCE_SIZE)
+        cipher = AES.new(session.key, AES.MODE_GCM, nonce=nonce, mac_len=TAG_SIZE)
+        cipher.update(header)
+        text, tag = cipher.encrypt_and_digest(data)
+        return header + nonce + text + tag
+
+    def decrypt(self, sender, data):
+        '''
+        Расшифровка байтов data, полученных от sender.
+        При ошибке расшифровки или проверки целостности - ValueError.
+        '''
+        if data[:len(HYBRID_MAGIC)] != HYBRID_MAGIC:
+            return self.decrypter().decrypt(data)
+        try:
+            return self.decrypt_hybrid(sender, data)
+        except ValueError:
+            # Сообщение старого формата, случайно начавшееся с признака
+            if len(data) == self.keys.size_in_bytes():
+                return self.decrypter().decrypt(data)
+            raise
+
+    def decrypt_hybrid(self, sender, data):
+        '''Расшифровка сообщения гибридного формата.'''
+        if len(data) < HYBRID_HEADER.size:
+            raise ValueError('Неполное зашифрованное сообщение')
+        _, key_id, wrapped_length = HYBRID_HEADER.unpack_from(data)
+        body = HYBRID_HEADER.size + wrapped_length
+        if len(data) < body + NONCE_SIZE + TAG_SIZE:
+            raise ValueError('Неполное зашифрованное сообщение')
+        session = (sender, key_id)
+        with self.lock:
+            key = self.incoming.get(session)
+            if key is not None:
+                self.incoming.move_to_end(session)
+        if key is None:
+            key = self.decrypter().decrypt(data[HYBRID_HEADER.size:body])
+            if len(key) != SESSION_KEY_SIZE:
+                raise ValueError('Неверная длина сеансового ключа')
+            with self.lock:
+                self.incoming[session] = key
+                while len(self.incoming) > SESSION_KEY_CACHE:
+                    self.incoming.popitem(last=False)
+        cipher = AES.new(key, AES.MODE_GCM, nonce=data[body:body + NONCE_SIZE], mac_len=TAG_SIZE)
+        cipher.update(data[:body])
+        return cipher.decrypt_and_verify(data[body + NONCE_SIZE:-TAG_SIZE], data[-TAG_SIZE:])
@@ -1,9 +1,15 @@
+import functools
+import itertools
+import queue
+import random
 import socket
 import sys
 import time
 import logging
 import json
 import threading
+from collections import OrderedDict
+from concurrent import futures
 import hashlib
 import hmac
 import binascii
@@ -13,10 +19,10 @@ sys.path.append('../')
 from common.utils import *
 from common.variables import *
 from common.errors import ServerError
+from common.responses import auth_511
 
-# Логер и объект блокировки для работы с сокетом.
+# Логер
 LOG = logging.getLogger('app.client')
-socket_lock = threading.Lock()
 
 
 # Класс - Транспорт, отвечает за взаимодействие с сервером
@@ -25,10 +31,13 @@ class ClientTransport(threading.Thread, QObject):
     Класс реализующий транспортную подсистему клиентского
     модуля. Отвечает за взаимодействие с сервером.
     '''
-    # Сигналы новое сообщение и потеря соединения
+    # Сигналы новое сообщение, изменение присутствия контактов, потеря
+    # и восстановление соединения
     new_message = pyqtSignal(dict)
     message_205 = pyqtSignal()
+    presence_changed = pyqtSignal()
     connection_lost = pyqtSignal()
+    connection_restored = pyqtSignal()
 
     def __init__(self, port, ip_address, database, username, passwd, keys):
         # Вызываем конструкторы предков
@@ -43,14 +52,35 @@ class ClientTransport(threading.Thread, QObject):
         self.password = passwd
         # Сокет для работы с сервером
         self.transport = None
+        # Декодер входящего потока сообщений сервера
+        self.decoder = MessageDecoder()
+        # Запросы, ожидающие ответа: {номер запроса: Future}, в порядке отправки
+        self.pending = OrderedDict()
+        self.pending_lock = threading.Lock()
+        self.request_ids = itertools.count(1)
+        # Блокировка только на время записи кадра в сокет
+        self.send_lock = threading.RLock()
+        # Уведомления, принятые потоком приёма
+        self.pushes = queue.Queue()
+        # Кодек сообщений: JSON до авторизации, затем выбранный сервером
+        self.codec = CODEC_JSON
+        # Сжатие исходящих кадров, если сервер его поддерживает
+        self.compressor = None
+        # Соединение установлено и авторизовано
+        self.connected = threading.Event()
+        # Транспорт остановлен (прерывает ожидание переподключения)
+        self.stopped = threading.Event()
+        # Исходящие сообщения из базы, ждущие ответа сервера (id в очереди)
+        self.in_flight = set()
+        self.outbox_lock = threading.Lock()
         # Набор ключей для шифрования
         self.keys = keys
         # Устанавливаем соединение:
+        self.server_address = (ip_address, port)
         self.connection_init(port, ip_address)
         # Обновляем таблицы известных пользователей и контактов
         try:
-            self.user_list_update()
-            self.contacts_list_update()
+            self.lists_update()
         except OSError as err:
             if err.errno:
                 LOG.critical(f'Потеряно соединение с сервером.')
@@ -63,18 +93,27 @@ class ClientTransport(threading.Thread, QObject):
             # Флаг продолжения работы транспорта.
         self.running = True
 
-    def connection_init(self, port, ip):
-        '''Метод отвечающий за устанновку соединения с сервером.'''
+    def connection_init(self, port, ip, attempts=5):
+        '''
+        Метод отвечающий за устанновку соединения с сервером.
+        Используется и при переподключении: состояние прежнего
+        соединения (декодер, кодек, сжатие) сбрасывается.
+        '''
+        self.decoder = MessageDecoder()
+        self.codec = CODEC_JSON
+        self.compressor = None
+        # Контакты в сети: после входа сервер присылает уведомления заново
+        self.online = set()
         # Инициализация сокета и сообщение серверу о нашем появлении
         self.transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
         # Таймаут необходим для освобождения сокета.
         self.transport.settimeout(5)
 
-        # Соединяемся, 5 попыток соединения, флаг успеха ставим в True если
+        # Соединяемся, attempts попыток соединения, флаг успеха ставим в True если
         # удалось
         connected = False
-        for i in range(5):
+        for i in range(attempts):
             LOG.info(f'Попытка подключения №{i + 1}')
             try:
                 self.transport.connect((ip, port))
@@ -84,10 +123,12 @@ class ClientTransport(threading.Thread, QObject):
                 connected = True
                 LOG.debug("Connection established.")
                 break
-            time.sleep(1)
+            if i + 1 < attempts:
+                time.sleep(1)
 
         # Если соединится не удалось - исключение
         if not connected:
+            self.transport.close()
             LOG.critical('Не удалось установить соединение с сервером')
             raise ServerError('Не удалось установить соединение с сервером')
 
@@ -106,39 +147,147 @@ class ClientTransport(threading.Thread, QObject):
         pubkey = self.keys.publickey().export_key().decode('ascii')
 
         # Авторизируемся на сервере
-        with socket_lock:
-            presense = {
-                ACTION: PRESENCE,
-                TIME: time.time(),
-                USER: {
-                    ACCOUNT_NAME: self.username,
-                    PUBLIC_KEY: pubkey
-                }
-            }
-            LOG.debug(f"Presense message = {presense}")
-            # Отправляем серверу приветственное сообщение.
+        presense = {
+            ACTION: PRESENCE,
+            TIME: time.time(),
+            USER: {
+                ACCOUNT_NAME: self.username,
+                PUBLIC_KEY: pubkey
+            },
+            CODECS: [CODEC_BINARY, CODEC_JSON],
+            COMPRESSION: [COMPRESSION_ZLIB]
+        }
+        LOG.debug(f"Presense message = {presense}")
+        # Отправляем серверу приветственное сообщение.
+        try:
+            ans = self.call(presense, handshake=True)
+            LOG.debug(f'Server response = {ans}.')
+            # Если сервер вернул ошибку, бросаем исключение.
+            if RESPONSE in ans:
+                if ans[RESPONSE] == 400:
+                    raise ServerError(ans[ERROR])
+                elif ans[RESPONSE] == 511:
+                    # Если всё нормально, то продолжаем процедуру
+                    # авторизации.
+                    ans_data = ans[DATA]
+                    hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'), 'MD5')
+                    digest = hash.digest()
+                    my_ans = auth_511(binascii.b2a_base64(
+                        digest).decode('ascii'))
+                    # Старый сервер не выбирает кодек - остаёмся на JSON
+                    if ans.get(CODEC) in (CODEC_BINARY, CODEC_JSON):
+                        self.codec = ans[CODEC]
+                    if ans.get(COMPRESSION) == COMPRESSION_ZLIB:
+                        self.compressor = FrameCompressor()
+                    self.process_server_ans(self.call(my_ans, handshake=True))
+                    self.connected.set()
+        # Сервер мог закрыть соединение (TypeError) или прислать
+        # повреждённый либо неполный ответ (ValueError, KeyError)
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            LOG.debug(f'Connection error.', exc_info=err)
+            self.transport.close()
+            raise ServerError('Сбой соединения в процессе авторизации.')
+        except ServerError:
+            self.transport.close()
+            raise
+
+    def send_to_server(self, message):
+        '''
+        Метод отправки сообщения серверу с выбранными кодеком и сжатием.
+        Кадры разных потоков не должны перемешиваться, а сжатие - общий
+        поток соединения, поэтому запись выполняется под блокировкой.
+        '''
+        with self.send_lock:
+            send_message(self.transport, message, framed=True, codec=self.codec, compressor=self.compressor)
+
+    def request(self, message, handshake=False):
+        '''
+        Метод отправки запроса без ожидания ответа.
+        Запросу присваивается номер (REQUEST_ID), возвращается Future,
+        который завершит поток приёма, получив ответ с тем же номером.
+        Поэтому по одному соединению может выполняться много запросов сразу.
+        До завершения авторизации отправляются только запросы авторизации
+        (handshake), остальные вызывают ConnectionResetError.
+        '''
+        if not (handshake or self.connected.is_set()):
+            raise ConnectionResetError('Нет соединения с сервером')
+        future = futures.Future()
+        # Номер и отправка под одной блокировкой: порядок в pending
+        # совпадает с порядком отправки (см. dispatch)
+        with self.send_lock:
+            with self.pending_lock:
+                future.request_id = message[REQUEST_ID] = next(self.request_ids)
+                self.pending[future.request_id] = future
+            try:
+                self.send_to_server(message)
+            except OSError:
+                with self.pending_lock:
+                    self.pending.pop(future.request_id, None)
+                raise
+        return future
+
+    def wait_reply(self, future):
+        '''
+        Метод ожидания ответа на запрос.
+        Пока поток приёма не запущен (авторизация, первичная загрузка
+        списков) или сам выполняет переподключение, сокет читается здесь же.
+        '''
+        if threading.current_thread() is self or not self.is_alive():
+            while not future.done():
+                self.dispatch(get_message(self.transport, self.decoder))
+        try:
+            return future.result(REPLY_TIMEOUT)
+        except futures.TimeoutError:
+            with self.pending_lock:
+                self.pending.pop(future.request_id, None)
+            error = TimeoutError('Сервер не ответил на запрос')
+            # Ожидающие завершения Future (очередь исходящих) узнают о таймауте
+            if not future.done():
+                future.set_exception(error)
+            raise error
+
+    def call(self, message, handshake=False):
+        '''Метод отправки запроса и ожидания ответа на него.'''
+        return self.wait_reply(self.request(message, handshake))
+
+    @staticmethod
+    def is_push(message):
+        '''Метод проверки, что сообщение сервера - уведомление, а не ответ на запрос.'''
+        return message.get(ACTION) in (MESSAGE, NOTIFY) or message.get(RESPONSE) == 205
+
+    def dispatch(self, message):
+        '''
+        Метод разбора сообщения сервера: уведомления передаются потоку
+        обработки, ответ завершает Future запроса с тем же номером.
+        Ответ без номера (сервер старой версии) относится к самому раннему
+        запросу: такой сервер отвечает на запросы по порядку.
+        '''
+        if self.is_push(message):
+            self.pushes.put(message)
+            return
+        with self.pending_lock:
+            request_id = message.get(REQUEST_ID)
+            if request_id is None and self.pending:
+                request_id = next(iter(self.pending))
+            future = self.pending.pop(request_id, None)
+        if future is None:
+            LOG.warning(f'Получен ответ на неизвестный запрос: {message}')
+            return
+        future.set_result(message)
+
+    def process_pushes(self):
+        '''
+        Метод потока обработки уведомлений сервера. Обработка 205 сама
+        отправляет запросы, поэтому выполняется не в потоке приёма.
+        '''
+        while True:
+            message = self.pushes.get()
+            if message is None:
+                return
             try:
-                send_message(self.transport, presense)
-                ans = get_message(self.transport)
-                LOG.debug(f'Server response = {ans}.')
-                # Если сервер вернул ошибку, бросаем исключение.
-                if RESPONSE in ans:
-                    if ans[RESPONSE] == 400:
-                        raise ServerError(ans[ERROR])
-                    elif ans[RESPONSE] == 511:
-                        # Если всё нормально, то продолжаем процедуру
-                        # авторизации.
-                        ans_data = ans[DATA]
-                        hash = hmac.new(passwd_hash_string, ans_data.encode('utf-8'), 'MD5')
-                        digest = hash.digest()
-                        my_ans = RESPONSE_511
-                        my_ans[DATA] = binascii.b2a_base64(
-                            digest).decode('ascii')
-                        send_message(self.transport, my_ans)
-                        self.process_server_ans(get_message(self.transport))
-            except (OSError, json.JSONDecodeError) as err:
-                LOG.debug(f'Connection error.', exc_info=err)
-                raise ServerError('Сбой соединения в процессе авторизации.')
+                self.process_server_ans(message)
+            except (OSError, ServerError) as err:
+                LOG.error(f'Не удалось обработать уведомление сервера: {err}')
 
     def process_server_ans(self, message):
         '''Метод обработчик поступающих сообщений с сервера.'''
@@ -151,8 +300,7 @@ class ClientTransport(threading.Thread, QObject):
             elif message[RESPONSE] == 400:
                 raise ServerError(f'{message[ERROR]}')
             elif message[RESPONSE] == 205:
-                self.user_list_update()
-                self.contacts_list_update()
+                self.lists_update()
                 self.message_205.emit()
             else:
                 LOG.error(
@@ -166,54 +314,79 @@ class ClientTransport(threading.Thread, QObject):
                 f'Получено сообщение от пользователя {message[SENDER]}:{message[MESSAGE_TEXT]}')
             self.new_message.emit(message)
 
-    def contacts_list_update(self):
-        '''Метод обновляющий с сервера список контактов.'''
-        self.database.contacts_clear()
-        LOG.debug(f'Запрос контакт листа для пользователся {self.name}')
-        req = {
-            ACTION: GET_CONTACTS,
-            TIME: time.time(),
-            USER: self.username
-        }
-        LOG.debug(f'Сформирован запрос {req}')
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        LOG.debug(f'Получен ответ {ans}')
-        if RESPONSE in ans and ans[RESPONSE] == 202:
-            for contact in ans[LIST_INFO]:
-                self.database.add_contact(contact)
+        # Уведомления о присутствии контактов и удалении пользователей
+        elif ACTION in message and message[ACTION] == NOTIFY and EVENTS in message:
+            self.process_events(message[EVENTS], message.get(FINGERPRINTS))
+
+    def process_events(self, events, fingerprints=None):
+        '''
+        Метод применения уведомлений сервера. Уведомление содержит всё
+        нужное для обновления, запросы к серверу не отправляются.
+        Сохранённые ключи вошедших пользователей, отпечатки которых
+        изменились, удаляются и при открытии чата запрашиваются заново.
+        '''
+        self.database.check_fingerprints(fingerprints)
+        removed = []
+        for name, event in events:
+            if event == EVENT_ONLINE:
+                self.online.add(name)
+            elif event == EVENT_OFFLINE:
+                self.online.discard(name)
+            elif event == EVENT_USER_REMOVED:
+                self.online.discard(name)
+                removed.append(name)
+        if removed:
+            # Версия справочника не меняется: при следующей синхронизации
+            # это изменение придёт ещё раз и ничего не изменит
+            self.database.apply_changes(
+                self.database.get_version(), False, ([], removed), ([], removed))
+            self.message_205.emit()
         else:
-            LOG.error('Не удалось обновить список контактов.')
+            self.presence_changed.emit()
 
-    def user_list_update(self):
-        '''Метод обновляющий с сервера список пользователей.'''
-        LOG.debug(f'Запрос списка известных пользователей {self.username}')
+    def lists_update(self):
+        '''
+        Метод обновляющий с сервера списки известных пользователей и контактов.
+        Сервер присылает только изменения после версии справочника, которая
+        сохранена в базе клиента, или полные списки, если версии ещё нет.
+        '''
         req = {
-            ACTION: USERS_REQUEST,
+            ACTION: SYNC_REQUEST,
             TIME: time.time(),
-            ACCOUNT_NAME: self.username
+            ACCOUNT_NAME: self.username,
+            VERSION: self.database.get_version()
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
-        if RESPONSE in ans and ans[RESPONSE] == 202:
-            self.database.add_users(ans[LIST_INFO])
+        LOG.debug(f'Запрос изменений списков для пользователя {self.username}, версия {req[VERSION]}')
+        ans = self.call(req)
+        if RESPONSE in ans and ans[RESPONSE] == 202 and VERSION in ans:
+            users, contacts = ans[USERS], ans[CONTACTS]
+            self.database.apply_changes(
+                ans[VERSION], ans[FULL],
+                (users[ADDED], users[REMOVED]),
+                (contacts[ADDED], contacts[REMOVED]))
+            LOG.debug(f'Списки обновлены до версии {ans[VERSION]}')
         else:
-            LOG.error('Не удалось обновить список известных пользователей.')
+            LOG.error('Не удалось обновить списки пользователей и контактов.')
 
     def key_request(self, user):
-        '''Метод запрашивающий с сервера публичный ключ пользователя.'''
+        '''
+        Метод возвращающий публичный ключ пользователя. Ключ запрашивается
+        с сервера, только если его нет в базе клиента: сохранённые ключи
+        удаляются при их смене (process_events, lists_update).
+        '''
+        pubkey = self.database.get_pubkey(user)
+        if pubkey:
+            return pubkey
         LOG.debug(f'Запрос публичного ключа для {user}')
         req = {
             ACTION: PUBLIC_KEY_REQUEST,
             TIME: time.time(),
             ACCOUNT_NAME: user
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            ans = get_message(self.transport)
+        ans = self.call(req)
         if RESPONSE in ans and ans[RESPONSE] == 511:
+            if ans[DATA]:
+                self.database.save_pubkey(user, ans[DATA])
             return ans[DATA]
         else:
             LOG.error(f'Не удалось получить ключ собеседника{user}.')
@@ -227,9 +400,7 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.call(req))
 
     def remove_contact(self, contact):
         '''Метод отправляющий на сервер сведения о удалении контакта.'''
@@ -240,28 +411,32 @@ class ClientTransport(threading.Thread, QObject):
             USER: self.username,
             ACCOUNT_NAME: contact
         }
-        with socket_lock:
-            send_message(self.transport, req)
-            self.process_server_ans(get_message(self.transport))
+        self.process_server_ans(self.call(req))
 
     def transport_shutdown(self):
         '''Метод уведомляющий сервер о завершении работы клиента.'''
         self.running = False
+        self.stopped.set()
         message = {
             ACTION: EXIT,
             TIME: time.time(),
             ACCOUNT_NAME: self.username
         }
-        with socket_lock:
-            try:
-                send_message(self.transport, message)
-            except OSError:
-                pass
+        try:
+            self.send_to_server(message)
+        except OSError:
+            pass
         LOG.debug('Транспорт завершает работу.')
         time.sleep(0.5)
 
-    def send_message(self, to, message):
-        '''Метод отправляющий на сервер сообщения для пользователя.'''
+    def post_message(self, to, message):
+        '''
+        Метод отправки на сервер сообщения для пользователя без ожидания
+        подтверждения. Возвращает Future ответа сервера: несколько сообщений
+        подряд отправляются, не дожидаясь ответов на предыдущие.
+        message - зашифрованный текст (байты): в двоичном кодеке
+        передаётся как есть, в JSON - строкой base64.
+        '''
         message_dict = {
             ACTION: MESSAGE,
             SENDER: self.username,
@@ -270,39 +445,148 @@ class ClientTransport(threading.Thread, QObject):
             MESSAGE_TEXT: message
         }
         LOG.debug(f'Сформирован словарь сообщения: {message_dict}')
-        # Необходимо дождаться освобождения сокета для отправки сообщения
-        with socket_lock:
-            send_message(self.transport, message_dict)
-            self.process_server_ans(get_message(self.transport))
-            LOG.info(f'Отправлено сообщение для пользователя {to}')
+        return self.request(message_dict)
+
+    def send_message(self, to, message):
+        '''
+        Метод отправки сообщения пользователю через очередь исходящих.
+        Сообщение сохраняется в базе до ответа сервера, поэтому не теряется
+        при потере соединения. Возвращает True, если сервер принял сообщение,
+        и False, если соединения нет: сообщение будет отправлено после
+        переподключения. При отказе сервера (400) вызывает ServerError.
+        '''
+        message_id = self.database.outbox_add(to, message)
+        future = self.flush_outbox().get(message_id)
+        if future is None:
+            LOG.info(f'Нет соединения, сообщение для {to} поставлено в очередь')
+            return False
+        try:
+            reply = self.wait_reply(future)
+        except OSError:
+            LOG.info(f'Сообщение для {to} будет отправлено после переподключения')
+            return False
+        self.process_server_ans(reply)
+        LOG.info(f'Отправлено сообщение для пользователя {to}')
+        return True
+
+    def flush_outbox(self):
+        '''
+        Метод отправки очереди исходящих сообщений из базы по порядку.
+        Сообщения, ждущие ответа, повторно не отправляются. Сообщение
+        удаляется из очереди после ответа сервера (200 или 400) и остаётся
+        в ней, если ответа не было. Возвращает {id: Future ответа}
+        для отправленных сейчас сообщений.
+        '''
+        posted = dict()
+        with self.outbox_lock:
+            if not self.connected.is_set():
+                return posted
+            for message_id, contact, message in self.database.get_outbox():
+                if message_id in self.in_flight:
+                    continue
+                try:
+                    future = self.post_message(contact, message)
+                except OSError as err:
+                    LOG.debug(f'Очередь исходящих не отправлена: {err}')
+                    break
+                self.in_flight.add(message_id)
+                future.add_done_callback(functools.partial(self.outbox_done, message_id))
+                posted[message_id] = future
+        return posted
+
+    def outbox_done(self, message_id, future):
+        '''Метод обработки ответа сервера на сообщение из очереди исходящих.'''
+        self.in_flight.discard(message_id)
+        if future.exception() is not None:
+            return
+        reply = future.result()
+        if reply.get(RESPONSE) == 400:
+            LOG.error(f'Сервер отклонил сообщение: {reply.get(ERROR)}')
+        self.database.outbox_remove(message_id)
 
     def run(self):
-        '''Метод содержащий основной цикл работы транспортного потока.'''
+        '''
+        Метод содержащий основной цикл работы потока приёма.
+        Сокет читается блокирующе, без опроса: ответы на запросы завершают
+        Future ожидающих их методов, уведомления (сообщения пользователей,
+        205) передаются потоку обработки через очередь pushes.
+        При потере соединения поток переподключается к серверу.
+        '''
         LOG.debug('Запущен процесс - приёмник собщений с сервера.')
+        push_handler = threading.Thread(target=self.process_pushes, daemon=True)
+        push_handler.start()
+        # Сообщения, не отправленные в прошлый запуск
+        self.flush_outbox()
         while self.running:
-            # Отдыхаем секунду и снова пробуем захватить сокет.
-            # если не сделать тут задержку, то отправка может достаточно долго
-            # ждать освобождения сокета.
-            time.sleep(1)
-            message = None
-            with socket_lock:
-                try:
-                    self.transport.settimeout(0.5)
-                    message = get_message(self.transport)
-                except OSError as err:
-                    if err.errno:
-                        LOG.critical(f'Потеряно соединение с сервером.')
-                        self.running = False
-                        self.connection_lost.emit()
-                # Проблемы с соединением
-                except (ConnectionError, ConnectionAbortedError, ConnectionResetError, json.JSONDecodeError, TypeError):
-                    LOG.debug(f'Потеряно соединение с сервером.')
-                    self.running = False
-                    self.connection_lost.emit()
-                finally:
-                    self.transport.settimeout(5)
-
-            # Если сообщение получено, то вызываем функцию обработчик:
-            if message:
-                LOG.debug(f'Принято сообщение с сервера: {message}')
-                self.process_server_ans(message)
+            self.receive()
+            self.fail_pending()
+            if not self.running:
+                break
+            self.connected.clear()
+            self.transport.close()
+            self.online = set()
+            LOG.critical(f'Потеряно соединение с сервером.')
+            self.connection_lost.emit()
+            if self.reconnect():
+                threading.Thread(target=self.resume, daemon=True).start()
+        self.pushes.put(None)
+
+    def receive(self):
+        '''Метод чтения сообщений сервера до потери соединения или остановки.'''
+        while self.running:
+            try:
+                message = get_message(self.transport, self.decoder)
+            # Таймаут сокета нужен только для проверки флага running
+            except socket.timeout:
+                continue
+            # Проблемы с соединением
+            except (OSError, ValueError, TypeError) as err:
+                LOG.debug(f'Ошибка чтения из сокета.', exc_info=err)
+                return
+            LOG.debug(f'Принято сообщение с сервера: {message}')
+            self.dispatch(message)
+
+    def fail_pending(self):
+        '''Метод завершения ожидающих ответа запросов при потере соединения.'''
+        with self.pending_lock:
+            pending = list(self.pending.values())
+            self.pending.clear()
+        for future in pending:
+            future.set_exception(ConnectionResetError('Потеряно соединение с сервером'))
+
+    def reconnect(self):
+        '''
+        Метод переподключения к серверу с повторной авторизацией.
+        Задержка между попытками растёт экспоненциально до RECONNECT_MAX_DELAY
+        и выбирается случайно, чтобы клиенты не подключались к перезапущенному
+        серверу одновременно. Возвращает False, если транспорт остановлен.
+        '''
+        ip, port = self.server_address
+        delay = RECONNECT_DELAY
+        while self.running:
+            if self.stopped.wait(random.uniform(0, delay)):
+                return False
+            delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            try:
+                self.connection_init(port, ip, attempts=1)
+            except ServerError as err:
+                LOG.info(f'Не удалось переподключиться: {err}')
+                self.fail_pending()
+                continue
+            LOG.info('Соединение с сервером восстановлено.')
+            return True
+        return False
+
+    def resume(self):
+        '''
+        Метод восстановления работы после переподключения: отправка очереди
+        исходящих и обновление списков. Выполняется отдельным потоком,
+        т.к. ждёт ответов, которые читает поток приёма.
+        '''
+        try:
+            self.flush_outbox()
+            self.lists_update()
+        except (OSError, ServerError) as err:
+            LOG.error(f'Не удалось обновить данные после переподключения: {err}')
+            return
+        self.connection_restored.emit()
@@ -0,0 +1,232 @@
+""" Кодеки тела JIM сообщения """
+
+import base64
+import json
+import struct
+
+from common.variables import *
+
+# Теги значений двоичного кодека
+TAG_NONE = 0
+TAG_FALSE = 1
+TAG_TRUE = 2
+TAG_INT = 3
+TAG_FLOAT = 4
+TAG_STR = 5
+TAG_BYTES = 6
+TAG_LIST = 7
+TAG_DICT = 8
+
+# Частые ключи словарей передаются номером (индекс + 1), остальные - строкой
+# после нулевого номера. Список только дополняется в конец: номер ключа -
+# часть протокола.
+KEY_TAGS = (
+    ACTION, TIME, USER, ACCOUNT_NAME, SENDER, DESTINATION, DATA, PUBLIC_KEY,
+    RESPONSE, ERROR, MESSAGE_TEXT, LIST_INFO, MESSAGE, CODECS, CODEC,
+    WORKER, ONLINE, COMPRESSION, REQUEST_ID, VERSION, FULL, USERS, CONTACTS,
+    ADDED, REMOVED, EVENTS, FINGERPRINTS,
+)
+KEY_NUMBERS = {key: number for number, key in enumerate(KEY_TAGS, 1)}
+
+FLOAT = struct.Struct('!d')
+
+
+def _json_default(value):
+    """Байты в JSON передаются строкой base64."""
+    if isinstance(value, (bytes, bytearray)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f'Тип {type(value).__name__} не поддерживается в JIM сообщении')
+
+
+def _write_varint(buffer, number):
+    """Запись неотрицательного целого: по 7 бит в байте, младшие вперёд."""
+    while number > 0x7F:
+        buffer.append(number & 0x7F | 0x80)
+        number >>= 7
+    buffer.append(number)
+
+
+def _read_varint(data, offset):
+    """Чтение целого, записанного _write_varint. Возвращает (число, смещение)."""
+    number = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        number |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return number, offset
+        shift += 7
+
+
+def _write_value(buffer, value):
+    """Запись значения с тегом типа."""
+    if value is None:
+        buffer.append(TAG_NONE)
+    elif value is True:
+        buffer.append(TAG_TRUE)
+    elif value is False:
+        buffer.append(TAG_FALSE)
+    elif isinstance(value, int):
+        buffer.append(TAG_INT)
+        # zigzag: отрицательные числа тоже занимают мало байтов
+        _write_varint(buffer, value << 1 if value >= 0 else (-value << 1) - 1)
+    elif isinstance(value, float):
+        buffer.append(TAG_FLOAT)
+        buffer += FLOAT.pack(value)
+    elif isinstance(value, str):
+        buffer.append(TAG_STR)
+        _write_string(buffer, value)
+    elif isinstance(value, (bytes, bytearray)):
+        buffer.append(TAG_BYTES)
+        _write_varint(buffer, len(value))
+        buffer += value
+    elif isinstance(value, (list, tuple)):
+        buffer.append(TAG_LIST)
+        _write_varint(buffer, len(value))
+        for item in value:
+            _write_value(buffer, item)
+    elif isinstance(value, dict):
+        buffer.append(TAG_DICT)
+        _write_varint(buffer, len(value))
+        for key, item in value.items():
+            _write_key(buffer, key)
+            _write_value(buffer, item)
+    else:
+        raise TypeError(f'Тип {type(value).__name__} не поддерживается в JIM сообщении')
+
+
+def _write_key(buffer, key):
+    """Запись ключа словаря: номером из KEY_TAGS или строкой после нуля."""
+    if not isinstance(key, str):
+        raise TypeError('Ключи JIM сообщения должны быть строками')
+    number = KEY_NUMBERS.get(key)
+    if number is None:
+        buffer.append(0)
+        _write_string(buffer, key)
+    else:
+        _write_varint(buffer, number)
+
+
+def _write_string(buffer, text):
+    """Запись строки UTF-8 с длиной."""
+    data = text.encode(ENCODING)
+    _write_varint(buffer, len(data))
+    buffer += data
+
+
+def _read_bytes(data, offset):
+    """Чтение последовательности байтов с длиной. Возвращает (байты, смещение)."""
+    length, offset = _read_varint(data, offset)
+    end = offset + length
+    if end > len(data):
+        raise ValueError('Неполное двоичное сообщение')
+    return data[offset:end], end
+
+
+def _read_value(data, offset, depth=0):
+    """
+    Чтение значения с тегом типа. Возвращает (значение, смещение).
+    depth - вложенность значения в списки и словари сообщения.
+    """
+    tag = data[offset]
+    offset += 1
+    if tag == TAG_NONE:
+        return None, offset
+    if tag == TAG_FALSE:
+        return False, offset
+    if tag == TAG_TRUE:
+        return True, offset
+    if tag == TAG_INT:
+        number, offset = _read_varint(data, offset)
+        return (number >> 1) ^ -(number & 1), offset
+    if tag == TAG_FLOAT:
+        return FLOAT.unpack_from(data, offset)[0], offset + FLOAT.size
+    if tag == TAG_STR:
+        value, offset = _read_bytes(data, offset)
+        return value.decode(ENCODING), offset
+    if tag == TAG_BYTES:
+        return _read_bytes(data, offset)
+    if tag in (TAG_LIST, TAG_DICT) and depth >= MAX_MESSAGE_DEPTH:
+        raise ValueError('Превышена вложенность двоичного сообщения')
+    if tag == TAG_LIST:
+        length, offset = _read_varint(data, offset)
+        items = []
+        for _ in range(length):
+            item, offset = _read_value(data, offset, depth + 1)
+            items.append(item)
+        return items, offset
+    if tag == TAG_DICT:
+        length, offset = _read_varint(data, offset)
+        items = dict()
+        for _ in range(length):
+            number, offset = _read_varint(data, offset)
+            if number:
+                key = KEY_TAGS[number - 1]
+            else:
+                key, offset = _read_bytes(data, offset)
+                key = key.decode(ENCODING)
+            items[key], offset = _read_value(data, offset, depth + 1)
+        return items, offset
+    raise ValueError(f'Неизвестный тег значения: {tag}')
+
+
+def encode_body(message, codec=CODEC_JSON):
+    """
+    Кодирование словаря в тело сообщения.
+    JSON не поддерживает байты, поэтому они передаются строкой base64,
+    в двоичном кодеке - как есть.
+    """
+    if codec == CODEC_JSON:
+        return json.dumps(message, default=_json_default).encode(ENCODING)
+    if codec == CODEC_BINARY:
+        buffer = bytearray()
+        _write_value(buffer, message)
+        return bytes(buffer)
+    raise ValueError(f'Неизвестный кодек: {codec}')
+
+
+def append_item(body, key, value, codec=CODEC_JSON):
+    """
+    Добавление поля в конец уже закодированного тела сообщения-словаря.
+    Результат совпадает с кодированием словаря, в конец которого добавлено
+    поле, но остальное тело не кодируется заново.
+    """
+    if codec == CODEC_JSON:
+        item = json.dumps({key: value}, default=_json_default).encode(ENCODING)
+        if body == b'{}':
+            return item
+        return body[:-1] + b', ' + item[1:]
+    if codec == CODEC_BINARY:
+        if body[:1] != bytes([TAG_DICT]):
+            raise ValueError('Аргумент функции должен быть словарём.')
+        length, offset = _read_varint(body, 1)
+        buffer = bytearray([TAG_DICT])
+        _write_varint(buffer, length + 1)
+        buffer += body[offset:]
+        _write_key(buffer, key)
+        _write_value(buffer, value)
+        return bytes(buffer)
+    raise ValueError(f'Неизвестный кодек: {codec}')
+
+
+def decode_body(payload, codec=CODEC_JSON):
+    """Преобразование тела сообщения в словарь."""
+    if codec == CODEC_JSON:
+        try:
+            message = json.loads(payload.decode(ENCODING))
+        except RecursionError as err:
+            raise ValueError('Превышена вложенность JSON сообщения') from err
+    elif codec == CODEC_BINARY:
+        try:
+            message, end = _read_value(payload, 0)
+        except (IndexError, struct.error) as err:
+            raise ValueError('Неполное двоичное сообщение') from err
+        except RecursionError as err:
+            raise ValueError('Превышена вложенность двоичного сообщения') from err
+        if end != len(payload):
+            raise ValueError('Лишние данные в двоичном сообщении')
+    else:
+        raise ValueError(f'Неизвестный кодек: {codec}')
+    if not isinstance(message, dict):
+        raise ValueError('Аргумент функции должен быть словарём.')
+    return message
@@ -5,7 +5,6 @@ import logging
 import logs.client_log_config
 import logs.server_log_config
 import sys
-import socket
 
 
 def log(func):
@@ -36,8 +35,8 @@ def log(func):
 def login_required(func):
     """
     Декоратор, проверяющий, что клиент авторизован на сервере.
-    Проверяет, что передаваемый объект сокета находится в
-    списке авторизованных клиентов.
+    Проверяет, что передаваемое подключение (ClientConnection)
+    отмечено как авторизованное.
     За исключением передачи словаря-запроса
     на авторизацию. Если клиент не авторизован,
     генерирует исключение TypeError
@@ -56,20 +55,18 @@ def login_required(func):
         #                    'pubkey': '-----BEGIN PUBLIC KEY-----\nMIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8AMIIBCgKCAQEAmKN/CFSxgU8eu0oO0oKw\n29WTZQSfqw/mJgEtr8nLUAOHGcg3kT7epUgPfwbo/V67sJlGhb/UD7dPK81utWRn\nFKhhUGuo+ad/4HnvbSQjIHy2Wbr85T4gJCL1IqTkodAgSOo4Nuv/Qq9r5po0dNIC\nF4YTZrzfCy6V0v349iXM2CXf+/14fHCxsm3OkNCUwHsOW6nzh5fIyAs1UhssJm/Z\nbCNzX5PkRjI7bwBJhoXHNgS1fDyII6vGrQAyAwxU0hKrBAtAzYIon5ZlIYxyF2/5\nKb8IVmLmnrvCpmtjTQ4u80Dp6YuErMCD82GzgUi50UdQoW617AmFxaKpvO7Lu+aA\nfwIDAQAB\n-----END PUBLIC KEY-----'
         #                    }
         #          },
-        #          <socket.socket fd=25, family=AddressFamily.AF_INET, type=SocketKind.SOCK_STREAM, proto=0, laddr=('127.0.0.1', 7777), raddr=('127.0.0.1', 52416)>
+        #          <ClientConnection - ('127.0.0.1', 52416)>
         # )
         from server.core import MessageProcessor
+        from server.registry import ClientConnection
         from common.variables import ACTION, PRESENCE
         if isinstance(args[0], MessageProcessor):
             found = False
-            for arg in args:
-                if isinstance(arg, socket.socket):
-                    # Проверяем, что данный сокет есть в списке names класса
-                    # MessageProcessor
-                    for client in args[0].names:
-                        # args[0].names = {'test1': <socket.socket fd=25, family=AddressFamily.AF_INET, type=SocketKind.SOCK_STREAM, proto=0, laddr=('127.0.0.1', 7777), raddr=('127.0.0.1', 52420)>}
-                        if args[0].names[client] == arg:
-                            found = True
+            for arg in args[1:]:
+                # Флаг authenticated выставляется реестром подключений
+                # при успешной авторизации, проверка не зависит от числа клиентов.
+                if isinstance(arg, ClientConnection) and arg.authenticated:
+                    found = True
 
             # Теперь надо проверить, что передаваемые аргументы не presence
             # сообщение. Если presence, то разрешаем
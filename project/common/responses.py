@@ -0,0 +1,64 @@
+""" Ответы JIM """
+# Постоянные ответы закодированы заранее (EncodedMessage), ответы
+# с данными каждый раз создаются заново. Словари RESPONSE_* из
+# common.variables - только шаблоны, изменять их нельзя: сервер
+# отправляет ответы из нескольких потоков.
+
+from functools import lru_cache
+
+from common.variables import RESPONSE, ERROR, LIST_INFO, DATA, REQUEST_ID, RESPONSE_200, \
+    VERSION, FULL, USERS, CONTACTS, ADDED, REMOVED
+from common.utils import EncodedMessage
+
+# 200
+OK_200 = EncodedMessage(RESPONSE_200)
+
+
+@lru_cache(maxsize=64)
+def error_400(text):
+    """
+    Ответ 400 с текстом ошибки.
+    Тексты ошибок сервера постоянные, поэтому ответы тоже кэшируются
+    в закодированном виде.
+    """
+    return EncodedMessage({RESPONSE: 400, ERROR: text})
+
+
+def list_202(items):
+    """Ответ 202 со списком (пользователи, контакты)."""
+    return {RESPONSE: 202, LIST_INFO: items}
+
+
+def sync_202(version, full, users, contacts):
+    """
+    Ответ 202 на запрос синхронизации: версия справочника и изменения
+    списков пользователей и контактов - пары (добавленные, удалённые).
+    При full списки добавленных - полные списки.
+    """
+    return {
+        RESPONSE: 202,
+        VERSION: version,
+        FULL: full,
+        USERS: {ADDED: users[0], REMOVED: users[1]},
+        CONTACTS: {ADDED: contacts[0], REMOVED: contacts[1]}
+    }
+
+
+def auth_511(data):
+    """Ответ 511 с данными (строка авторизации или открытый ключ)."""
+    return {RESPONSE: 511, DATA: data}
+
+
+def reply_to(request_id, response):
+    """
+    Ответ на запрос с номером: номер запроса (REQUEST_ID) добавляется
+    в копию ответа. Запросы без номера (старые клиенты) получают ответ как есть.
+    В заранее закодированный ответ номер дописывается к его готовым байтам.
+    """
+    if request_id is None:
+        return response
+    if isinstance(response, EncodedMessage):
+        return response.with_item(REQUEST_ID, request_id)
+    response = dict(response)
+    response[REQUEST_ID] = request_id
+    return response
@@ -0,0 +1,60 @@
+""" Настройка и миграция баз данных SQLite сервера и клиента """
+
+import re
+
+from sqlalchemy import event, inspect
+
+from common.variables import SQLITE_PROFILE
+
+# PRAGMA, которые можно задать в профиле, и допустимый вид значений
+PROFILE_PRAGMAS = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size')
+PRAGMA_VALUE = re.compile(r'^-?\w+$')
+
+
+def check_profile(profile):
+    """
+    Проверка профиля базы данных: словаря {PRAGMA: значение}.
+    Значения попадают в текст запроса, поэтому допускаются только
+    известные PRAGMA и простые значения (слово или целое число).
+    """
+    for name, value in profile.items():
+        if name not in PROFILE_PRAGMAS:
+            raise ValueError(f'Неизвестный параметр профиля базы данных: {name}')
+        if not PRAGMA_VALUE.match(str(value)):
+            raise ValueError(f'Недопустимое значение параметра {name}: {value}')
+    return profile
+
+
+def apply_profile(engine, profile=None):
+    """
+    Установка PRAGMA профиля для каждого нового подключения движка.
+    :param engine: движок SQLAlchemy
+    :param dict profile: профиль, по умолчанию SQLITE_PROFILE
+    """
+    profile = check_profile(SQLITE_PROFILE if profile is None else profile)
+
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in profile.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+
+def create_indexes(engine, indexes):
+    """
+    Миграция: создание отсутствующих индексов в существующей базе.
+    Таблицы и данные не изменяются, повторный запуск ничего не делает.
+    Индексы таблиц, которых в базе ещё нет, пропускаются: такие таблицы
+    вместе с индексами создаст сервер или клиент при запуске.
+    :param engine: движок SQLAlchemy
+    :param indexes: набор (имя индекса, таблица, столбцы)
+    """
+    tables = set(inspect(engine).get_table_names())
+    with engine.begin() as connection:
+        for name, table, columns in indexes:
+            if table not in tables:
+                continue
+            column_list = ', '.join(f'"{column}"' for column in columns)
+            connection.exec_driver_sql(
+                f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({column_list})')
@@ -1,20 +1,372 @@
 """ Утилиты """
 
+import codecs
+import hashlib
 import json
+import re
+import struct
+import zlib
+from collections import deque
 
-from common.variables import MAX_PACKET_LENGTH, ENCODING
+from common.variables import MAX_PACKET_LENGTH, ENCODING, RECV_BUFFER_SIZE, MAX_MESSAGE_LENGTH, \
+    CODEC_JSON, CODEC_BINARY, COMPRESSION_THRESHOLD, COMPRESSION_LEVEL
 from common.decorators import log
+from common.codec import encode_body, decode_body, append_item
+
+# Заголовок кадра: 4 байта в сетевом порядке. Младшие 3 байта - длина тела
+# сообщения, старший байт - флаги кадра.
+FRAME_HEADER = struct.Struct('!I')
+FRAME_LENGTH_MASK = 0xFFFFFF
+# Тело кадра закодировано двоичным кодеком (иначе - JSON)
+FRAME_FLAG_BINARY = 0x01000000
+# Тело кадра сжато потоком zlib соединения
+FRAME_FLAG_COMPRESSED = 0x02000000
+FRAME_FLAGS = FRAME_FLAG_BINARY | FRAME_FLAG_COMPRESSED
+# Символы, с которых может начинаться сообщение в старом (некадрированном) режиме
+LEGACY_START = b'{ \t\r\n'
+# Поиск границ JSON объекта в старом режиме: пробелы между объектами,
+# скобки и кавычки вне строк, кавычки и экранирование внутри строк
+_LEGACY_SPACE = re.compile(r'\s*')
+_LEGACY_TOKEN = re.compile(r'[{}\[\]"]')
+_LEGACY_STRING = re.compile(r'["\\]')
+
+
+class MessageDecoder:
+    """
+    Инкрементальный декодер потока JIM сообщений одного соединения.
+    Принимает произвольные куски байтов из сокета и складывает полностью
+    принятые словари в очередь messages. Режим передачи определяется по
+    первому байту потока: '{' - старый режим (JSON без разделителей),
+    иначе - кадры с заголовком длины. Кодек тела каждого кадра указан
+    в его флагах, поэтому кадры JSON и двоичные могут чередоваться.
+    Сжатые кадры распаковываются общим для соединения потоком zlib
+    (см. FrameCompressor).
+    """
+
+    def __init__(self):
+        # Режим соединения: None - ещё не определён, True - кадры, False - старый
+        self.framed = None
+        # Полностью принятые, но ещё не обработанные сообщения
+        self.messages = deque()
+        self._buffer = bytearray()
+        self._text_decoder = codecs.getincrementaldecoder(ENCODING)()
+        # Старый режим: куски недочитанного объекта, их общая длина и
+        # состояние поиска его конца (глубина скобок, внутри строки,
+        # после обратной косой черты)
+        self._chunks = []
+        self._pending = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        # Поток распаковки создаётся при первом сжатом кадре
+        self._decompressor = None
+
+    def feed(self, data):
+        """
+        Добавление очередного куска данных из сокета.
+        Все сообщения, которые удалось собрать, попадают в очередь messages,
+        неполный хвост остаётся в буфере до следующего вызова.
+        :param bytes data: данные, прочитанные из сокета
+        """
+        if not isinstance(data, (bytes, bytearray)):
+            raise ValueError('Получили НЕ байтовые данные')
+        if self.framed is None and data:
+            self.framed = data[:1] not in LEGACY_START
+        if self.framed:
+            self._feed_frames(data)
+        else:
+            self._feed_legacy(data)
+
+    def _feed_frames(self, data):
+        """Разбор потока кадров с заголовком длины."""
+        buffer = self._buffer
+        buffer += data
+        offset = 0
+        while len(buffer) - offset >= FRAME_HEADER.size:
+            header, = FRAME_HEADER.unpack_from(buffer, offset)
+            if header & ~(FRAME_LENGTH_MASK | FRAME_FLAGS):
+                raise ValueError('Неизвестные флаги кадра')
+            # Длина проверяется по заголовку, до приёма тела кадра
+            length = header & FRAME_LENGTH_MASK
+            if length > MAX_MESSAGE_LENGTH:
+                raise ValueError('Превышена максимальная длина сообщения')
+            end = offset + FRAME_HEADER.size + length
+            if end > len(buffer):
+                break
+            payload = bytes(buffer[offset + FRAME_HEADER.size:end])
+            if header & FRAME_FLAG_COMPRESSED:
+                payload = self._decompress(payload)
+            self.messages.append(decode_body(
+                payload, CODEC_BINARY if header & FRAME_FLAG_BINARY else CODEC_JSON))
+            offset = end
+        del buffer[:offset]
+
+    def _decompress(self, payload):
+        """Распаковка тела сжатого кадра с ограничением длины результата."""
+        if self._decompressor is None:
+            self._decompressor = zlib.decompressobj()
+        try:
+            payload = self._decompressor.decompress(payload, MAX_MESSAGE_LENGTH + 1)
+        except zlib.error as err:
+            raise ValueError('Повреждён сжатый кадр') from err
+        if len(payload) > MAX_MESSAGE_LENGTH or self._decompressor.unconsumed_tail:
+            raise ValueError('Превышена максимальная длина сообщения')
+        return payload
+
+    def _feed_legacy(self, data):
+        """
+        Разбор потока идущих подряд JSON объектов без разделителей.
+        Каждый кусок просматривается один раз: поиск конца объекта
+        продолжается с места, где остановился на прошлом куске, а JSON
+        разбирается, только когда объект закрыт.
+        """
+        text = self._text_decoder.decode(bytes(data))
+        length = len(text)
+        # Начало недочитанного объекта в куске и позиция поиска
+        start = position = 0
+        if self._escaped and length:
+            self._escaped = False
+            position = 1
+        while position < length:
+            if not self._depth:
+                # Между объектами допустимы только пробельные символы
+                position = _LEGACY_SPACE.match(text, position).end()
+                if position == length:
+                    break
+                if text[position] != '{':
+                    raise ValueError('Аргумент функции должен быть словарём.')
+                start = position
+                position += 1
+                self._depth = 1
+            elif self._in_string:
+                match = _LEGACY_STRING.search(text, position)
+                if match is None:
+                    break
+                position = match.end()
+                if match.group() == '"':
+                    self._in_string = False
+                elif position == length:
+                    # Экранированный символ придёт в следующем куске
+                    self._escaped = True
+                else:
+                    position += 1
+            else:
+                match = _LEGACY_TOKEN.search(text, position)
+                if match is None:
+                    break
+                position = match.end()
+                char = match.group()
+                if char == '"':
+                    self._in_string = True
+                elif char in '{[':
+                    self._depth += 1
+                else:
+                    self._depth -= 1
+                    if not self._depth:
+                        self._legacy_message(text[start:position])
+                        start = position
+        if self._depth:
+            self._pending += length - start
+            if self._pending > MAX_MESSAGE_LENGTH:
+                raise ValueError('Превышена максимальная длина сообщения')
+            self._chunks.append(text[start:])
+
+    def _legacy_message(self, tail):
+        """Разбор закрытого JSON объекта из накопленных кусков и его окончания tail."""
+        if self._pending + len(tail) > MAX_MESSAGE_LENGTH:
+            raise ValueError('Превышена максимальная длина сообщения')
+        self._chunks.append(tail)
+        text = ''.join(self._chunks)
+        self._chunks = []
+        self._pending = 0
+        try:
+            message = json.loads(text)
+        except RecursionError as err:
+            raise ValueError('Превышена вложенность JSON сообщения') from err
+        self.messages.append(message)
+
+
+class FrameCompressor:
+    """
+    Сжатие исходящих кадров одного соединения.
+    Все сжатые кадры соединения - части одного потока zlib: каждый кадр
+    завершается Z_SYNC_FLUSH и распаковывается сразу, а повторяющиеся
+    между сообщениями данные (списки пользователей, ключи) сжимаются
+    по словарю предыдущих кадров. Поэтому кадры должны сжиматься в порядке
+    отправки. Короткие кадры (меньше threshold) передаются без сжатия.
+    Если сжатый кадр не будет отправлен (очередь соединения его отбросила),
+    поток нужно сбросить (reset): следующие кадры не должны ссылаться
+    на данные, которых у получателя нет.
+    """
+    __slots__ = ('threshold', '_compressor')
+
+    def __init__(self, threshold=COMPRESSION_THRESHOLD, level=COMPRESSION_LEVEL):
+        self.threshold = threshold
+        self._compressor = zlib.compressobj(level)
+
+    def compress(self, frame):
+        """Сжатие готового кадра, если тело не короче порога."""
+        header, = FRAME_HEADER.unpack_from(frame)
+        if (header & FRAME_LENGTH_MASK) < self.threshold:
+            return frame
+        body = self._compressor.compress(frame[FRAME_HEADER.size:])
+        body += self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        # Несжимаемые данные отправляются как есть: сжатое тело не должно
+        # быть длиннее исходного и не должно выйти за поле длины кадра
+        if len(body) >= len(frame) - FRAME_HEADER.size or len(body) > FRAME_LENGTH_MASK:
+            self.reset()
+            return frame
+        flags = header & ~FRAME_LENGTH_MASK | FRAME_FLAG_COMPRESSED
+        return FRAME_HEADER.pack(flags | len(body)) + body
+
+    def reset(self):
+        """
+        Сброс словаря потока после кадра, который не дойдёт до получателя.
+        Кадры завершаются на границе блока, поэтому пропуск кадра
+        и пустого блока Z_FULL_FLUSH не нарушает распаковку, а следующие
+        кадры сжимаются без ссылок на предыдущие данные.
+        """
+        self._compressor.flush(zlib.Z_FULL_FLUSH)
+
+
+class EncodedMessage:
+    """
+    Неизменяемое JIM сообщение с кэшем закодированных байтов.
+    Используется для постоянных ответов сервера: сообщение кодируется
+    один раз для каждого режима передачи и кодека, а не при каждой отправке.
+    Поддерживает чтение как словарь (message[RESPONSE], key in message).
+    """
+    __slots__ = ('_message', '_encoded', '_base')
+
+    def __init__(self, message):
+        if not isinstance(message, dict):
+            raise TypeError('Аргумент функции должен быть словарём.')
+        # Копия через JSON: вложенные объекты тоже не связаны с исходным словарём
+        self._message = json.loads(json.dumps(message))
+        self._encoded = dict()
+        # Сообщение, байты которого дополняются полем (with_item)
+        self._base = None
+
+    def __getitem__(self, key):
+        return self._message[key]
+
+    def __contains__(self, key):
+        return key in self._message
+
+    def __eq__(self, other):
+        if isinstance(other, EncodedMessage):
+            other = other._message
+        return self._message == other
+
+    def __hash__(self):
+        return hash(json.dumps(self._message, sort_keys=True))
+
+    def __repr__(self):
+        return repr(self._message)
+
+    def get(self, key, default=None):
+        return self._message.get(key, default)
+
+    def to_dict(self):
+        """Изменяемая копия сообщения."""
+        return json.loads(json.dumps(self._message))
+
+    def with_item(self, key, value):
+        """
+        Сообщение с дополнительным полем key (например, номером запроса).
+        Его байты строятся из закодированных байтов этого сообщения:
+        поле дописывается в конец, остальное тело не кодируется заново.
+        """
+        message = EncodedMessage.__new__(EncodedMessage)
+        # Значения общие с этим сообщением: оба неизменяемые
+        message._message = dict(self._message)
+        message._message[key] = value
+        message._encoded = dict()
+        message._base = (self, key, value)
+        return message
+
+    def encode(self, framed=False, codec=CODEC_JSON):
+        """Байты сообщения для указанного режима передачи и кодека."""
+        data = self._encoded.get((framed, codec))
+        if data is None:
+            if self._base is None:
+                data = encode_message(self._message, framed, codec)
+            else:
+                base, key, value = self._base
+                data = base.encode(framed, codec)
+                if framed:
+                    data = data[FRAME_HEADER.size:]
+                data = append_item(data, key, value, codec)
+                if framed:
+                    data = _frame(data, codec)
+            self._encoded[framed, codec] = data
+        return data
+
+
+def key_fingerprint(pubkey):
+    """Отпечаток открытого ключа: SHA-256 его текста, шестнадцатеричной строкой."""
+    return hashlib.sha256(pubkey.encode(ENCODING)).hexdigest()
+
+
+def encode_message(message, framed=False, codec=CODEC_JSON, compressor=None):
+    """
+    Кодирование словаря с JIM сообщением в байты для отправки.
+    В кадрированном режиме перед телом добавляется заголовок длины
+    с флагом кодека. Двоичный кодек и сжатие возможны только
+    в кадрированном режиме.
+    Для EncodedMessage используются заранее закодированные байты.
+    :param dict message: сообщение (словарь или EncodedMessage)
+    :param bool framed: использовать ли кадрированный режим
+    :param str codec: кодек тела сообщения (CODEC_JSON, CODEC_BINARY)
+    :param FrameCompressor compressor: сжатие кадров соединения
+    :return bytes:
+    """
+    if compressor is not None:
+        if not framed:
+            raise ValueError('Сжатие требует кадрированного режима')
+        return compressor.compress(encode_message(message, framed, codec))
+    if isinstance(message, EncodedMessage):
+        return message.encode(framed, codec)
+    if not isinstance(message, dict):
+        raise TypeError('Аргумент функции должен быть словарём.')
+
+    if not framed:
+        if codec != CODEC_JSON:
+            raise ValueError('Двоичный кодек требует кадрированного режима')
+        return encode_body(message)
+    return _frame(encode_body(message, codec), codec)
+
+
+def _frame(message_bytes, codec):
+    """Кадр из тела сообщения: заголовок с длиной и флагом кодека."""
+    if len(message_bytes) > MAX_MESSAGE_LENGTH:
+        raise ValueError('Превышена максимальная длина сообщения')
+    flags = FRAME_FLAG_BINARY if codec == CODEC_BINARY else 0
+    return FRAME_HEADER.pack(flags | len(message_bytes)) + message_bytes
+
 
 @log
-def get_message(client):
+def get_message(client, decoder=None):
     """
     Приём сообщения.
     Принимает объект сокета и достает из него байтовое сообщение.
     Возвращает словарь либо ошибку ValueError.
+    Если передан декодер соединения (MessageDecoder), чтение идёт до получения
+    целого сообщения, а сообщения, пришедшие в том же пакете, остаются
+    в очереди декодера до следующего вызова.
     :param client: объект сокета
+    :param MessageDecoder decoder: декодер потока соединения
     :return dict:
     """
 
+    if decoder is not None:
+        while not decoder.messages:
+            data_bytes = client.recv(RECV_BUFFER_SIZE)
+            if not data_bytes:
+                raise TypeError('Получено пустое сообщение')
+            decoder.feed(data_bytes)
+        return decoder.messages.popleft()
+
     data_bytes = client.recv(MAX_PACKET_LENGTH)
     if not isinstance(data_bytes, bytes):
         raise ValueError('Получили НЕ байтовые данные')
@@ -34,17 +386,21 @@ def get_message(client):
 
 
 @log
-def send_message(sock, message):
+def send_message(sock, message, framed=False, codec=CODEC_JSON, compressor=None):
     """
     Передача сообщения.
     Принимает объект сокета и словарь с JIM сообщением, социализирует в json, кодирует в байты и отправляет в сокет.
+    В кадрированном режиме сообщение отправляется целиком (sendall) с заголовком длины.
     :param sock:
     :param dict message:
+    :param bool framed: использовать ли кадрированный режим
+    :param str codec: кодек тела сообщения
+    :param FrameCompressor compressor: сжатие кадров соединения
     :return:
     """
 
-    if not isinstance(message, dict):
-        raise TypeError('Аргумент функции должен быть словарём.')
-
-    message_bytes = json.dumps(message).encode(ENCODING)
-    sock.send(message_bytes)
+    message_bytes = encode_message(message, framed, codec, compressor)
+    if framed:
+        sock.sendall(message_bytes)
+    else:
+        sock.send(message_bytes)
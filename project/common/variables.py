@@ -5,10 +5,67 @@ import logging
 # сокет
 DEFAULT_PORT = 7777
 DEFAULT_IP_ADDRESS = '127.0.0.1'
-MAX_CONNECTIONS = 5
+MAX_CONNECTIONS = 128
 MAX_PACKET_LENGTH = 1024
 ENCODING = 'utf-8'
 CONNECTION_TIMEOUT = 0.5
+# Время ожидания клиентом ответа сервера на запрос, секунд
+REPLY_TIMEOUT = 5
+# Переподключение клиента: начальная и наибольшая задержка между попытками,
+# секунд. Задержка удваивается, фактическая - случайная в [0, задержка].
+RECONNECT_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30
+# Размер буфера одного чтения из сокета в потоковом режиме
+RECV_BUFFER_SIZE = 65536
+# Максимальная длина одного сообщения в кадрированном режиме (3 байта длины)
+MAX_MESSAGE_LENGTH = 0xFFFFFF
+# Наибольшая вложенность списков и словарей в теле сообщения
+MAX_MESSAGE_DEPTH = 32
+# Сжатие кадров соединения (zlib): сжимаются тела длиннее порога, байт
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_LEVEL = 6
+# Время на ответ клиента на запрос авторизации 511, секунд
+AUTH_TIMEOUT = 5
+# Очередь исходящих данных клиента на сервере: верхняя и нижняя границы
+# в байтах и политика для отстающих клиентов (drop, disconnect, spill)
+OUTBOUND_HIGH_WATERMARK = 1024 * 1024
+OUTBOUND_LOW_WATERMARK = 256 * 1024
+OUTBOUND_POLICY = 'disconnect'
+# Счётчики статистики сообщений на сервере копятся в памяти и записываются
+# в базу после указанного числа сообщений или по истечении интервала, секунд
+COUNTERS_FLUSH_COUNT = 100
+COUNTERS_FLUSH_INTERVAL = 5
+# Наибольшее число изменений базы сервера, применяемых одной транзакцией
+WRITE_BATCH_SIZE = 256
+# Уведомления о присутствии копятся на сервере указанное время, секунд,
+# и отправляются клиенту одним сообщением
+PRESENCE_EVENTS_DELAY = 0.2
+# Число сообщений истории переписки, загружаемых клиентом за один раз
+HISTORY_PAGE_SIZE = 20
+# Наибольшее число входящих сообщений, расшифровываемых и сохраняемых
+# клиентом одной группой
+RECEIVE_BATCH_SIZE = 64
+# Сеансовые ключи шифрования сообщений клиента: смена ключа после
+# указанного числа сообщений или времени, секунд, и число ключей
+# принятых сеансов, хранимых в памяти
+SESSION_KEY_MESSAGES = 1000
+SESSION_KEY_LIFETIME = 60 * 60
+SESSION_KEY_CACHE = 256
+# Почтовый ящик сервера для сообщений пользователям не в сети: срок
+# хранения сообщения, секунд, и ограничения на одного получателя -
+# число сообщений и их общий объём в байтах
+MAILBOX_TTL = 7 * 24 * 60 * 60
+MAILBOX_QUOTA = 1000
+MAILBOX_MAX_BYTES = 4 * 1024 * 1024
+# Профиль баз данных SQLite сервера и клиента (значения PRAGMA):
+# журнал WAL, synchronous=NORMAL (в режиме WAL без потери целостности),
+# кэш 16 Мб (отрицательное значение - в килобайтах) и отображение в память
+SQLITE_PROFILE = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 268435456,
+}
 # Текущий уровень логирования
 LOGGING_LEVEL = logging.DEBUG
 # Конфигурационный файл сервера:
@@ -36,9 +93,49 @@ ADD_CONTACT = 'add'
 LIST_INFO = 'data_list'
 USERS_REQUEST = 'get_users'
 PUBLIC_KEY_REQUEST = 'pubkey_need'
+# Синхронизация списков пользователей и контактов: клиент передаёт версию
+# справочника, которая у него есть (VERSION), сервер отвечает изменениями
+# после неё (ADDED, REMOVED) или полными списками (FULL)
+SYNC_REQUEST = 'sync'
+VERSION = 'version'
+FULL = 'full'
+USERS = 'users'
+CONTACTS = 'contacts'
+ADDED = 'added'
+REMOVED = 'removed'
+# Уведомления о присутствии: список событий [имя, событие] получают только
+# клиенты, у которых пользователь в контактах
+NOTIFY = 'notify'
+EVENTS = 'events'
+EVENT_ONLINE = 'online'
+EVENT_OFFLINE = 'offline'
+EVENT_USER_REMOVED = 'user_removed'
+# К событиям входа прилагаются отпечатки открытых ключей пользователей
+# {имя: отпечаток}: клиент запрашивает ключ заново, только если он изменился
+FINGERPRINTS = 'fingerprints'
+# Необязательный номер запроса клиента, сервер возвращает его в ответе
+REQUEST_ID = 'id'
 
+# Шина маршрутизации между рабочими процессами сервера
+BUS_HELLO = 'bus_hello'
+BUS_PRESENCE = 'bus_presence'
+BUS_ROUTE = 'bus_route'
+WORKER = 'worker'
+ONLINE = 'online'
 
-# Словари - ответы:
+# Кодеки тела сообщения: клиент перечисляет поддерживаемые в presence (CODECS),
+# сервер сообщает выбранный в ответе 511 (CODEC)
+CODECS = 'codecs'
+CODEC = 'codec'
+CODEC_JSON = 'json'
+CODEC_BINARY = 'bin1'
+# Сжатие: клиент перечисляет поддерживаемые способы в presence,
+# сервер сообщает выбранный в ответе 511 (None - без сжатия)
+COMPRESSION = 'compression'
+COMPRESSION_ZLIB = 'zlib'
+
+
+# Словари - ответы (шаблоны, не изменять: готовые ответы в common.responses):
 # 200
 RESPONSE_200 = {RESPONSE: 200}
 # 202
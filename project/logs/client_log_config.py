@@ -12,8 +12,10 @@ log = logging.getLogger('app.client')
 _formatter = logging.Formatter("%(asctime)s  %(levelname)-8s  %(module)-10s  %(message)s")
 _formatter_stream = logging.Formatter("%(levelname)-8s  %(message)s ")
 
-# Создаём файловый обработчик логирования (можно задать кодировку):
-PATH = os.path.dirname(os.path.abspath(__file__))
+# Создаём файловый обработчик логирования (можно задать кодировку).
+# Каталог логов можно переопределить переменной окружения MESSENGER_LOG_DIR
+# (например, тесты пишут логи во временный каталог):
+PATH = os.environ.get('MESSENGER_LOG_DIR') or os.path.dirname(os.path.abspath(__file__))
 PATH = os.path.join(PATH, 'client.log')
 fh = logging.FileHandler(PATH, encoding='utf-8')
 # fh.setLevel(logging.DEBUG)
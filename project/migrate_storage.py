@@ -0,0 +1,48 @@
+""" Миграция баз данных сервера и клиента """
+# Включает профиль SQLite (WAL и прочие PRAGMA) и создаёт недостающие
+# индексы в существующих файлах баз без изменения данных. Сервер и клиент
+# выполняют ту же миграцию при запуске, скрипт нужен для обновления баз
+# заранее.
+# migrate_storage.py [файл.db3 ...]
+# Без параметров обрабатываются server_database.db3 и client/client_*.db3
+
+import glob
+import os
+import sys
+
+from sqlalchemy import create_engine, inspect
+
+from common.storage import apply_profile, create_indexes
+from server.database import INDEXES as SERVER_INDEXES
+from client.database import INDEXES as CLIENT_INDEXES
+
+
+def migrate(path):
+    """Миграция одного файла базы, тип базы определяется по таблицам."""
+    engine = create_engine(f'sqlite:///{path}')
+    apply_profile(engine)
+    tables = inspect(engine).get_table_names()
+    if 'Users' in tables:
+        create_indexes(engine, SERVER_INDEXES)
+        print(f'{path}: база сервера обновлена')
+    elif 'message_history' in tables:
+        create_indexes(engine, CLIENT_INDEXES)
+        print(f'{path}: база клиента обновлена')
+    else:
+        print(f'{path}: неизвестная база, пропущена')
+    engine.dispose()
+
+
+def main():
+    '''Основная функция'''
+    dir_path = os.path.dirname(os.path.realpath(__file__))
+    paths = sys.argv[1:] or \
+        [os.path.join(dir_path, 'server_database.db3')] + \
+        sorted(glob.glob(os.path.join(dir_path, 'client', 'client_*.db3')))
+    for path in paths:
+        if os.path.exists(path):
+            migrate(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,8 @@ from common.decorators import log
 import logging
 import logs.server_log_config
 from server.core import MessageProcessor
+from server.async_core import AsyncMessageProcessor
+from server.cluster import WorkerPool
 from server.database import ServerStorage
 from server.main_window import MainWindow
 from PyQt5.QtWidgets import QApplication
@@ -23,7 +25,8 @@ LOG = logging.getLogger('app.server')
 def arg_parser(default_port, default_address):
     """
     Разбор параметров командной строки.
-    server.py -p 8888 -a 127.0.0.1
+    server.py -p 8888 -a 127.0.0.1 --engine asyncio
+    server.py --workers 4
     """
     LOG.debug(
         f'Инициализация парсера аргументов командной строки: {sys.argv}')
@@ -32,12 +35,23 @@ def arg_parser(default_port, default_address):
                         help=f'Server port 1024-65535. Default {default_port}')
     parser.add_argument('-a', default=default_address, nargs='?', help=f'Server address. Default - all net interfaces')
     parser.add_argument('--no_gui', action='store_true')
+    parser.add_argument('--engine', default='thread', choices=('thread', 'asyncio'),
+                        help='Server engine: thread (selectors loop) or asyncio. Default thread')
+    parser.add_argument('--workers', default=1, type=int,
+                        help='Number of server processes sharing the port (SO_REUSEPORT), '
+                             'runs without GUI. Default 1')
     namespace = parser.parse_args(sys.argv[1:])
+    if namespace.workers < 1:
+        parser.error('--workers must be positive')
+    if namespace.workers > 1 and namespace.engine != 'thread':
+        parser.error('--workers is supported only by the thread engine')
     listen_address = namespace.a
     listen_port = namespace.p
     gui_flag = namespace.no_gui
+    engine = namespace.engine
+    workers = namespace.workers
     LOG.debug('Аргументы успешно загружены.')
-    return listen_address, listen_port, gui_flag
+    return listen_address, listen_port, gui_flag, engine, workers
 
 
 @log
@@ -56,6 +70,16 @@ def config_load():
         config.set('SETTINGS', 'Listen_Address', '')
         config.set('SETTINGS', 'Database_path', '')
         config.set('SETTINGS', 'Database_file', 'server_database.db3')
+        config.set('SETTINGS', 'Outbound_high_watermark', str(OUTBOUND_HIGH_WATERMARK))
+        config.set('SETTINGS', 'Outbound_low_watermark', str(OUTBOUND_LOW_WATERMARK))
+        config.set('SETTINGS', 'Outbound_policy', OUTBOUND_POLICY)
+        config.set('SETTINGS', 'Counters_flush_count', str(COUNTERS_FLUSH_COUNT))
+        config.set('SETTINGS', 'Counters_flush_interval', str(COUNTERS_FLUSH_INTERVAL))
+        config.set('SETTINGS', 'Mailbox_ttl', str(MAILBOX_TTL))
+        config.set('SETTINGS', 'Mailbox_quota', str(MAILBOX_QUOTA))
+        config.set('SETTINGS', 'Mailbox_max_bytes', str(MAILBOX_MAX_BYTES))
+        for name, value in SQLITE_PROFILE.items():
+            config.set('SETTINGS', f'Sqlite_{name}', str(value))
         return config
 
 
@@ -67,17 +91,60 @@ def main():
 
     # Загрузка параметров командной строки, если нет параметров, то задаём
     # значения по умоланию.
-    listen_address, listen_port, gui_flag = arg_parser(
+    listen_address, listen_port, gui_flag, engine, workers = arg_parser(
         config['SETTINGS']['Default_port'], config['SETTINGS']['Listen_Address'])
 
     # Инициализация базы данных
-    database = ServerStorage(
-        os.path.join(
-            config['SETTINGS']['Database_path'],
-            config['SETTINGS']['Database_file']))
+    database_path = os.path.join(
+        config['SETTINGS']['Database_path'],
+        config['SETTINGS']['Database_file'])
+    # Параметры отложенной записи статистики сообщений, почтового ящика
+    # и профиль базы
+    database_settings = dict(
+        counters_flush_count=config.getint(
+            'SETTINGS', 'Counters_flush_count', fallback=COUNTERS_FLUSH_COUNT),
+        counters_flush_interval=config.getfloat(
+            'SETTINGS', 'Counters_flush_interval', fallback=COUNTERS_FLUSH_INTERVAL),
+        mailbox_ttl=config.getfloat('SETTINGS', 'Mailbox_ttl', fallback=MAILBOX_TTL),
+        mailbox_quota=config.getint('SETTINGS', 'Mailbox_quota', fallback=MAILBOX_QUOTA),
+        mailbox_max_bytes=config.getint(
+            'SETTINGS', 'Mailbox_max_bytes', fallback=MAILBOX_MAX_BYTES),
+        # Профиль SQLite: параметры Sqlite_<pragma> конфигурационного файла
+        storage_profile={
+            name: config.get('SETTINGS', f'Sqlite_{name}', fallback=str(value))
+            for name, value in SQLITE_PROFILE.items()})
+    database = ServerStorage(database_path, **database_settings)
+
+    # Параметры очереди исходящих данных клиентов
+    outbound_settings = dict(
+        high_watermark=config.getint(
+            'SETTINGS', 'Outbound_high_watermark', fallback=OUTBOUND_HIGH_WATERMARK),
+        low_watermark=config.getint(
+            'SETTINGS', 'Outbound_low_watermark', fallback=OUTBOUND_LOW_WATERMARK),
+        overflow_policy=config.get(
+            'SETTINGS', 'Outbound_policy', fallback=OUTBOUND_POLICY))
+
+    # Несколько рабочих процессов: каждый со своим MessageProcessor и
+    # подключением к базе, управление только из консоли.
+    if workers > 1:
+        pool = WorkerPool(workers, listen_address, listen_port,
+                          database_path, database_settings, outbound_settings)
+        pool.start()
+        while True:
+            command = input('Введите exit для завершения работы сервера.')
+            if command == 'exit':
+                pool.stop()
+                break
+        database.close()
+        return
 
     # Создание экземпляра класса - сервера и его запуск:
-    server = MessageProcessor(listen_address, listen_port, database)
+    if engine == 'asyncio':
+        server = AsyncMessageProcessor(
+            listen_address, listen_port, database, **outbound_settings)
+    else:
+        server = MessageProcessor(
+            listen_address, listen_port, database, **outbound_settings)
     server.daemon = True
     server.start()
 
@@ -102,8 +169,13 @@ def main():
         # Запускаем GUI
         server_app.exec_()
 
-        # По закрытию окон останавливаем обработчик сообщений
+        # По закрытию окон останавливаем обработчик сообщений и ждём
+        # его завершения, чтобы он успел сохранить статистику.
         server.running = False
+        server.join()
+
+    # Дожидаемся записи всех изменений в базу
+    database.close()
 
 
 if __name__ == '__main__':
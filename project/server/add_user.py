@@ -80,11 +80,11 @@ class RegisterUser(QDialog):
                 'sha512', passwd_bytes, salt, 10000)
             self.database.add_user(
                 self.client_name.text(),
-                binascii.hexlify(passwd_hash))
+                binascii.hexlify(passwd_hash)).result()
+            # Клиентов не уведомляем: нового пользователя нет ни в чьих
+            # контактах, списки пользователей клиенты получают синхронизацией
             self.messages.information(
                 self, 'Успех', 'Пользователь успешно зарегистрирован.')
-            # Рассылаем клиентам сообщение о необходимости обновить справочники
-            self.server.service_update_lists()
             self.close()
 
 
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import sys
+sys.path.append('../')
+from common.variables import *
+from common.utils import MessageDecoder
+from server.core import MessageProcessor
+from server.outbound import OutboundQueue
+from server.registry import ClientConnection
+
+# Подключение логирования
+LOG = logging.getLogger('app.server')
+
+
+class AsyncMessageProcessor(MessageProcessor):
+    """
+    Версия сервера на asyncio. Протокол и обработка сообщений те же,
+    что и в MessageProcessor, но каждое соединение обслуживается
+    отдельной сопрограммой поверх asyncio streams, а не общим циклом select.
+    Подключения хранятся в том же реестре ClientConnection, что и в
+    MessageProcessor, сокетом подключения является StreamWriter соединения.
+    Цикл событий работает в отдельном потоке, поэтому вызовы из GUI
+    передаются в него через call_soon_threadsafe, пара сокетов и селектор
+    MessageProcessor этому движку не нужны и не создаются.
+    При остановке сервера сопрограммы подключений отменяются и
+    дожидаются до закрытия цикла событий.
+    Исходящие данные проходят через ту же очередь OutboundQueue, что и в
+    MessageProcessor: в буфер транспорта данные передаются, пока он меньше
+    нижней границы, остальное ждёт освобождения буфера (drain).
+    """
+
+    def __init__(self, *args, **kwargs):
+        # Цикл событий, создаётся при запуске потока
+        self.loop = None
+        # Клиенты, для которых запущено ожидание освобождения буфера
+        self.draining = set()
+        # Задачи обслуживания подключений и ожидания освобождения буфера
+        self.tasks = set()
+        super().__init__(*args, **kwargs)
+        if self.bus:
+            raise ValueError('Шина рабочих процессов поддерживается только движком thread.')
+
+    def run(self):
+        '''Метод основной цикл потока.'''
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.serve())
+        finally:
+            self.loop.close()
+
+    async def serve(self):
+        '''Сопрограмма запуска сервера и ожидания его остановки.'''
+        # Инициализация Сокета
+        self.init_socket()
+        server = await asyncio.start_server(
+            self.handle_client, sock=self.sock, backlog=MAX_CONNECTIONS)
+        # Флаг running выставляется из другого потока, проверяем его
+        # периодически.
+        while self.running:
+            await asyncio.sleep(CONNECTION_TIMEOUT)
+            self.check_auth_deadlines()
+            self.database.flush_counters()
+        server.close()
+        for client in self.clients:
+            self.remove_client(client)
+        # Оставшиеся задачи отменяются и дожидаются, иначе закрытие цикла
+        # событий уничтожит их незавершёнными
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await server.wait_closed()
+        # Незаписанная статистика сохраняется при остановке сервера
+        self.database.flush_counters(force=True)
+
+    async def handle_client(self, reader, writer):
+        '''Сопрограмма обслуживания одного подключения.'''
+        task = asyncio.current_task()
+        self.tasks.add(task)
+        try:
+            await self.serve_client(reader, writer)
+        finally:
+            self.tasks.discard(task)
+
+    async def serve_client(self, reader, writer):
+        '''Сопрограмма приёма и обработки сообщений подключения.'''
+        address = writer.get_extra_info('peername')
+        LOG.info(f'Установлено соедение с ПК {address}')
+        # Транспорт приостанавливает запись, как только его буфер превысит
+        # нижнюю границу очереди, дальше данные копятся в OutboundQueue.
+        writer.transport.set_write_buffer_limits(high=self.low_watermark)
+        client = ClientConnection(
+            writer, address, MessageDecoder(),
+            OutboundQueue(self.high_watermark, self.low_watermark, self.overflow_policy))
+        self.clients.add(client)
+        decoder = client.decoder
+        try:
+            while client in self.clients:
+                data = await reader.read(RECV_BUFFER_SIZE)
+                if not data:
+                    raise TypeError('Получено пустое сообщение')
+                decoder.feed(data)
+                # Клиент может быть отключён в процессе обработки (например, exit)
+                while decoder.messages and client in self.clients:
+                    self.dispatch_message(decoder.messages.popleft(), client)
+        except (OSError, ValueError, TypeError) as err:
+            LOG.debug(f'Getting data from client exception.', exc_info=err)
+        finally:
+            # Клиент удаляется при любом завершении сопрограммы, в том числе
+            # по непредвиденной ошибке обработки или отмене задачи
+            self.remove_client(client)
+
+    def send_to_client(self, client, message):
+        '''Метод постановки сообщения в очередь клиента и её отправки.'''
+        if client.sock.is_closing():
+            raise ConnectionResetError('Соединение с клиентом закрыто')
+        super().send_to_client(client, message)
+
+    def flush_client(self, client):
+        '''Метод передачи данных из очереди клиента в буфер транспорта.'''
+        queue = client.outbound
+        transport = client.sock.transport
+        while queue and transport.get_write_buffer_size() <= self.low_watermark:
+            chunk = queue.peek()
+            client.sock.write(bytes(chunk))
+            queue.consume(len(chunk))
+        if queue and client not in self.draining:
+            self.draining.add(client)
+            task = self.loop.create_task(self.drain_client(client))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def drain_client(self, client):
+        '''Сопрограмма ожидания освобождения буфера транспорта.'''
+        try:
+            await client.sock.drain()
+            self.draining.discard(client)
+            if client in self.clients:
+                self.flush_client(client)
+        except OSError as err:
+            LOG.debug(f'Sending data to client exception.', exc_info=err)
+            self.draining.discard(client)
+            self.remove_client(client)
+
+    def schedule_events(self):
+        '''Метод назначения отправки накопленных уведомлений таймером цикла событий.'''
+        super().schedule_events()
+        self.loop.call_later(PRESENCE_EVENTS_DELAY, self.flush_events)
+
+    def call_in_loop(self, callback, *args):
+        '''Метод передачи вызова из другого потока (GUI) в цикл событий.'''
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def close_client(self, client):
+        '''Метод закрытия соединения с клиентом.'''
+        LOG.info(f'Клиент {client.address} отключился от сервера.')
+        # Остаток очереди (например, ответ 400) передаётся в буфер транспорта,
+        # закрытие транспорта дожидается его отправки
+        queue = client.outbound
+        writer = client.sock
+        if not writer.is_closing():
+            while queue:
+                chunk = queue.peek()
+                writer.write(bytes(chunk))
+                queue.consume(len(chunk))
+        writer.close()
@@ -0,0 +1,316 @@
+import multiprocessing
+import os
+import selectors
+import shutil
+import socket
+import tempfile
+import time
+import logging
+import sys
+sys.path.append('../')
+from common.variables import *
+from common.utils import encode_message, MessageDecoder, FrameCompressor
+from server.outbound import OutboundQueue, POLICY_SPILL
+from server.registry import ClientConnection
+from server.core import MessageProcessor
+from server.database import ServerStorage
+
+# Подключение логирования
+LOG = logging.getLogger('app.server')
+
+
+class BusPeer(ClientConnection):
+    """
+    Подключение шины маршрутизации к другому рабочему процессу.
+    worker - номер процесса, известен после приветствия (BUS_HELLO).
+    """
+    __slots__ = ('worker',)
+
+    def __init__(self, sock, address, decoder, outbound, worker=None):
+        super().__init__(sock, address, decoder, outbound)
+        self.worker = worker
+
+    def __repr__(self):
+        return f'<BusPeer {self.worker}>'
+
+
+class RoutingBus:
+    """
+    Шина маршрутизации между рабочими процессами сервера.
+    Процессы связаны попарно через Unix-сокеты в каталоге path, каждый
+    процесс подключается к процессам с меньшими номерами. По шине
+    рассылаются входы и выходы пользователей (общий справочник
+    присутствия directory) и пересылаются сообщения пользователям,
+    подключённым к другим процессам.
+    Работает в потоке MessageProcessor, сокеты шины обслуживаются тем же
+    циклом selectors, что и клиенты.
+    """
+
+    def __init__(self, worker_id, workers, path):
+        self.worker_id = worker_id
+        self.workers = workers
+        self.path = path
+        self.server = None
+        self.sock = None
+        # Представившиеся процессы: {номер: BusPeer}
+        self.peers = dict()
+        # Все подключения шины, включая ещё не приславшие приветствие
+        self.connections = set()
+        # Справочник пользователей других процессов: {имя: номер процесса}
+        self.directory = dict()
+        # Время следующей попытки подключения к недоступным процессам
+        self.next_connect = 0
+
+    def socket_path(self, worker):
+        '''Путь к сокету шины процесса с номером worker.'''
+        return os.path.join(self.path, f'worker-{worker}.sock')
+
+    def start(self, server):
+        '''Запуск шины в цикле сервера server.'''
+        self.server = server
+        path = self.socket_path(self.worker_id)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(self.workers)
+        self.sock.setblocking(False)
+        server.selector.register(self.sock, selectors.EVENT_READ, self)
+        self.connect_peers()
+
+    def stop(self):
+        '''Остановка шины.'''
+        for peer in list(self.connections):
+            self.remove_peer(peer)
+        self.server.selector.unregister(self.sock)
+        self.sock.close()
+        try:
+            os.unlink(self.socket_path(self.worker_id))
+        except OSError:
+            pass
+
+    def handle_event(self, key, mask):
+        '''
+        Обработка события selectors. Возвращает False, если событие
+        относится не к шине, а к клиенту сервера.
+        '''
+        if key.data is self:
+            self.accept_peers()
+            return True
+        if not isinstance(key.data, BusPeer):
+            return False
+        peer = key.data
+        if peer not in self.connections:
+            return True
+        try:
+            if mask & selectors.EVENT_WRITE:
+                self.server.flush_client(peer)
+            if mask & selectors.EVENT_READ:
+                data = peer.sock.recv(RECV_BUFFER_SIZE)
+                if not data:
+                    raise ConnectionResetError('Процесс закрыл соединение шины')
+                peer.decoder.feed(data)
+                while peer.decoder.messages and peer in self.connections:
+                    self.process_bus_message(peer, peer.decoder.messages.popleft())
+        except (BlockingIOError, InterruptedError):
+            pass
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            LOG.debug(f'Bus peer exception.', exc_info=err)
+            self.remove_peer(peer)
+        return True
+
+    def new_peer(self, sock, worker=None):
+        '''Регистрация нового соединения шины.'''
+        sock.setblocking(False)
+        # Сообщения между процессами не отбрасываются: излишек уходит на диск
+        peer = BusPeer(
+            sock, self.path, MessageDecoder(),
+            OutboundQueue(self.server.high_watermark, self.server.low_watermark, POLICY_SPILL),
+            worker)
+        # Приветствие несёт список всех пользователей процесса - сжимаем
+        peer.compressor = FrameCompressor()
+        self.connections.add(peer)
+        self.server.selector.register(sock, selectors.EVENT_READ, peer)
+        return peer
+
+    def accept_peers(self):
+        '''Приём подключений от процессов с большими номерами.'''
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            self.new_peer(sock)
+
+    def connect_peers(self):
+        '''
+        Подключение к процессам с меньшими номерами. Процессы стартуют
+        одновременно, поэтому недоступные опрашиваются повторно на каждом
+        проходе цикла, но не чаще CONNECTION_TIMEOUT.
+        '''
+        if time.time() < self.next_connect:
+            return
+        self.next_connect = time.time() + CONNECTION_TIMEOUT
+        for worker in range(self.worker_id):
+            if worker in self.peers:
+                continue
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path(worker))
+            except OSError:
+                sock.close()
+                continue
+            peer = self.new_peer(sock, worker)
+            self.peers[worker] = peer
+            LOG.info(f'Процесс {self.worker_id} подключён к процессу {worker}.')
+            self.send(peer, self.hello())
+
+    def remove_peer(self, peer):
+        '''Закрытие соединения шины, пользователи процесса считаются вышедшими.'''
+        if peer not in self.connections:
+            return
+        self.connections.discard(peer)
+        if peer.worker is not None and self.peers.get(peer.worker) is peer:
+            del self.peers[peer.worker]
+            LOG.warning(f'Потеряно соединение с процессом {peer.worker}.')
+            # Подписчики этого процесса узнают, что пользователи вышли
+            for name in [name for name, worker in self.directory.items() if worker == peer.worker]:
+                del self.directory[name]
+                self.server.notify(name, EVENT_OFFLINE)
+        self.server.selector.unregister(peer.sock)
+        peer.sock.close()
+        peer.outbound.close()
+
+    def hello(self):
+        '''Приветствие со списком пользователей текущего процесса.'''
+        return {
+            ACTION: BUS_HELLO,
+            WORKER: self.worker_id,
+            LIST_INFO: list(self.server.names)
+        }
+
+    def send(self, peer, message):
+        '''
+        Постановка сообщения в очередь процесса и её отправка.
+        Процессы одной версии, поэтому шина всегда использует двоичный
+        кодек и сжатие.
+        '''
+        if peer not in self.connections:
+            return
+        peer.outbound.push(encode_message(message, True, CODEC_BINARY, peer.compressor))
+        try:
+            self.server.flush_client(peer)
+        except OSError as err:
+            LOG.debug(f'Bus peer exception.', exc_info=err)
+            self.remove_peer(peer)
+
+    def process_bus_message(self, peer, message):
+        '''Обработчик сообщений шины.'''
+        if message[ACTION] == BUS_HELLO:
+            answer = peer.worker is None
+            peer.worker = message[WORKER]
+            self.peers[peer.worker] = peer
+            for name in message[LIST_INFO]:
+                self.directory[name] = peer.worker
+            # Подключившемуся процессу отвечаем своим списком пользователей
+            if answer:
+                self.send(peer, self.hello())
+        elif message[ACTION] == BUS_PRESENCE:
+            if message[ONLINE]:
+                self.directory[message[ACCOUNT_NAME]] = peer.worker
+                if message.get(PUBLIC_KEY):
+                    self.server.database.cache_pubkey(message[ACCOUNT_NAME], message[PUBLIC_KEY])
+                self.server.notify(message[ACCOUNT_NAME], EVENT_ONLINE)
+            elif self.directory.get(message[ACCOUNT_NAME]) == peer.worker:
+                del self.directory[message[ACCOUNT_NAME]]
+                self.server.notify(message[ACCOUNT_NAME], EVENT_OFFLINE)
+        elif message[ACTION] == BUS_ROUTE:
+            # Пересланное сообщение доставляется только локально,
+            # чтобы устаревший справочник не зациклил его между процессами.
+            self.server.process_message(message[MESSAGE], forward=False)
+
+    def publish(self, name, online, pubkey=None):
+        '''
+        Рассылка всем процессам сведений о входе или выходе пользователя.
+        При входе передаётся и открытый ключ: справочники пользователей
+        других процессов о нём не знают.
+        '''
+        message = {
+            ACTION: BUS_PRESENCE,
+            ACCOUNT_NAME: name,
+            ONLINE: online,
+            PUBLIC_KEY: pubkey
+        }
+        for peer in list(self.peers.values()):
+            self.send(peer, message)
+
+    def route(self, message):
+        '''
+        Пересылка сообщения процессу, к которому подключён получатель.
+        Возвращает False, если получатель не найден в справочнике.
+        '''
+        peer = self.peers.get(self.directory.get(message[DESTINATION]))
+        if peer is None:
+            return False
+        self.send(peer, {ACTION: BUS_ROUTE, MESSAGE: message})
+        return True
+
+
+def run_worker(worker_id, workers, bus_path, listen_address, listen_port,
+               database_path, database_settings, outbound_settings, stop_event):
+    '''
+    Точка входа рабочего процесса: свой MessageProcessor на общем порту
+    (SO_REUSEPORT) и шина для связи с остальными процессами.
+    '''
+    database = ServerStorage(database_path, **database_settings)
+    server = MessageProcessor(
+        listen_address, listen_port, database, reuse_port=True,
+        bus=RoutingBus(worker_id, workers, bus_path), **outbound_settings)
+    server.daemon = True
+    server.start()
+    try:
+        stop_event.wait()
+    except KeyboardInterrupt:
+        pass
+    server.running = False
+    server.join()
+    database.close()
+
+
+class WorkerPool:
+    """
+    Набор рабочих процессов сервера, слушающих один порт.
+    """
+
+    def __init__(self, workers, listen_address, listen_port, database_path,
+                 database_settings, outbound_settings):
+        if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+            raise OSError('Запуск нескольких процессов не поддерживается этой ОС.')
+        # Процессы запускаются с чистым интерпретатором (spawn): классические
+        # отображения ServerStorage нельзя создать в процессе повторно.
+        context = multiprocessing.get_context('spawn')
+        self.stop_event = context.Event()
+        # Каталог для сокетов шины
+        self.bus_path = tempfile.mkdtemp(prefix='server-bus-')
+        self.processes = [
+            context.Process(
+                target=run_worker,
+                args=(worker_id, workers, self.bus_path, listen_address, listen_port,
+                      database_path, database_settings, outbound_settings, self.stop_event),
+                daemon=True)
+            for worker_id in range(workers)]
+
+    def start(self):
+        '''Запуск процессов.'''
+        for process in self.processes:
+            process.start()
+        LOG.info(f'Запущено рабочих процессов: {len(self.processes)}.')
+
+    def stop(self):
+        '''Остановка процессов и удаление каталога шины.'''
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(CONNECTION_TIMEOUT * 10)
+            if process.is_alive():
+                process.terminate()
+        shutil.rmtree(self.bus_path, ignore_errors=True)
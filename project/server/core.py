@@ -1,18 +1,23 @@
 import threading
+import time
 import logging
-import select
+import selectors
 import socket
 import json
 import hmac
 import binascii
 import os
 import sys
+from collections import deque
 sys.path.append('../')
 from common.metaclasses import ServerMaker
 from common.descriptors import Port
 from common.variables import *
-from common.utils import send_message, get_message
+from common.utils import encode_message, MessageDecoder, FrameCompressor, key_fingerprint
+from common.responses import OK_200, error_400, list_202, sync_202, auth_511, reply_to
 from common.decorators import login_required
+from server.outbound import OutboundQueue, OVERFLOW_POLICIES
+from server.registry import ClientConnection, ConnectionRegistry
 
 # Подключение логирования
 LOG = logging.getLogger('app.server')
@@ -26,10 +31,25 @@ class MessageProcessor(threading.Thread):
     """
     port = Port()
 
-    def __init__(self, listen_address, listen_port, database):
+    def __init__(self, listen_address, listen_port, database,
+                 high_watermark=OUTBOUND_HIGH_WATERMARK,
+                 low_watermark=OUTBOUND_LOW_WATERMARK,
+                 overflow_policy=OUTBOUND_POLICY,
+                 reuse_port=False, bus=None):
         # Параметры подключения
         self.addr = listen_address
         self.port = listen_port
+        # Порт делится с другими рабочими процессами (SO_REUSEPORT)
+        self.reuse_port = reuse_port
+        # Шина маршрутизации между рабочими процессами (RoutingBus) или None
+        self.bus = bus
+
+        # Границы очереди исходящих данных клиента и политика её переполнения
+        if overflow_policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Неизвестная политика переполнения: {overflow_policy}')
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.overflow_policy = overflow_policy
 
         # База данных сервера
         self.database = database
@@ -37,74 +57,244 @@ class MessageProcessor(threading.Thread):
         # Сокет, через который будет осуществляться работа
         self.sock = None
 
-        # Список подключённых клиентов.
-        self.clients = []
+        # Реестр подключённых клиентов (ClientConnection) с индексом по именам.
+        self.clients = ConnectionRegistry()
+
+        # Сроки ответа на 511 клиентов, проходящих авторизацию:
+        # (срок, подключение). Лежат в порядке возрастания, т.к. таймаут общий.
+        self.auth_deadlines = deque()
+
+        # Подключения с накопленными уведомлениями о присутствии и время
+        # их отправки (None - уведомлений нет)
+        self.events_pending = set()
+        self.events_deadline = None
+
+        # Вызовы, переданные в поток сервера из других потоков (GUI), и пара
+        # сокетов для пробуждения селектора при их поступлении (создаётся
+        # при запуске потока).
+        self.calls = deque()
+        self.wakeup_receiver = self.wakeup_sender = None
 
-        # Сокеты
-        self.listen_sockets = None
-        self.error_sockets = None
+        # Селектор, ожидающий готовности слушающего и клиентских сокетов
+        # (epoll на Linux, kqueue на BSD/macOS, select на Windows).
+        self.selector = None
 
         # Флаг продолжения работы
         self.running = True
 
-        # Словарь содержащий сопоставленные имена и соответствующие им сокеты.
-        # {'test1': <socket.socket fd=25, family=AddressFamily.AF_INET, type=SocketKind.SOCK_STREAM, proto=0, laddr=('127.0.0.1', 7777), raddr=('127.0.0.1', 52420)>}
-        self.names = dict()
-
         # Конструктор предка
         super().__init__()
 
+    @property
+    def names(self):
+        '''
+        Словарь содержащий сопоставленные имена и подключения авторизованных клиентов.
+        {'test1': <ClientConnection test1 ('127.0.0.1', 52420)>}
+        '''
+        return self.clients.names
+
     def run(self):
         '''Метод основной цикл потока.'''
         # Инициализация Сокета
         self.init_socket()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.wakeup_receiver, self.wakeup_sender = socket.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+        # Вызовы, переданные до запуска потока
+        if self.calls:
+            self.wakeup_sender.send(b'\0')
+        if self.bus:
+            self.bus.start(self)
 
-        # Основной цикл программы сервера
+        # Основной цикл программы сервера. Одно ожидание на все сокеты сразу,
+        # таймаут нужен для проверки флага running и отправки уведомлений.
         while self.running:
-            # Ждём подключения, если таймаут вышел, ловим исключение.
+            timeout = CONNECTION_TIMEOUT
+            if self.events_deadline is not None:
+                timeout = max(0, min(timeout, self.events_deadline - time.monotonic()))
             try:
-                client, client_address = self.sock.accept()
-            except OSError:
+                events = self.selector.select(timeout)
+            except OSError as err:
+                LOG.error(f'Ошибка работы с сокетами: {err.errno}')
+                continue
+
+            for key, mask in events:
+                if key.fileobj is self.sock:
+                    self.accept_clients()
+                    continue
+                if key.fileobj is self.wakeup_receiver:
+                    self.run_calls()
+                    continue
+                if self.bus and self.bus.handle_event(key, mask):
+                    continue
+                client_with_message = key.data
+                # Клиент мог быть отключён при обработке предыдущих событий
+                if client_with_message not in self.clients:
+                    continue
+                # отправляем накопленное и принимаем сообщения,
+                # если ошибка, исключаем клиента.
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        self.flush_client(client_with_message)
+                    if mask & selectors.EVENT_READ:
+                        self.read_client_messages(client_with_message)
+                except (OSError, ValueError, TypeError) as err:
+                    LOG.debug(f'Getting data from client exception.', exc_info=err)
+                    self.remove_client(client_with_message)
+
+            self.check_auth_deadlines()
+            if self.events_deadline is not None and self.events_deadline <= time.monotonic():
+                self.flush_events()
+            self.database.flush_counters()
+            if self.bus:
+                self.bus.connect_peers()
+
+        for client in self.clients:
+            self.remove_client(client)
+        if self.bus:
+            self.bus.stop()
+        # Незаписанная статистика сохраняется при остановке сервера
+        self.database.flush_counters(force=True)
+        self.selector.close()
+        self.wakeup_receiver.close()
+        self.wakeup_sender.close()
+        self.sock.close()
+
+    def in_loop_thread(self):
+        '''Метод проверяющий, что вызов сделан из потока сервера.'''
+        return threading.current_thread() is self or not self.is_alive()
+
+    def call_in_loop(self, callback, *args):
+        '''Метод передачи вызова из другого потока (GUI) в поток сервера.'''
+        self.calls.append((callback, args))
+        wakeup_sender = self.wakeup_sender
+        if wakeup_sender is None:
+            return
+        try:
+            wakeup_sender.send(b'\0')
+        except OSError:
+            pass
+
+    def run_calls(self):
+        '''Метод выполнения вызовов, переданных из других потоков.'''
+        try:
+            while self.wakeup_receiver.recv(RECV_BUFFER_SIZE):
                 pass
-            else:
-                LOG.info(f'Установлено соедение с ПК {client_address}')
-                client.settimeout(5)
-                self.clients.append(client)
-
-            recv_data_lst = []
-            send_data_lst = []
-            err_lst = []
-            # Проверяем на наличие ждущих клиентов
+        except (BlockingIOError, InterruptedError):
+            pass
+        while self.calls:
+            callback, args = self.calls.popleft()
+            callback(*args)
+
+    def accept_clients(self):
+        '''Метод принимающий все ожидающие в очереди подключения.'''
+        while True:
             try:
-                if self.clients:
-                    recv_data_lst, self.listen_sockets, self.error_sockets = select.select(
-                        self.clients, self.clients, [], 0)
+                client, client_address = self.sock.accept()
+            except BlockingIOError:
+                return
             except OSError as err:
-                LOG.error(f'Ошибка работы с сокетами: {err.errno}')
+                LOG.error(f'Ошибка приёма подключения: {err.errno}')
+                return
+            LOG.info(f'Установлено соедение с ПК {client_address}')
+            client.setblocking(False)
+            connection = ClientConnection(
+                client, client_address, MessageDecoder(),
+                OutboundQueue(self.high_watermark, self.low_watermark, self.overflow_policy))
+            self.clients.add(connection)
+            self.selector.register(client, selectors.EVENT_READ, connection)
+
+    def read_client_messages(self, client):
+        '''
+        Метод чтения данных из сокета клиента.
+        Все целиком принятые сообщения обрабатываются по порядку,
+        неполное сообщение остаётся в декодере до следующего чтения.
+        '''
+        try:
+            data = client.sock.recv(RECV_BUFFER_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            raise TypeError('Получено пустое сообщение')
+        decoder = client.decoder
+        decoder.feed(data)
+        # Клиент может быть отключён в процессе обработки (например, exit)
+        while decoder.messages and client in self.clients:
+            self.dispatch_message(decoder.messages.popleft(), client)
+
+    def dispatch_message(self, message, client):
+        '''
+        Метод выбора обработчика сообщения: ответ на 511 от клиента,
+        проходящего авторизацию, или обычный запрос.
+        '''
+        if client.auth_state is not None:
+            presence, digest, deadline = client.auth_state
+            client.auth_state = None
+            self.auth_complete(presence, client, digest, message)
+        else:
+            self.process_client_message(message, client)
 
-            # принимаем сообщения и если ошибка, исключаем клиента.
-            if recv_data_lst:
-                for client_with_message in recv_data_lst:
-                    try:
-                        self.process_client_message(
-                            get_message(client_with_message), client_with_message)
-                    except (OSError, json.JSONDecodeError, TypeError) as err:
-                        LOG.debug(f'Getting data from client exception.', exc_info=err)
-                        self.remove_client(client_with_message)
+    def send_to_client(self, client, message):
+        '''
+        Метод отправки сообщения клиенту в режиме передачи его соединения.
+        Сообщение ставится в очередь клиента, отправка идёт сразу, пока
+        сокет принимает данные, остаток - по готовности сокета к записи.
+        Если клиент не успевает принимать данные и политика очереди -
+        отключение, вызывает ConnectionAbortedError.
+        '''
+        if client not in self.clients:
+            raise ConnectionResetError('Соединение с клиентом закрыто')
+        if not client.outbound.push(encode_message(
+                message, client.decoder.framed, client.codec, client.compressor),
+                client.compressor):
+            raise ConnectionAbortedError('Клиент не успевает принимать сообщения')
+        self.flush_client(client)
+
+    def flush_client(self, client):
+        '''
+        Метод отправки накопленных в очереди данных клиента.
+        Пока в очереди есть данные, селектор ждёт и готовности сокета к записи.
+        '''
+        queue = client.outbound
+        pending = bool(queue)
+        if pending:
+            pending = not queue.send(client.sock)
+        events = selectors.EVENT_READ | selectors.EVENT_WRITE if pending else selectors.EVENT_READ
+        if self.selector.get_key(client.sock).events != events:
+            self.selector.modify(client.sock, events, client)
 
     def remove_client(self, client):
         '''
         Метод обработчик клиента с которым прервана связь.
         Ищет клиента и удаляет его из списков и базы:
         '''
-        LOG.info(f'Клиент {client.getpeername()} отключился от сервера.')
-        for name in self.names:
-            if self.names[name] == client:
-                self.database.user_logout(name)
-                del self.names[name]
-                break
-        self.clients.remove(client)
-        client.close()
+        if not self.in_loop_thread():
+            self.call_in_loop(self.remove_client, client)
+            return
+        name = client.name if client.authenticated else None
+        if not self.clients.remove(client):
+            return
+        self.events_pending.discard(client)
+        if name:
+            self.database.user_logout(name)
+            if self.bus:
+                self.bus.publish(name, False)
+            self.notify(name, EVENT_OFFLINE)
+        self.close_client(client)
+        client.outbound.close()
+
+    def close_client(self, client):
+        '''Метод закрытия соединения с клиентом.'''
+        LOG.info(f'Клиент {client.address} отключился от сервера.')
+        # Последняя попытка отправить остаток очереди (например, ответ 400)
+        try:
+            client.outbound.send(client.sock)
+        except OSError:
+            pass
+        self.selector.unregister(client.sock)
+        client.sock.close()
 
     def init_socket(self):
         '''Метод инициализатор сокета.'''
@@ -113,214 +303,453 @@ class MessageProcessor(threading.Thread):
         # Готовим сокет
         transport = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1) # Несколько приложений может слушать сокет
+        if self.reuse_port:
+            # Входящие соединения распределяются ядром между процессами
+            transport.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         transport.bind((self.addr, self.port))
-        transport.settimeout(CONNECTION_TIMEOUT)
+        transport.setblocking(False)
 
         # Начинаем слушать сокет.
         self.sock = transport
         self.sock.listen(MAX_CONNECTIONS)
 
-    def process_message(self, message):
+    def user_online(self, name):
+        '''Метод проверяющий, что пользователь подключён к серверу (к любому процессу).'''
+        return name in self.names or bool(self.bus and name in self.bus.directory)
+
+    def process_message(self, message, forward=True):
         '''
         Метод отправки сообщения клиенту.
+        Если получатель подключён к другому рабочему процессу и forward
+        разрешён, сообщение пересылается через шину. Если доставить
+        сообщение не удалось, оно сохраняется в почтовый ящик получателя.
         '''
-        if message[DESTINATION] in self.names and self.names[message[DESTINATION]
-        ] in self.listen_sockets:
+        client = self.names.get(message[DESTINATION])
+        if client:
             try:
-                send_message(self.names[message[DESTINATION]], message)
+                self.send_to_client(client, message)
                 LOG.info(
                     f'Отправлено сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]}.')
             except OSError:
-                self.remove_client(message[DESTINATION])
-        elif message[DESTINATION] in self.names and self.names[message[DESTINATION]] not in self.listen_sockets:
-            LOG.error(
-                f'Связь с клиентом {message[DESTINATION]} была потеряна. Соединение закрыто, доставка невозможна.')
-            self.remove_client(self.names[message[DESTINATION]])
+                LOG.error(
+                    f'Связь с клиентом {message[DESTINATION]} была потеряна. Сообщение сохранено в почтовый ящик.')
+                self.remove_client(client)
+                self.store_message(message)
+        elif forward and self.bus and self.bus.route(message):
+            LOG.info(
+                f'Сообщение пользователю {message[DESTINATION]} от пользователя {message[SENDER]} передано в шину.')
         else:
-            LOG.error(
-                f'Пользователь {message[DESTINATION]} не зарегистрирован на сервере, отправка сообщения невозможна.')
+            LOG.info(
+                f'Пользователь {message[DESTINATION]} не в сети, сообщение сохранено в почтовый ящик.')
+            self.store_message(message)
+
+    def store_message(self, message):
+        '''Метод сохранения сообщения в почтовый ящик получателя без ответа отправителю.'''
+        future = self.database.store_message(message[DESTINATION], message)
+        future.add_done_callback(lambda done: done.exception() and LOG.error(
+            f'Сообщение пользователю {message[DESTINATION]} потеряно: {done.exception()}'))
+
+    def deliver_mailbox(self, client):
+        '''
+        Метод доставки клиенту сообщений, ждавших его в почтовом ящике.
+        Ящик читает поток записи базы, отправка идёт из цикла сервера.
+        '''
+        future = self.database.get_mailbox(client.name)
+        future.add_done_callback(
+            lambda done: self.call_in_loop(self.send_mailbox, client, done))
+
+    def send_mailbox(self, client, future):
+        '''
+        Метод отправки содержимого почтового ящика клиенту.
+        Все сообщения ставятся в очередь клиента одним блоком и уходят
+        в сокет общими вызовами send. Из ящика удаляются сообщения,
+        принятые в очередь; если очередь их не приняла, они останутся
+        в ящике до следующего входа.
+        '''
+        if client not in self.clients:
+            return
+        if future.exception() is not None:
+            LOG.error(f'Ошибка чтения почтового ящика: {future.exception()}')
+            return
+        messages = future.result()
+        if not messages:
+            return
+        data = b''.join(
+            encode_message(message, client.decoder.framed, client.codec, client.compressor)
+            for message_id, message in messages)
+        dropped = client.outbound.dropped
+        if not client.outbound.push(data, client.compressor):
+            LOG.warning(f'Клиент {client.name} не принял сообщения почтового ящика.')
+            self.remove_client(client)
+            return
+        # Отброшенные очередью сообщения остаются в ящике до следующего входа
+        if client.outbound.dropped != dropped:
+            LOG.warning(f'Сообщения почтового ящика для {client.name} отложены: очередь переполнена.')
+            return
+        self.database.remove_mailbox([message_id for message_id, message in messages])
+        LOG.info(f'Пользователю {client.name} доставлено сообщений из почтового ящика: {len(messages)}.')
+        try:
+            self.flush_client(client)
+        except OSError:
+            self.remove_client(client)
 
     @login_required
     def process_client_message(self, message, client):
-        """ Метод обработчик поступающих сообщений. """
+        """
+        Метод обработчик поступающих сообщений.
+        Номер запроса (REQUEST_ID) возвращается в ответе и не пересылается
+        получателю сообщения.
+        """
         LOG.debug(f'Разбор сообщения от клиента : {message}')
+        request_id = message.pop(REQUEST_ID, None)
         # Если это сообщение о присутствии, принимаем и отвечаем
         if ACTION in message and message[ACTION] == PRESENCE and TIME in message and USER in message:
             # Если сообщение о присутствии то вызываем функцию авторизации.
-            self.autorize_user(message, client)
+            self.autorize_user(message, client, request_id)
 
         # Если это сообщение, то отправляем его получателю.
         elif ACTION in message and message[ACTION] == MESSAGE and DESTINATION in message and TIME in message \
-                and SENDER in message and MESSAGE_TEXT in message and self.names[message[SENDER]] == client:
-            if message[DESTINATION] in self.names:
+                and SENDER in message and MESSAGE_TEXT in message and self.names.get(message[SENDER]) is client:
+            if self.user_online(message[DESTINATION]):
                 self.database.process_message(
                     message[SENDER], message[DESTINATION])
                 self.process_message(message)
                 try:
-                    send_message(client, RESPONSE_200)
+                    self.send_to_client(client, reply_to(request_id, OK_200))
                 except OSError:
                     self.remove_client(client)
+            elif self.database.check_user(message[DESTINATION]):
+                # Получатель не в сети: сообщение ждёт его в почтовом ящике,
+                # отправитель получает ответ после записи
+                self.database.process_message(
+                    message[SENDER], message[DESTINATION])
+                self.reply_on_commit(
+                    self.database.store_message(message[DESTINATION], message), client, request_id)
             else:
-                response = RESPONSE_400
-                response[ERROR] = 'Пользователь не зарегистрирован на сервере.'
+                response = error_400('Пользователь не зарегистрирован на сервере.')
                 try:
-                    send_message(client, response)
+                    self.send_to_client(client, reply_to(request_id, response))
                 except OSError:
                     pass
             return
 
         # Если клиент выходит
         elif ACTION in message and message[ACTION] == EXIT and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
+                and self.names.get(message[ACCOUNT_NAME]) is client:
             self.remove_client(client)
 
         # Если это запрос контакт-листа
         elif ACTION in message and message[ACTION] == GET_CONTACTS and USER in message and \
-                self.names[message[USER]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = self.database.get_contacts(message[USER])
+                self.names.get(message[USER]) is client:
+            response = list_202(self.database.get_contacts(message[USER]))
             try:
-                send_message(client, response)
+                self.send_to_client(client, reply_to(request_id, response))
             except OSError:
                 self.remove_client(client)
 
         # Если это добавление контакта
         elif ACTION in message and message[ACTION] == ADD_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.add_contact(message[USER], message[ACCOUNT_NAME])
-            try:
-                send_message(client, RESPONSE_200)
-            except OSError:
-                self.remove_client(client)
+                and self.names.get(message[USER]) is client:
+            self.reply_on_commit(
+                self.database.add_contact(message[USER], message[ACCOUNT_NAME]), client, request_id)
+            # Клиент подписывается на присутствие нового контакта
+            if self.database.check_user(message[ACCOUNT_NAME]):
+                self.clients.subscribe(client, [message[ACCOUNT_NAME]])
+                if self.user_online(message[ACCOUNT_NAME]):
+                    self.queue_event(client, message[ACCOUNT_NAME], EVENT_ONLINE)
 
         # Если это удаление контакта
         elif ACTION in message and message[ACTION] == REMOVE_CONTACT and ACCOUNT_NAME in message and USER in message \
-                and self.names[message[USER]] == client:
-            self.database.remove_contact(message[USER], message[ACCOUNT_NAME])
+                and self.names.get(message[USER]) is client:
+            self.reply_on_commit(
+                self.database.remove_contact(message[USER], message[ACCOUNT_NAME]), client, request_id)
+            self.clients.unsubscribe(client, [message[ACCOUNT_NAME]])
+
+        # Если это запрос известных пользователей
+        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
+                and self.names.get(message[ACCOUNT_NAME]) is client:
+            response = list_202([user[0] for user in self.database.users_list()])
             try:
-                send_message(client, RESPONSE_200)
+                self.send_to_client(client, reply_to(request_id, response))
             except OSError:
                 self.remove_client(client)
 
-        # Если это запрос известных пользователей
-        elif ACTION in message and message[ACTION] == USERS_REQUEST and ACCOUNT_NAME in message \
-                and self.names[message[ACCOUNT_NAME]] == client:
-            response = RESPONSE_202
-            response[LIST_INFO] = [user[0]
-                                   for user in self.database.users_list()]
+        # Если это запрос изменений списков пользователей и контактов
+        elif ACTION in message and message[ACTION] == SYNC_REQUEST and ACCOUNT_NAME in message \
+                and isinstance(message.get(VERSION), int) and self.names.get(message[ACCOUNT_NAME]) is client:
+            # Пользователь мог быть удалён, пока клиент ещё подключён
+            try:
+                response = sync_202(*self.database.get_changes(message[ACCOUNT_NAME], message[VERSION]))
+            except ValueError as err:
+                response = error_400(str(err))
             try:
-                send_message(client, response)
+                self.send_to_client(client, reply_to(request_id, response))
             except OSError:
                 self.remove_client(client)
 
         # Если это запрос публичного ключа пользователя
         elif ACTION in message and message[ACTION] == PUBLIC_KEY_REQUEST and ACCOUNT_NAME in message:
-            response = RESPONSE_511
-            response[DATA] = self.database.get_pubkey(message[ACCOUNT_NAME])
+            response = auth_511(self.database.get_pubkey(message[ACCOUNT_NAME]))
             # может быть, что ключа ещё нет (пользователь никогда не логинился,
             # тогда шлём 400)
             if response[DATA]:
                 try:
-                    send_message(client, response)
+                    self.send_to_client(client, reply_to(request_id, response))
                 except OSError:
                     self.remove_client(client)
             else:
-                response = RESPONSE_400
-                response[ERROR] = 'Нет публичного ключа для данного пользователя'
+                response = error_400('Нет публичного ключа для данного пользователя')
                 try:
-                    send_message(client, response)
+                    self.send_to_client(client, reply_to(request_id, response))
                 except OSError:
                     self.remove_client(client)
 
         # Иначе отдаём Bad request
         else:
-            response = RESPONSE_400
-            response[ERROR] = 'Запрос некорректен.'
+            response = error_400('Запрос некорректен.')
             try:
-                send_message(client, response)
+                self.send_to_client(client, reply_to(request_id, response))
             except OSError:
                 self.remove_client(client)
 
-    def autorize_user(self, message, sock):
-        """ Метод реализующий авторизацию пользователей. """
+    def autorize_user(self, message, client, request_id=None):
+        """
+        Метод реализующий авторизацию пользователей.
+        Отправляет клиенту 511 и запоминает состояние авторизации,
+        ответ клиента обрабатывается при его поступлении (dispatch_message),
+        не задерживая остальных клиентов.
+        """
+        digest = self.auth_challenge(message, client, request_id)
+        if digest is None:
+            return
+        deadline = time.monotonic() + AUTH_TIMEOUT
+        client.auth_state = (message, digest, deadline)
+        self.auth_deadlines.append((deadline, client))
+
+    def check_auth_deadlines(self):
+        """Метод отключения клиентов, не ответивших на 511 вовремя."""
+        now = time.monotonic()
+        while self.auth_deadlines and self.auth_deadlines[0][0] <= now:
+            deadline, client = self.auth_deadlines.popleft()
+            state = client.auth_state
+            # Клиент мог уже ответить или отключиться
+            if state is None or state[2] != deadline:
+                continue
+            LOG.info(f'Клиент {state[0][USER][ACCOUNT_NAME]} не прошёл авторизацию вовремя.')
+            response = error_400('Превышено время авторизации.')
+            try:
+                self.send_to_client(client, response)
+            except OSError:
+                pass
+            self.remove_client(client)
+
+    def auth_challenge(self, message, client, request_id=None):
+        """
+        Первый шаг авторизации: проверка имени и отправка клиенту 511
+        со случайной строкой. Возвращает ожидаемый от клиента хэш
+        или None, если авторизация невозможна (соединение уже закрыто).
+        """
         # Если имя пользователя уже занято то возвращаем 400
         LOG.debug(f'Start auth process for {message[USER]}')
-        if message[USER][ACCOUNT_NAME] in self.names.keys():
-            response = RESPONSE_400
-            response[ERROR] = 'Имя пользователя уже занято.'
+        if self.user_online(message[USER][ACCOUNT_NAME]):
+            response = error_400('Имя пользователя уже занято.')
             try:
                 LOG.debug(f'Username busy, sending {response}')
-                send_message(sock, response)
+                self.send_to_client(client, reply_to(request_id, response))
             except OSError:
                 LOG.debug('OS Error')
                 pass
-            self.clients.remove(sock)
-            sock.close()
+            self.remove_client(client)
+            return None
         # Проверяем что пользователь зарегистрирован на сервере.
         elif not self.database.check_user(message[USER][ACCOUNT_NAME]):
-            response = RESPONSE_400
-            response[ERROR] = 'Пользователь не зарегистрирован.'
+            response = error_400('Пользователь не зарегистрирован.')
             try:
                 LOG.debug(f'Unknown username, sending {response}')
-                send_message(sock, response)
+                self.send_to_client(client, reply_to(request_id, response))
             except OSError:
                 pass
-            self.clients.remove(sock)
-            sock.close()
+            self.remove_client(client)
+            return None
+
+        LOG.debug('Correct username, starting passwd check.')
+        # Иначе отвечаем 511 и проводим процедуру авторизации
+        # Набор байтов в hex представлении
+        random_str = binascii.hexlify(os.urandom(64))
+        # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
+        message_auth = auth_511(random_str.decode('ascii'))
+        # Создаём хэш пароля и связки с рандомной строкой, сохраняем
+        # серверную версию ключа
+        hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
+        digest = hash.digest()
+        # Двоичный кодек выбирается, только если клиент его поддерживает,
+        # старые клиенты продолжают работать в JSON
+        codec = CODEC_JSON
+        if client.decoder.framed and CODEC_BINARY in message.get(CODECS, ()):
+            codec = CODEC_BINARY
+        message_auth[CODEC] = codec
+        # Сжатие больших кадров (списки пользователей, ключи) - так же по выбору клиента
+        compression = None
+        if client.decoder.framed and COMPRESSION_ZLIB in message.get(COMPRESSION, ()):
+            compression = COMPRESSION_ZLIB
+        message_auth[COMPRESSION] = compression
+        LOG.debug(f'Auth message = {message_auth}')
+        try:
+            self.send_to_client(client, reply_to(request_id, message_auth))
+        except OSError as err:
+            LOG.debug('Error in auth, data:', exc_info=err)
+            self.remove_client(client)
+            return None
+        client.codec = codec
+        if compression:
+            client.compressor = FrameCompressor()
+        return digest
+
+    def auth_complete(self, message, client, digest, ans):
+        """
+        Второй шаг авторизации: проверка ответа клиента на 511.
+        При успехе клиент заносится в список авторизованных.
+        """
+        client_digest = binascii.a2b_base64(ans[DATA]) if DATA in ans else b''
+        request_id = ans.get(REQUEST_ID)
+        # Пока клиент отвечал, под этим именем мог войти другой клиент
+        if self.user_online(message[USER][ACCOUNT_NAME]):
+            response = error_400('Имя пользователя уже занято.')
+            try:
+                self.send_to_client(client, reply_to(request_id, response))
+            except OSError:
+                pass
+            self.remove_client(client)
+        # Если ответ клиента корректный, то сохраняем его в список
+        # пользователей.
+        elif RESPONSE in ans and ans[RESPONSE] == 511 and \
+                hmac.compare_digest(digest, client_digest):
+            self.clients.authenticate(client, message[USER][ACCOUNT_NAME])
+            if self.bus:
+                self.bus.publish(message[USER][ACCOUNT_NAME], True, message[USER][PUBLIC_KEY])
+            client_ip, client_port = client.address[:2]
+            # добавляем пользователя в список активных и,
+            # если у него изменился открытый ключ, то сохраняем новый.
+            # Ответ отправляется после записи, чтобы следующие запросы
+            # клиента уже видели новый ключ.
+            self.reply_on_commit(self.database.user_login(
+                message[USER][ACCOUNT_NAME],
+                client_ip,
+                client_port,
+                message[USER][PUBLIC_KEY]), client, request_id)
+            # Сообщения, пришедшие без клиента, отправляются после ответа 200
+            self.deliver_mailbox(client)
+            # Отпечаток нового ключа в уведомлениях о входе должен быть
+            # верным ещё до записи ключа в базу
+            if message[USER][PUBLIC_KEY]:
+                self.database.cache_pubkey(message[USER][ACCOUNT_NAME], message[USER][PUBLIC_KEY])
+            self.subscribe_contacts(client)
         else:
-            LOG.debug('Correct username, starting passwd check.')
-            # Иначе отвечаем 511 и проводим процедуру авторизации
-            # Словарь - заготовка
-            message_auth = RESPONSE_511
-            # Набор байтов в hex представлении
-            random_str = binascii.hexlify(os.urandom(64))
-            # В словарь байты нельзя, декодируем (json.dumps -> TypeError)
-            message_auth[DATA] = random_str.decode('ascii')
-            # Создаём хэш пароля и связки с рандомной строкой, сохраняем
-            # серверную версию ключа
-            hash = hmac.new(self.database.get_hash(message[USER][ACCOUNT_NAME]), random_str, 'MD5')
-            digest = hash.digest()
-            LOG.debug(f'Auth message = {message_auth}')
+            response = error_400('Неверный пароль.')
             try:
-                # Обмен с клиентом
-                send_message(sock, message_auth)
-                ans = get_message(sock)
-            except OSError as err:
-                LOG.debug('Error in auth, data:', exc_info=err)
-                sock.close()
-                return
-            client_digest = binascii.a2b_base64(ans[DATA])
-            # Если ответ клиента корректный, то сохраняем его в список
-            # пользователей.
-            if RESPONSE in ans and ans[RESPONSE] == 511 and \
-                    hmac.compare_digest(digest, client_digest):
-                self.names[message[USER][ACCOUNT_NAME]] = sock
-                client_ip, client_port = sock.getpeername()
-                try:
-                    send_message(sock, RESPONSE_200)
-                except OSError:
-                    self.remove_client(message[USER][ACCOUNT_NAME])
-                # добавляем пользователя в список активных и,
-                # если у него изменился открытый ключ, то сохраняем новый
-                self.database.user_login(
-                    message[USER][ACCOUNT_NAME],
-                    client_ip,
-                    client_port,
-                    message[USER][PUBLIC_KEY])
-            else:
-                response = RESPONSE_400
-                response[ERROR] = 'Неверный пароль.'
-                try:
-                    send_message(sock, response)
-                except OSError:
-                    pass
-                self.clients.remove(sock)
-                sock.close()
+                self.send_to_client(client, reply_to(request_id, response))
+            except OSError:
+                pass
+            self.remove_client(client)
 
-    def service_update_lists(self):
-        '''Метод реализующий отправки сервисного сообщения 205 клиентам.'''
-        for client in self.names:
+    def subscribe_contacts(self, client):
+        '''
+        Метод подписки авторизованного клиента на присутствие его контактов.
+        Клиент получает уведомления о контактах, которые уже в сети,
+        а клиенты, у которых он в контактах, - о его входе.
+        '''
+        self.clients.subscribe(client, self.database.get_contacts(client.name))
+        for contact in client.watching:
+            if self.user_online(contact):
+                self.queue_event(client, contact, EVENT_ONLINE)
+        self.notify(client.name, EVENT_ONLINE)
+
+    def reply_on_commit(self, future, client, request_id=None, response=OK_200):
+        '''
+        Метод отправки ответа клиенту после записи изменения в базу.
+        Поток сервера не ждёт записи: ответ отправляется из цикла сервера,
+        когда поток записи завершит Future.
+        '''
+        future.add_done_callback(
+            lambda done: self.call_in_loop(self.send_write_result, client, request_id, response, done))
+
+    def send_write_result(self, client, request_id, response, future):
+        '''Метод отправки клиенту результата записи в базу.'''
+        if client not in self.clients:
+            return
+        if isinstance(future.exception(), ValueError):
+            # Отказ по существу запроса (например, переполнен почтовый ящик)
+            response = error_400(str(future.exception()))
+        elif future.exception() is not None:
+            LOG.error(f'Ошибка записи в базу данных: {future.exception()}')
+            response = error_400('Ошибка записи в базу данных.')
+        try:
+            self.send_to_client(client, reply_to(request_id, response))
+        except OSError:
+            self.remove_client(client)
+
+    def notify(self, name, event):
+        '''
+        Метод постановки уведомления о пользователе name клиентам,
+        у которых он в контактах. Уведомления копятся PRESENCE_EVENTS_DELAY
+        секунд, за это время от каждого пользователя остаётся последнее событие.
+        '''
+        for client in self.clients.watching(name):
+            self.queue_event(client, name, event)
+
+    def queue_event(self, client, name, event):
+        '''Метод добавления уведомления в накопленные для клиента.'''
+        client.events[name] = event
+        self.events_pending.add(client)
+        if self.events_deadline is None:
+            self.schedule_events()
+
+    def schedule_events(self):
+        '''Метод назначения отправки накопленных уведомлений (проверяется в цикле сервера).'''
+        self.events_deadline = time.monotonic() + PRESENCE_EVENTS_DELAY
+
+    def flush_events(self):
+        '''
+        Метод отправки накопленных уведомлений: одно сообщение каждому клиенту.
+        К событиям входа прилагаются отпечатки ключей вошедших пользователей.
+        '''
+        self.events_deadline = None
+        pending, self.events_pending = self.events_pending, set()
+        # Отпечатки считаются один раз на пользователя, а не на получателя
+        fingerprints = self.fingerprints({
+            name for client in pending for name, event in client.events.items()
+            if event == EVENT_ONLINE})
+        for client in pending:
+            events, client.events = client.events, dict()
+            if client not in self.clients or not events:
+                continue
             try:
-                send_message(self.names[client], RESPONSE_205)
+                self.send_to_client(client, {
+                    ACTION: NOTIFY,
+                    EVENTS: [[name, event] for name, event in events.items()],
+                    FINGERPRINTS: {
+                        name: fingerprints[name] for name, event in events.items()
+                        if event == EVENT_ONLINE and name in fingerprints}
+                })
             except OSError:
-                self.remove_client(self.names[client])
+                self.remove_client(client)
+
+    def fingerprints(self, names):
+        '''Метод получения отпечатков открытых ключей пользователей {имя: отпечаток}.'''
+        result = dict()
+        for name in names:
+            pubkey = self.database.get_pubkey(name)
+            if pubkey:
+                result[name] = key_fingerprint(pubkey)
+        return result
+
+    def user_removed(self, name):
+        '''
+        Метод уведомления об удалении пользователя с сервера: уведомление
+        получают клиенты, у которых он был в контактах.
+        '''
+        if not self.in_loop_thread():
+            self.call_in_loop(self.user_removed, name)
+            return
+        self.notify(name, EVENT_USER_REMOVED)
+        self.clients.forget(name)
@@ -1,6 +1,32 @@
-from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text
+from sqlalchemy import create_engine, Table, Column, Integer, String, MetaData, ForeignKey, DateTime, Text, \
+    Float, LargeBinary, Boolean, func
 from sqlalchemy.orm import mapper, sessionmaker
 import datetime
+import threading
+import queue
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+import sys
+sys.path.append('../')
+from common.variables import COUNTERS_FLUSH_COUNT, COUNTERS_FLUSH_INTERVAL, WRITE_BATCH_SIZE, \
+    MAILBOX_TTL, MAILBOX_QUOTA, MAILBOX_MAX_BYTES, CODEC_BINARY
+from common.codec import encode_body, decode_body
+from common.storage import apply_profile, create_indexes
+
+# Вторичные индексы базы сервера: (имя индекса, таблица, столбцы).
+# Создаются при запуске, в том числе в уже существующей базе.
+INDEXES = (
+    ('ix_contacts_user_contact', 'Contacts', ('user', 'contact')),
+    ('ix_history_user', 'History', ('user',)),
+    ('ix_login_history_name_date', 'Login_history', ('name', 'date_time')),
+    ('ix_mailbox_recipient_id', 'Mailbox', ('recipient', 'id')),
+    ('ix_changes_owner_id', 'Changes', ('owner', 'id')),
+)
+
+# Запись справочника пользователей в памяти: только поля, нужные
+# авторизации и маршрутизации сообщений
+UserRecord = namedtuple('UserRecord', ('id', 'passwd_hash', 'pubkey', 'last_login'))
 
 
 class ServerStorage:
@@ -8,6 +34,21 @@ class ServerStorage:
     Класс - оболочка для работы с базой данных сервера.
     Использует SQLite базу данных, реализован с помощью
     SQLAlchemy ORM и используется классический подход.
+    Счётчики статистики сообщений (таблица History) обновляются
+    отложенно: приращения копятся в памяти и записываются в базу
+    одной транзакцией (flush_counters).
+    Все изменения базы выполняет отдельный поток записи: методы
+    изменения ставят операцию в очередь и возвращают Future, операции
+    из очереди применяются группами с одним commit на группу.
+    Справочник пользователей (users) хранится в памяти и отвечает
+    на частые запросы (check_user, get_hash, get_pubkey) без обращения
+    к базе, поток записи обновляет его после commit.
+    Сообщения пользователям не в сети хранятся в почтовом ящике (таблица
+    Mailbox) не дольше mailbox_ttl секунд, объём ящика одного получателя
+    ограничен mailbox_quota сообщениями и mailbox_max_bytes байтами.
+    Изменения списка пользователей и списков контактов записываются
+    в журнал (таблица Changes), номер последней записи журнала - версия
+    справочника, по которой клиенты получают только изменения (get_changes).
     '''
 
     class AllUsers:
@@ -57,7 +98,53 @@ class ServerStorage:
             self.sent = 0
             self.accepted = 0
 
-    def __init__(self, path):
+    class Mailbox:
+        '''Класс - отображение таблицы почтового ящика.'''
+
+        def __init__(self, recipient, created, message):
+            self.id = None
+            self.recipient = recipient
+            self.created = created
+            self.message = message
+
+    class Changes:
+        '''
+        Класс - отображение таблицы журнала изменений справочника.
+        owner - владелец списка контактов или None для списка пользователей.
+        '''
+
+        def __init__(self, owner, name, added):
+            self.id = None
+            self.owner = owner
+            self.name = name
+            self.added = added
+
+    def __init__(self, path, counters_flush_count=COUNTERS_FLUSH_COUNT,
+                 counters_flush_interval=COUNTERS_FLUSH_INTERVAL, mailbox_ttl=MAILBOX_TTL,
+                 mailbox_quota=MAILBOX_QUOTA, mailbox_max_bytes=MAILBOX_MAX_BYTES,
+                 storage_profile=None):
+        # Незаписанные приращения счётчиков статистики:
+        # {имя пользователя: [отправлено, принято]}
+        self.counters = dict()
+        self.counters_messages = 0
+        self.counters_flush_count = counters_flush_count
+        self.counters_flush_interval = counters_flush_interval
+        self.counters_flush_time = time.time() + counters_flush_interval
+        # Пачки счётчиков, переданные в поток записи, но ещё не записанные
+        self.counters_flushing = []
+        # Счётчики меняет поток сервера, а читает и сбрасывает ещё и GUI
+        self.counters_lock = threading.Lock()
+        # Пачки, которые поток записи уже записывает (id пачки): они могут
+        # быть в базе, а могут ещё нет. Номер поколения растёт при начале
+        # записи каждой пачки (см. message_history).
+        self.counters_writing = set()
+        self.counters_generation = 0
+        self.counters_written = threading.Condition(self.counters_lock)
+        # Ограничения почтового ящика
+        self.mailbox_ttl = mailbox_ttl
+        self.mailbox_quota = mailbox_quota
+        self.mailbox_max_bytes = mailbox_max_bytes
+
         # Создаём движок базы данных
         self.database_engine = create_engine(
             f'sqlite:///{path}',
@@ -65,6 +152,8 @@ class ServerStorage:
             pool_recycle=7200,
             connect_args={
                 'check_same_thread': False})
+        # Параметры SQLite (WAL, synchronous, кэш) для каждого подключения
+        apply_profile(self.database_engine, storage_profile)
 
         # Создаём объект MetaData
         self.metadata = MetaData()
@@ -111,8 +200,28 @@ class ServerStorage:
                                     Column('accepted', Integer)
                                     )
 
-        # Создаём таблицы
+        # Создаём таблицу почтового ящика: сообщение хранится телом
+        # двоичного кодека, created - время постановки (time.time())
+        mailbox_table = Table('Mailbox', self.metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('recipient', ForeignKey('Users.id')),
+                              Column('created', Float),
+                              Column('message', LargeBinary)
+                              )
+
+        # Создаём таблицу журнала изменений справочника. Номера записей
+        # не используются повторно (AUTOINCREMENT): номер - версия справочника
+        changes_table = Table('Changes', self.metadata,
+                              Column('id', Integer, primary_key=True),
+                              Column('owner', ForeignKey('Users.id'), nullable=True),
+                              Column('name', String),
+                              Column('added', Boolean),
+                              sqlite_autoincrement=True
+                              )
+
+        # Создаём таблицы и недостающие индексы
         self.metadata.create_all(self.database_engine)
+        create_indexes(self.database_engine, INDEXES)
 
         # Создаём отображения
         mapper(self.AllUsers, users_table)
@@ -120,168 +229,391 @@ class ServerStorage:
         mapper(self.LoginHistory, user_login_history)
         mapper(self.UsersContacts, contacts)
         mapper(self.UsersHistory, users_history_table)
+        mapper(self.Mailbox, mailbox_table)
+        mapper(self.Changes, changes_table)
 
-        # Создаём сессию
+        # Создаём сессии: session для чтения, write_session только для
+        # потока записи
         Session = sessionmaker(bind=self.database_engine)
         self.session = Session()
+        self.write_session = Session()
 
         # Если в таблице активных пользователей есть записи, то их необходимо
         # удалить
         self.session.query(self.ActiveUsers).delete()
+        # Просроченные сообщения почтового ящика тоже удаляем
+        self.session.query(self.Mailbox).filter(
+            self.Mailbox.created < time.time() - self.mailbox_ttl).delete()
         self.session.commit()
 
+        # Справочник пользователей {имя: UserRecord}
+        self.users = {
+            name: UserRecord(user_id, passwd_hash, pubkey, last_login)
+            for name, user_id, passwd_hash, pubkey, last_login in self.session.query(
+                self.AllUsers.name,
+                self.AllUsers.id,
+                self.AllUsers.passwd_hash,
+                self.AllUsers.pubkey,
+                self.AllUsers.last_login)}
+        # Действия, выполняемые потоком записи после commit текущей группы
+        self.after_commit = []
+
+        # Очередь изменений (Future, метод, аргументы) и поток записи
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def submit(self, method, *args):
+        '''
+        Постановка изменения в очередь потока записи.
+        Возвращает Future, завершаемый после commit группы изменений.
+        '''
+        future = Future()
+        self.writes.put((future, method, args))
+        return future
+
+    def write_loop(self):
+        '''Основной цикл потока записи.'''
+        while True:
+            batch = [self.writes.get()]
+            # Забираем всё, что успело накопиться, одной группой
+            while len(batch) < WRITE_BATCH_SIZE:
+                try:
+                    batch.append(self.writes.get_nowait())
+                except queue.Empty:
+                    break
+            # None - сигнал остановки потока (close)
+            stop = None in batch
+            self.apply_writes([item for item in batch if item is not None])
+            if stop:
+                return
+
+    def apply_writes(self, batch):
+        '''Применение группы изменений одной транзакцией.'''
+        results = []
+        try:
+            for future, method, args in batch:
+                results.append(method(*args))
+            self.commit_writes()
+        except Exception:
+            self.rollback_writes()
+            # Повторяем изменения по одному, чтобы ошибка одного из них
+            # не отменила остальные
+            for future, method, args in batch:
+                try:
+                    result = method(*args)
+                    self.commit_writes()
+                except Exception as err:
+                    self.rollback_writes()
+                    future.set_exception(err)
+                else:
+                    future.set_result(result)
+            return
+        for (future, method, args), result in zip(batch, results):
+            future.set_result(result)
+
+    def commit_writes(self):
+        '''Commit группы изменений и обновление справочника пользователей.'''
+        self.write_session.commit()
+        actions, self.after_commit = self.after_commit, []
+        for action in actions:
+            action()
+
+    def rollback_writes(self):
+        '''Откат группы изменений, справочник пользователей не меняется.'''
+        self.write_session.rollback()
+        self.after_commit = []
+
+    def _user_id(self, name):
+        '''
+        ID пользователя для потока записи. Пользователь мог быть добавлен
+        в текущей, ещё не завершённой группе, тогда его нет в справочнике.
+        '''
+        record = self.users.get(name)
+        if record:
+            return record.id
+        return self.write_session.query(self.AllUsers.id).filter_by(name=name).scalar()
+
+    def close(self):
+        '''Запись накопленных изменений и остановка потока записи.'''
+        self.flush_counters(force=True)
+        self.writes.put(None)
+        self.writer.join()
+
     def user_login(self, username, ip_address, port, key=None):
         """
         Метод выполняющийся при входе пользователя, записывает в базу факт входа
-        обновляет открытый ключ пользователя при его изменении.
+        обновляет открытый ключ пользователя при его изменении. Смена ключа
+        записывается в журнал изменений, как повторное добавление
+        пользователя: клиенты, сохранившие старый ключ, узнают о смене
+        при синхронизации списков.
+        Возвращает Future записи.
         """
-        # Запрос в таблицу пользователей на наличие там пользователя с таким
-        # именем
-        rez = self.session.query(self.AllUsers).filter_by(name=username)
-
-        # Если имя пользователя уже присутствует в таблице, обновляем время последнего входа
-        # и проверяем корректность ключа. Если клиент прислал новый ключ,
-        # сохраняем его.
-        if rez.count():
-            user = rez.first()
-            user.last_login = datetime.datetime.now()
-            if key and user.pubkey != key:
-                user.pubkey = key
-        # Если нет, то генерируем исключение
-        else:
+        return self.submit(self._user_login, username, ip_address, port, key)
+
+    def _user_login(self, username, ip_address, port, key):
+        # Пользователь ищется в справочнике, если его нет, то генерируем исключение
+        user = self.users.get(username)
+        if not user:
             raise ValueError('Пользователь не зарегистрирован.')
 
+        # Обновляем время последнего входа и проверяем корректность ключа.
+        # Если клиент прислал новый ключ, сохраняем его.
+        login_time = datetime.datetime.now()
+        changes = {self.AllUsers.last_login: login_time}
+        # Ключ сравнивается с записанным в базе: справочник мог быть
+        # обновлён раньше (cache_pubkey при входе или от другого процесса)
+        pubkey = self.write_session.query(self.AllUsers.pubkey).filter_by(id=user.id).scalar()
+        if key and pubkey != key:
+            pubkey = key
+            changes[self.AllUsers.pubkey] = key
+            self.write_session.add(self.Changes(None, username, True))
+        self.write_session.query(self.AllUsers).filter_by(id=user.id).update(
+            changes, synchronize_session=False)
+
         # Теперь можно создать запись в таблицу активных пользователей о факте
         # входа.
         new_active_user = self.ActiveUsers(
-            user.id, ip_address, port, datetime.datetime.now())
-        self.session.add(new_active_user)
+            user.id, ip_address, port, login_time)
+        self.write_session.add(new_active_user)
 
         # и сохранить в историю входов
         history = self.LoginHistory(
-            user.id, datetime.datetime.now(), ip_address, port)
-        self.session.add(history)
+            user.id, login_time, ip_address, port)
+        self.write_session.add(history)
 
-        # Сохраняем изменения
-        self.session.commit()
+        self.after_commit.append(lambda: self.users.__setitem__(
+            username, user._replace(pubkey=pubkey, last_login=login_time)))
 
     def add_user(self, name, passwd_hash):
         """
         Метод регистрации пользователя.
         Принимает имя и хэш пароля, создаёт запись в таблице статистики.
+        Возвращает Future записи.
         """
+        return self.submit(self._add_user, name, passwd_hash)
+
+    def _add_user(self, name, passwd_hash):
         user_row = self.AllUsers(name, passwd_hash)
-        self.session.add(user_row)
-        self.session.commit()
+        self.write_session.add(user_row)
+        self.write_session.flush()
         history_row = self.UsersHistory(user_row.id)
-        self.session.add(history_row)
-        self.session.commit()
+        self.write_session.add(history_row)
+        self.write_session.add(self.Changes(None, name, True))
+        record = UserRecord(user_row.id, passwd_hash, None, user_row.last_login)
+        self.after_commit.append(lambda: self.users.__setitem__(name, record))
 
     def remove_user(self, name):
-        """Метод удаляющий пользователя из базы."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
-        self.session.query(self.LoginHistory).filter_by(name=user.id).delete()
-        self.session.query(self.UsersContacts).filter_by(user=user.id).delete()
-        self.session.query(
+        """Метод удаляющий пользователя из базы. Возвращает Future записи."""
+        with self.counters_lock:
+            self.counters.pop(name, None)
+        return self.submit(self._remove_user, name)
+
+    def _remove_user(self, name):
+        user_id = self._user_id(name)
+        self.write_session.query(self.ActiveUsers).filter_by(user=user_id).delete()
+        self.write_session.query(self.LoginHistory).filter_by(name=user_id).delete()
+        self.write_session.query(self.UsersContacts).filter_by(user=user_id).delete()
+        # Пользователь исчезает и из чужих списков контактов
+        for owner, in self.write_session.query(
+                self.UsersContacts.user).filter_by(contact=user_id).all():
+            self.write_session.add(self.Changes(owner, name, False))
+        self.write_session.query(
             self.UsersContacts).filter_by(
-            contact=user.id).delete()
-        self.session.query(self.UsersHistory).filter_by(user=user.id).delete()
-        self.session.query(self.AllUsers).filter_by(name=name).delete()
-        self.session.commit()
+            contact=user_id).delete()
+        self.write_session.query(self.Changes).filter_by(owner=user_id).delete()
+        self.write_session.add(self.Changes(None, name, False))
+        self.write_session.query(self.UsersHistory).filter_by(user=user_id).delete()
+        self.write_session.query(self.Mailbox).filter_by(recipient=user_id).delete()
+        self.write_session.query(self.AllUsers).filter_by(name=name).delete()
+        self.after_commit.append(lambda: self.users.pop(name, None))
 
     def get_hash(self, name):
         """Метод получения хэша пароля пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.passwd_hash
+        user = self.users.get(name)
+        return user.passwd_hash if user else None
 
     def get_pubkey(self, name):
         """Метод получения публичного ключа пользователя."""
-        user = self.session.query(self.AllUsers).filter_by(name=name).first()
-        return user.pubkey
+        user = self.users.get(name)
+        return user.pubkey if user else None
+
+    def cache_pubkey(self, name, pubkey):
+        """
+        Метод обновления ключа в справочнике без записи в базу. Нужен, когда
+        ключ сохранил другой рабочий процесс сервера.
+        """
+        user = self.users.get(name)
+        if user and user.pubkey != pubkey:
+            self.users[name] = user._replace(pubkey=pubkey)
 
     def check_user(self, name):
         """Метод проверяющий существование пользователя."""
-        if self.session.query(self.AllUsers).filter_by(name=name).count():
-            return True
-        else:
-            return False
+        return name in self.users
 
     def user_logout(self, username):
-        """Метод фиксирующий отключения пользователя."""
-        # Запрашиваем пользователя, что покидает нас
-        user = self.session.query(
-            self.AllUsers).filter_by(
-            name=username).first()
+        """Метод фиксирующий отключения пользователя. Возвращает Future записи."""
+        return self.submit(self._user_logout, username)
 
-        # Удаляем его из таблицы активных пользователей.
-        self.session.query(self.ActiveUsers).filter_by(user=user.id).delete()
-
-        # Применяем изменения
-        self.session.commit()
+    def _user_logout(self, username):
+        # Удаляем пользователя, что покидает нас, из таблицы активных пользователей.
+        self.write_session.query(self.ActiveUsers).filter_by(
+            user=self._user_id(username)).delete()
 
     def process_message(self, sender, recipient):
-        """Метод записывающий в таблицу статистики факт передачи сообщения."""
-        # Получаем ID отправителя и получателя
-        sender = self.session.query(
-            self.AllUsers).filter_by(
-            name=sender).first().id
-        recipient = self.session.query(
-            self.AllUsers).filter_by(
-            name=recipient).first().id
-        # Запрашиваем строки из истории и увеличиваем счётчики
-        sender_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=sender).first()
-        sender_row.sent += 1
-        recipient_row = self.session.query(
-            self.UsersHistory).filter_by(
-            user=recipient).first()
-        recipient_row.accepted += 1
+        """
+        Метод фиксирующий в статистике факт передачи сообщения.
+        Счётчики увеличиваются в памяти, в базу они записываются
+        после counters_flush_count сообщений или по таймеру.
+        """
+        with self.counters_lock:
+            self.counters.setdefault(sender, [0, 0])[0] += 1
+            self.counters.setdefault(recipient, [0, 0])[1] += 1
+            self.counters_messages += 1
+            flush = self.counters_messages >= self.counters_flush_count
+        if flush:
+            self.flush_counters(force=True)
+
+    def flush_counters(self, force=False):
+        """
+        Метод записи накопленных счётчиков статистики в базу одной транзакцией.
+        Возвращает Future записи или None, если записывать нечего.
+        Без force запись выполняется, только если истёк интервал
+        counters_flush_interval, поэтому его можно вызывать на каждом
+        проходе цикла сервера.
+        """
+        if not force and time.time() < self.counters_flush_time:
+            return
+        with self.counters_lock:
+            counters = self.counters
+            self.counters = dict()
+            self.counters_messages = 0
+            self.counters_flush_time = time.time() + self.counters_flush_interval
+            if not counters:
+                return
+            # До записи пачка остаётся видимой для message_history
+            self.counters_flushing.append(counters)
+        future = self.submit(self._write_counters, counters)
+        future.add_done_callback(lambda done: self._counters_written(counters))
+        return future
+
+    def _counters_written(self, counters):
+        '''Удаление записанной пачки из списка ожидающих записи.'''
+        with self.counters_written:
+            self.counters_flushing.remove(counters)
+            self.counters_writing.discard(id(counters))
+            self.counters_written.notify_all()
+
+    def _write_counters(self, counters):
+        with self.counters_lock:
+            self.counters_writing.add(id(counters))
+            self.counters_generation += 1
+        for name, (sent, accepted) in counters.items():
+            user_id = self._user_id(name)
+            if user_id is None:
+                continue
+            self.write_session.query(self.UsersHistory).filter_by(user=user_id).update({
+                self.UsersHistory.sent: self.UsersHistory.sent + sent,
+                self.UsersHistory.accepted: self.UsersHistory.accepted + accepted
+            }, synchronize_session=False)
+
+    def store_message(self, recipient, message):
+        """
+        Метод сохранения сообщения в почтовый ящик получателя.
+        Возвращает Future записи, завершаемый ошибкой ValueError, если
+        получатель не зарегистрирован или его ящик переполнен.
+        """
+        return self.submit(self._store_message, recipient, encode_body(message, CODEC_BINARY))
 
-        self.session.commit()
+    def _store_message(self, recipient, data):
+        user_id = self._user_id(recipient)
+        if user_id is None:
+            raise ValueError('Пользователь не зарегистрирован.')
+        now = time.time()
+        # Просроченные сообщения получателя не занимают место в ящике
+        self.write_session.query(self.Mailbox).filter(
+            self.Mailbox.recipient == user_id,
+            self.Mailbox.created < now - self.mailbox_ttl).delete()
+        count, size = self.write_session.query(
+            func.count(self.Mailbox.id),
+            func.coalesce(func.sum(func.length(self.Mailbox.message)), 0)
+        ).filter_by(recipient=user_id).one()
+        if count >= self.mailbox_quota or size + len(data) > self.mailbox_max_bytes:
+            raise ValueError('Почтовый ящик получателя переполнен.')
+        self.write_session.add(self.Mailbox(user_id, now, data))
+
+    def get_mailbox(self, username):
+        """
+        Метод получения сообщений из почтового ящика пользователя.
+        Чтение выполняет поток записи, поэтому в результат попадают все
+        сообщения, сохранённые до вызова. Возвращает Future со списком
+        кортежей (id, сообщение) в порядке поступления.
+        """
+        return self.submit(self._get_mailbox, username)
+
+    def _get_mailbox(self, username):
+        user_id = self._user_id(username)
+        query = self.write_session.query(self.Mailbox.id, self.Mailbox.message).filter(
+            self.Mailbox.recipient == user_id,
+            self.Mailbox.created >= time.time() - self.mailbox_ttl
+        ).order_by(self.Mailbox.id)
+        return [(message_id, decode_body(data, CODEC_BINARY)) for message_id, data in query]
+
+    def remove_mailbox(self, ids):
+        """Метод удаления доставленных сообщений почтового ящика. Возвращает Future записи."""
+        return self.submit(self._remove_mailbox, list(ids))
+
+    def _remove_mailbox(self, ids):
+        # Частями: число параметров запроса SQLite ограничено
+        for start in range(0, len(ids), 500):
+            self.write_session.query(self.Mailbox).filter(
+                self.Mailbox.id.in_(ids[start:start + 500])).delete(synchronize_session=False)
 
     def add_contact(self, user, contact):
-        """Метод добавления контакта для пользователя."""
+        """Метод добавления контакта для пользователя. Возвращает Future записи."""
+        return self.submit(self._add_contact, user, contact)
+
+    def _add_contact(self, user, contact):
+        contact_name = contact
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user = self._user_id(user)
+        contact = self._user_id(contact)
 
         # Проверяем что не дубль и что контакт может существовать (полю
         # пользователь мы доверяем)
-        if not contact or self.session.query(
+        if contact is None or self.write_session.query(
                 self.UsersContacts).filter_by(
-                user=user.id,
-                contact=contact.id).count():
+                user=user,
+                contact=contact).count():
             return
 
         # Создаём объект и заносим его в базу
-        contact_row = self.UsersContacts(user.id, contact.id)
-        self.session.add(contact_row)
-        self.session.commit()
+        contact_row = self.UsersContacts(user, contact)
+        self.write_session.add(contact_row)
+        self.write_session.add(self.Changes(user, contact_name, True))
 
     # Функция удаляет контакт из базы данных
     def remove_contact(self, user, contact):
-        """Метод удаления контакта пользователя."""
+        """Метод удаления контакта пользователя. Возвращает Future записи."""
+        return self.submit(self._remove_contact, user, contact)
+
+    def _remove_contact(self, user, contact):
+        contact_name = contact
         # Получаем ID пользователей
-        user = self.session.query(self.AllUsers).filter_by(name=user).first()
-        contact = self.session.query(
-            self.AllUsers).filter_by(
-            name=contact).first()
+        user = self._user_id(user)
+        contact = self._user_id(contact)
 
         # Проверяем что контакт может существовать (полю пользователь мы
         # доверяем)
-        if not contact:
+        if contact is None:
             return
 
         # Удаляем требуемое
-        self.session.query(self.UsersContacts).filter(
-            self.UsersContacts.user == user.id,
-            self.UsersContacts.contact == contact.id
-        ).delete()
-        self.session.commit()
+        if self.write_session.query(self.UsersContacts).filter(
+                self.UsersContacts.user == user,
+                self.UsersContacts.contact == contact
+        ).delete():
+            self.write_session.add(self.Changes(user, contact_name, False))
 
     def users_list(self):
         """Метод возвращающий список известных пользователей со временем последнего входа."""
@@ -323,8 +655,11 @@ class ServerStorage:
 
     def get_contacts(self, username):
         """Метод возвращающий список контактов пользователя."""
-        # Запрашиваем указанного пользователя
-        user = self.session.query(self.AllUsers).filter_by(name=username).one()
+        # ID указанного пользователя берём из справочника. Пользователь
+        # может быть удалён, пока его клиент ещё подключён - контактов нет
+        user = self.users.get(username)
+        if user is None:
+            return []
 
         # Запрашиваем его список контактов
         query = self.session.query(self.UsersContacts, self.AllUsers.name). \
@@ -334,16 +669,77 @@ class ServerStorage:
         # выбираем только имена пользователей и возвращаем их.
         return [contact[1] for contact in query.all()]
 
+    def get_changes(self, username, version):
+        """
+        Метод получения изменений списков пользователей и контактов
+        пользователя после версии справочника version.
+        Возвращает кортеж (версия, полные списки или нет, пользователи,
+        контакты), где пользователи и контакты - пары списков (добавленные,
+        удалённые). Полные списки отдаются клиенту без версии (0) и клиенту,
+        чья версия больше текущей (база сервера заменена).
+        Неизвестный (например, удалённый) пользователь - ValueError.
+        """
+        user = self.users.get(username)
+        if user is None:
+            raise ValueError('Пользователь не зарегистрирован.')
+        # Версия читается до списков: изменение, попавшее в списки после
+        # неё, клиент получит ещё раз, применение изменений повторяемо
+        current = self.session.query(func.max(self.Changes.id)).scalar() or 0
+        if not version or version > current:
+            return current, True, ([row[0] for row in self.users_list()], []), \
+                (self.get_contacts(username), [])
+        lists = []
+        for owner in (None, user.id):
+            # По журналу важно только последнее изменение каждого имени
+            changes = dict()
+            for name, added in self.session.query(
+                    self.Changes.name, self.Changes.added
+            ).filter(
+                self.Changes.owner == owner,
+                self.Changes.id > version
+            ).order_by(self.Changes.id):
+                changes[name] = added
+            lists.append((
+                [name for name, added in changes.items() if added],
+                [name for name, added in changes.items() if not added]))
+        return (current, False) + tuple(lists)
+
     def message_history(self):
-        """Метод возвращающий статистику сообщений."""
+        """
+        Метод возвращающий статистику сообщений.
+        К значениям из базы добавляются ещё не записанные счётчики.
+        """
         query = self.session.query(
             self.AllUsers.name,
             self.AllUsers.last_login,
             self.UsersHistory.sent,
             self.UsersHistory.accepted
         ).join(self.AllUsers)
+        while True:
+            # Незаписанные счётчики суммируем до запроса. Пачка, запись
+            # которой уже началась, может оказаться в базе, поэтому ждём
+            # окончания её записи: оставшиеся пачки в базе ещё не видны.
+            counters = dict()
+            with self.counters_written:
+                self.counters_written.wait_for(lambda: not self.counters_writing)
+                generation = self.counters_generation
+                for pending in self.counters_flushing + [self.counters]:
+                    for name, (sent, accepted) in pending.items():
+                        total = counters.setdefault(name, [0, 0])
+                        total[0] += sent
+                        total[1] += accepted
+            rows = query.all()
+            # Если во время запроса началась запись пачки, она могла попасть
+            # и в запрос, и в снимок - повторяем
+            with self.counters_lock:
+                if generation == self.counters_generation:
+                    break
         # Возвращаем список кортежей
-        return query.all()
+        history = []
+        for name, last_login, sent, accepted in rows:
+            pending_sent, pending_accepted = counters.get(name, (0, 0))
+            history.append((name, last_login, sent + pending_sent, accepted + pending_accepted))
+        return history
 
 
 # Отладка
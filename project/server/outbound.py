@@ -0,0 +1,155 @@
+import tempfile
+import logging
+from collections import deque
+
+# Подключение логирования
+LOG = logging.getLogger('app.server')
+
+# Политики обработки клиента, не успевающего принимать данные
+POLICY_DROP = 'drop'
+POLICY_DISCONNECT = 'disconnect'
+POLICY_SPILL = 'spill'
+OVERFLOW_POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_SPILL)
+
+
+class OutboundQueue:
+    """
+    Очередь исходящих байтов одного соединения.
+    Данные добавляются целыми сообщениями (push) и отправляются по мере
+    готовности сокета к записи, с учётом частичной отправки.
+    Когда объём очереди превышает верхнюю границу (high_watermark),
+    применяется политика:
+    * drop - новые сообщения отбрасываются, пока очередь не опустится
+      ниже нижней границы (low_watermark);
+    * disconnect - push возвращает False, клиента следует отключить;
+    * spill - излишек пишется во временный файл и подгружается обратно
+      по мере отправки.
+    """
+
+    def __init__(self, high_watermark, low_watermark, policy=POLICY_DISCONNECT):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f'Неизвестная политика переполнения: {policy}')
+        if low_watermark > high_watermark:
+            raise ValueError('Нижняя граница очереди больше верхней')
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.policy = policy
+        # Байты в памяти, первый элемент может быть отправлен частично
+        self.chunks = deque()
+        self.size = 0
+        # Режим отбрасывания (для политики drop) и счётчик отброшенного
+        self.dropping = False
+        self.dropped = 0
+        # Временный файл для политики spill: запись в конец, чтение с read_pos
+        self.spill_file = None
+        self.spill_size = 0
+        self.spill_read_pos = 0
+
+    def __len__(self):
+        return self.size + self.spill_size
+
+    def __bool__(self):
+        return bool(self.size or self.spill_size)
+
+    def push(self, data, compressor=None):
+        """
+        Добавление сообщения в очередь.
+        Возвращает False, если клиент отстал слишком сильно и по политике
+        disconnect его нужно отключить.
+        compressor - поток сжатия соединения (FrameCompressor), которым
+        сжаты данные: если они отбрасываются, поток сбрасывается, иначе
+        получатель не сможет распаковать следующие кадры.
+        """
+        if self.spill_size:
+            # Порядок сообщений сохраняется: пока есть данные в файле,
+            # новые тоже идут в файл.
+            self._spill(data)
+            return True
+        if self.dropping and self.size > self.low_watermark:
+            self._drop(compressor)
+            return True
+        self.dropping = False
+        # Одиночное сообщение больше границы принимаем в пустую очередь,
+        # иначе его невозможно будет доставить вовсе.
+        if self.size and self.size + len(data) > self.high_watermark:
+            if self.policy == POLICY_DISCONNECT:
+                return False
+            if self.policy == POLICY_DROP:
+                LOG.warning('Очередь клиента переполнена, сообщения отбрасываются.')
+                self.dropping = True
+                self._drop(compressor)
+                return True
+            self._spill(data)
+            return True
+        self.chunks.append(memoryview(data))
+        self.size += len(data)
+        return True
+
+    def peek(self):
+        """Первый неотправленный кусок данных (memoryview)."""
+        return self.chunks[0]
+
+    def consume(self, count):
+        """Удаление из начала очереди count отправленных байтов."""
+        self.size -= count
+        while count:
+            chunk = self.chunks[0]
+            if count < len(chunk):
+                self.chunks[0] = chunk[count:]
+                break
+            count -= len(chunk)
+            self.chunks.popleft()
+        # Пустая очередь подгружается при любой нижней границе, в том числе 0
+        if self.spill_size and (not self.size or self.size < self.low_watermark):
+            self._unspill()
+
+    def send(self, sock):
+        """
+        Отправка данных в неблокирующий сокет, пока он принимает данные.
+        Возвращает True, если очередь опустела.
+        """
+        while self.chunks:
+            try:
+                sent = sock.send(self.peek())
+            except (BlockingIOError, InterruptedError):
+                return False
+            self.consume(sent)
+        return True
+
+    def close(self):
+        """Освобождение ресурсов очереди."""
+        self.chunks.clear()
+        self.size = 0
+        if self.spill_file:
+            self.spill_file.close()
+            self.spill_file = None
+            self.spill_size = 0
+
+    def _drop(self, compressor):
+        """Учёт отброшенного сообщения и сброс потока сжатия."""
+        self.dropped += 1
+        if compressor is not None:
+            compressor.reset()
+
+    def _spill(self, data):
+        """Запись излишка во временный файл."""
+        if self.spill_file is None:
+            LOG.warning('Очередь клиента переполнена, данные сбрасываются на диск.')
+            self.spill_file = tempfile.TemporaryFile()
+            self.spill_read_pos = 0
+        self.spill_file.seek(0, 2)
+        self.spill_file.write(data)
+        self.spill_size += len(data)
+
+    def _unspill(self):
+        """Подгрузка данных из временного файла до верхней границы."""
+        self.spill_file.seek(self.spill_read_pos)
+        data = self.spill_file.read(
+            min(self.spill_size, max(self.high_watermark - self.size, 1)))
+        self.spill_read_pos += len(data)
+        self.spill_size -= len(data)
+        self.chunks.append(memoryview(data))
+        self.size += len(data)
+        if not self.spill_size:
+            self.spill_file.close()
+            self.spill_file = None
@@ -0,0 +1,116 @@
+from common.variables import CODEC_JSON
+
+
+class ClientConnection:
+    """
+    Состояние одного подключения к серверу.
+    sock - сокет (или StreamWriter в asyncio версии сервера),
+    decoder и outbound - входящий и исходящий потоки соединения,
+    name и authenticated заполняются при успешной авторизации,
+    auth_state - состояние незавершённой авторизации
+    (сообщение presence, ожидаемый хэш, срок ответа),
+    codec и compressor - кодек и сжатие исходящих сообщений
+    (FrameCompressor или None), выбранные при авторизации,
+    watching - имена, о присутствии которых клиент получает уведомления
+    (его контакты), events - накопленные для него уведомления {имя: событие}.
+    """
+    __slots__ = ('sock', 'address', 'decoder', 'outbound', 'name',
+                 'authenticated', 'auth_state', 'codec', 'compressor',
+                 'watching', 'events')
+
+    def __init__(self, sock, address, decoder, outbound):
+        self.sock = sock
+        self.address = address
+        self.decoder = decoder
+        self.outbound = outbound
+        self.name = None
+        self.authenticated = False
+        self.auth_state = None
+        self.codec = CODEC_JSON
+        self.compressor = None
+        self.watching = set()
+        self.events = dict()
+
+    def __repr__(self):
+        return f'<ClientConnection {self.name or "-"} {self.address}>'
+
+
+class ConnectionRegistry:
+    """
+    Реестр подключений сервера.
+    Хранит множество подключений и двусторонний индекс
+    имя пользователя <-> подключение, все операции за O(1).
+    Подписки на присутствие хранятся обратным индексом: имя -> подключения,
+    у которых это имя в контактах.
+    """
+
+    def __init__(self):
+        self.connections = set()
+        # {'test1': <ClientConnection test1 ('127.0.0.1', 52420)>}
+        self.names = dict()
+        # {'test2': {<ClientConnection test1 ('127.0.0.1', 52420)>}}
+        self.watchers = dict()
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __iter__(self):
+        return iter(list(self.connections))
+
+    def __contains__(self, connection):
+        return connection in self.connections
+
+    def add(self, connection):
+        """Регистрация нового подключения."""
+        self.connections.add(connection)
+
+    def authenticate(self, connection, name):
+        """Привязка подключения к имени авторизованного пользователя."""
+        connection.name = name
+        connection.authenticated = True
+        connection.auth_state = None
+        self.names[name] = connection
+
+    def get(self, name):
+        """Подключение пользователя по имени или None."""
+        return self.names.get(name)
+
+    def subscribe(self, connection, names):
+        """Подписка подключения на уведомления о пользователях names."""
+        for name in names:
+            connection.watching.add(name)
+            self.watchers.setdefault(name, set()).add(connection)
+
+    def unsubscribe(self, connection, names):
+        """Отмена подписки подключения на уведомления о пользователях names."""
+        for name in names:
+            connection.watching.discard(name)
+            watchers = self.watchers.get(name)
+            if watchers is not None:
+                watchers.discard(connection)
+                if not watchers:
+                    del self.watchers[name]
+
+    def watching(self, name):
+        """Подключения, подписанные на уведомления о пользователе name."""
+        return list(self.watchers.get(name, ()))
+
+    def forget(self, name):
+        """Отмена всех подписок на пользователя name (пользователь удалён)."""
+        for connection in self.watchers.pop(name, ()):
+            connection.watching.discard(name)
+
+    def remove(self, connection):
+        """
+        Удаление подключения из реестра.
+        Возвращает False, если подключение уже было удалено.
+        """
+        if connection not in self.connections:
+            return False
+        self.connections.discard(connection)
+        if connection.authenticated and self.names.get(connection.name) is connection:
+            del self.names[connection.name]
+        self.unsubscribe(connection, list(connection.watching))
+        connection.authenticated = False
+        connection.auth_state = None
+        return True
@@ -46,13 +46,12 @@ class DelUserDialog(QDialog):
 
     def remove_user(self):
         '''Метод - обработчик удаления пользователя.'''
-        self.database.remove_user(self.selector.currentText())
-        if self.selector.currentText() in self.server.names:
-            sock = self.server.names[self.selector.currentText()]
-            del self.server.names[self.selector.currentText()]
-            self.server.remove_client(sock)
-        # Рассылаем клиентам сообщение о необходимости обновить справочники
-        self.server.service_update_lists()
+        self.database.remove_user(self.selector.currentText()).result()
+        client = self.server.names.get(self.selector.currentText())
+        if client:
+            self.server.remove_client(client)
+        # Уведомляем клиентов, у которых пользователь был в контактах
+        self.server.user_removed(self.selector.currentText())
         self.close()
 
 
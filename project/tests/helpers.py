@@ -0,0 +1,111 @@
+""" Общее окружение тестов: временный каталог для баз и логов, запуск сервера """
+import sys
+import os
+import binascii
+import hashlib
+import hmac
+import socket
+import tempfile
+import time
+
+# Логи и базы тестов пишутся во временный каталог, а не в каталоги проекта.
+# Переменная окружения должна быть задана до импорта модулей с логированием.
+TEMP_DIR = tempfile.mkdtemp(prefix='messenger_tests_')
+os.environ['MESSENGER_LOG_DIR'] = TEMP_DIR
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from common.variables import ACTION, PRESENCE, TIME, USER, ACCOUNT_NAME, PUBLIC_KEY, DATA
+from common.utils import MessageDecoder, get_message, send_message
+from common.responses import auth_511
+from client.database import ClientDatabase
+from server.database import ServerStorage
+
+# Классические отображения создаются один раз на процесс,
+# поэтому все тесты работают с одной базой сервера и одной базой клиента.
+_SERVER_DATABASE = None
+_CLIENT_DATABASE = None
+
+
+def server_database():
+    """ База сервера с пользователями test1 и test2 (пароль - имя пользователя) """
+    global _SERVER_DATABASE
+    if _SERVER_DATABASE is None:
+        _SERVER_DATABASE = ServerStorage(os.path.join(TEMP_DIR, 'test_server.db3'),
+                                         counters_flush_count=3, counters_flush_interval=3600)
+        for name in ('test1', 'test2'):
+            _SERVER_DATABASE.add_user(name, password_hash(name, name)).result()
+    return _SERVER_DATABASE
+
+
+def client_database():
+    """ База клиента во временном каталоге """
+    global _CLIENT_DATABASE
+    if _CLIENT_DATABASE is None:
+        _CLIENT_DATABASE = ClientDatabase('test', path=TEMP_DIR)
+    return _CLIENT_DATABASE
+
+
+def password_hash(name, password):
+    """ Хэш пароля в том виде, в котором его хранит сервер """
+    return binascii.hexlify(hashlib.pbkdf2_hmac(
+        'sha512', password.encode('utf-8'), name.lower().encode('utf-8'), 10000))
+
+
+def free_port():
+    """ Свободный порт для тестового сервера """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(engine, **kwargs):
+    """ Запуск сервера класса engine на свободном порту """
+    server = engine('127.0.0.1', free_port(), server_database(), **kwargs)
+    server.daemon = True
+    server.start()
+    return server
+
+
+def stop_server(server):
+    """ Остановка сервера и ожидание его потока и записи выхода клиентов в базу """
+    server.running = False
+    server.join()
+    server.database.submit(lambda: None).result()
+
+
+def connect(server, timeout=5):
+    """ Подключение к тестовому серверу, ожидающее открытия его порта """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            sock = socket.create_connection(('127.0.0.1', server.port), timeout=timeout)
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+        else:
+            return sock
+
+
+def auth_digest(name, challenge):
+    """ Ответ пользователя name (пароль - имя) на запрос авторизации 511 """
+    digest = hmac.new(password_hash(name, name), challenge[DATA].encode('utf-8'), 'MD5').digest()
+    return binascii.b2a_base64(digest).decode('ascii')
+
+
+def login(server, name, pubkey='KEY'):
+    """
+    Подключение и авторизация пользователя name (пароль - имя) в формате
+    старых клиентов: JSON без кадров. Возвращает сокет, декодер и ответ сервера.
+    """
+    sock = connect(server)
+    decoder = MessageDecoder()
+    send_message(sock, {ACTION: PRESENCE, TIME: time.time(),
+                        USER: {ACCOUNT_NAME: name, PUBLIC_KEY: pubkey}})
+    challenge = get_message(sock, decoder)
+    if DATA not in challenge:
+        return sock, decoder, challenge
+    send_message(sock, auth_511(auth_digest(name, challenge)))
+    return sock, decoder, get_message(sock, decoder)
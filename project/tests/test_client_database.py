@@ -0,0 +1,65 @@
+""" Тестирование базы данных клиента """
+import sys
+import os
+import datetime
+import unittest
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from helpers import client_database
+from common.utils import key_fingerprint
+
+# Классические отображения создаются один раз на процесс,
+# поэтому все тесты работают с одной базой.
+DATABASE = client_database()
+
+
+class TestClientDatabase(unittest.TestCase):
+    """ Тестирование ClientDatabase """
+
+    def test_history_page(self):
+        """ Страницы истории идут от новых к старым, внутри страницы - по дате """
+        start = datetime.datetime(2020, 1, 1)
+        for number in range(7):
+            DATABASE.save_message('test2', 'in', f'message {number}')
+        # Два сообщения с одинаковым временем различаются по id
+        for number, row in enumerate(DATABASE.session.query(DATABASE.MessageStat).order_by(
+                DATABASE.MessageStat.id)):
+            row.date = start + datetime.timedelta(seconds=min(number, 5))
+        DATABASE.session.commit()
+        DATABASE.save_message('test3', 'out', 'other chat')
+
+        page, cursor = DATABASE.get_history_page('test2', 3)
+        self.assertEqual([row[2] for row in page], ['message 4', 'message 5', 'message 6'])
+        page, cursor = DATABASE.get_history_page('test2', 3, cursor)
+        self.assertEqual([row[2] for row in page], ['message 1', 'message 2', 'message 3'])
+        page, cursor = DATABASE.get_history_page('test2', 3, cursor)
+        self.assertEqual([row[2] for row in page], ['message 0'])
+        self.assertIsNone(cursor)
+        self.assertEqual([row[2] for row in DATABASE.get_history('test2')],
+                         [f'message {number}' for number in range(7)])
+
+    def test_save_messages(self):
+        """ Группа сообщений сохраняется в исходном порядке """
+        rows = DATABASE.save_messages([('test4', 'in', 'first'), ('test5', 'in', 'other'),
+                                       ('test4', 'in', 'second')])
+        self.assertEqual([row[:3] for row in rows], [('test4', 'in', 'first'),
+                                                     ('test5', 'in', 'other'),
+                                                     ('test4', 'in', 'second')])
+        self.assertEqual(DATABASE.get_history('test4'), rows[::2])
+
+    def test_public_keys(self):
+        """ Ключ удаляется при смене отпечатка и при изменении пользователя """
+        DATABASE.save_pubkey('test6', 'KEY6')
+        DATABASE.save_pubkey('test7', 'KEY7')
+        DATABASE.check_fingerprints({'test6': key_fingerprint('KEY6'),
+                                     'test7': key_fingerprint('NEW7')})
+        self.assertEqual(DATABASE.get_pubkey('test6'), 'KEY6')
+        self.assertIsNone(DATABASE.get_pubkey('test7'))
+        DATABASE.apply_changes(DATABASE.get_version(), False, (['test6'], []), ([], []))
+        self.assertIsNone(DATABASE.get_pubkey('test6'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+""" Тестирование транспорта клиента """
+import base64
+import sys
+import os
+import socket
+import threading
+import time
+import unittest
+from concurrent import futures
+from unittest import mock
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from helpers import client_database, server_database, start_server, stop_server, login
+from Cryptodome.PublicKey import RSA
+from PyQt5.QtCore import Qt
+from common.variables import *
+from common.utils import get_message, send_message
+from client.transport import ClientTransport
+from server.core import MessageProcessor
+
+# Генерация ключей RSA долгая, поэтому ключ общий для всех тестов
+KEYS = RSA.generate(1024)
+
+
+def start_transport(server, name):
+    """ Подключение транспорта пользователя name (пароль - имя) и запуск потока приёма """
+    transport = ClientTransport(server.port, '127.0.0.1', client_database(), name, name, KEYS)
+    transport.daemon = True
+    transport.start()
+    return transport
+
+
+def stop_transport(transport):
+    """ Остановка транспорта и ожидание его потока """
+    transport.transport_shutdown()
+    transport.join()
+    transport.transport.close()
+
+
+class TestReceiveLoop(unittest.TestCase):
+    """ Тестирование потока приёма: уведомления доставляются без опроса """
+
+    def setUp(self):
+        self.server = start_server(MessageProcessor)
+        self.transport = start_transport(self.server, 'test1')
+
+    def tearDown(self):
+        stop_transport(self.transport)
+        stop_server(self.server)
+
+    def test_push_delivery(self):
+        """ Сообщение пользователя доставляется сразу, без интервала опроса """
+        received = []
+        delivered = threading.Event()
+        # Сигналы испускаются потоками транспорта, цикла событий Qt в тестах нет
+        self.transport.new_message.connect(
+            lambda message: (received.append(message), delivered.set()), Qt.DirectConnection)
+        sock, decoder, response = login(self.server, 'test2')
+        with sock:
+            self.assertEqual(response[RESPONSE], 200)
+            started = time.monotonic()
+            send_message(sock, {ACTION: MESSAGE, SENDER: 'test2', DESTINATION: 'test1',
+                                TIME: time.time(), MESSAGE_TEXT: 'text'})
+            self.assertEqual(get_message(sock, decoder)[RESPONSE], 200)
+            self.assertTrue(delivered.wait(CONNECTION_TIMEOUT))
+            self.assertLess(time.monotonic() - started, CONNECTION_TIMEOUT)
+        self.assertEqual([(message[SENDER], message[MESSAGE_TEXT]) for message in received],
+                         [('test2', 'text')])
+
+    def test_connection_lost(self):
+        """ Поток приёма замечает закрытие соединения сервером """
+        lost = threading.Event()
+        self.transport.connection_lost.connect(lost.set, Qt.DirectConnection)
+        self.server.call_in_loop(lambda: [self.server.remove_client(client)
+                                          for client in self.server.clients])
+        self.assertTrue(lost.wait(REPLY_TIMEOUT))
+
+
+class TestRequests(unittest.TestCase):
+    """ Тестирование номеров запросов и конвейера запросов """
+
+    def setUp(self):
+        self.server = start_server(MessageProcessor)
+        self.transport = start_transport(self.server, 'test1')
+
+    def tearDown(self):
+        stop_transport(self.transport)
+        stop_server(self.server)
+
+    def test_pipelined(self):
+        """ Запросы отправляются без ожидания ответов, ответ находит свой запрос по номеру """
+        pending = [self.transport.request({ACTION: USERS_REQUEST, TIME: time.time(),
+                                           ACCOUNT_NAME: 'test1'}) for _ in range(50)]
+        pending.append(self.transport.request({ACTION: GET_CONTACTS, TIME: time.time(),
+                                               USER: 'test1'}))
+        replies = [self.transport.wait_reply(future) for future in pending]
+        self.assertEqual([reply[REQUEST_ID] for reply in replies],
+                         [future.request_id for future in pending])
+        self.assertTrue(all(reply[RESPONSE] == 202 for reply in replies))
+        self.assertIn('test2', replies[0][LIST_INFO])
+        self.assertEqual(self.transport.pending, {})
+
+    def test_dispatch(self):
+        """ Ответы по номеру, ответ без номера - самому раннему запросу, уведомление - не ответ """
+        first, second = futures.Future(), futures.Future()
+        with self.transport.pending_lock:
+            self.transport.pending[-2] = first
+            self.transport.pending[-1] = second
+        self.transport.dispatch({ACTION: MESSAGE, SENDER: 'test2', DESTINATION: 'test1',
+                                 TIME: time.time(), MESSAGE_TEXT: 'text'})
+        self.assertFalse(first.done() or second.done())
+        self.transport.dispatch({RESPONSE: 200, REQUEST_ID: -1})
+        self.assertEqual(second.result(0), {RESPONSE: 200, REQUEST_ID: -1})
+        self.assertFalse(first.done())
+        self.transport.dispatch({RESPONSE: 202, LIST_INFO: []})
+        self.assertEqual(first.result(0), {RESPONSE: 202, LIST_INFO: []})
+
+    def test_lost_connection_fails_requests(self):
+        """ При потере соединения ожидающие запросы завершаются ошибкой """
+        future = futures.Future()
+        with self.transport.pending_lock:
+            self.transport.pending[-1] = future
+        self.server.call_in_loop(lambda: [self.server.remove_client(client)
+                                          for client in self.server.clients])
+        self.assertIsInstance(future.exception(REPLY_TIMEOUT), ConnectionResetError)
+
+
+class TestReconnect(unittest.TestCase):
+    """ Тестирование переподключения и очереди исходящих """
+
+    def setUp(self):
+        self.server = start_server(MessageProcessor)
+        self.transport = start_transport(self.server, 'test1')
+
+    def tearDown(self):
+        stop_transport(self.transport)
+        stop_server(self.server)
+
+    def test_outbox_after_restart(self):
+        """ Сообщения, отправленные без соединения, уходят по порядку после переподключения """
+        lost, restored = threading.Event(), threading.Event()
+        self.transport.connection_lost.connect(lost.set, Qt.DirectConnection)
+        self.transport.connection_restored.connect(restored.set, Qt.DirectConnection)
+        port = self.server.port
+        stop_server(self.server)
+        self.assertTrue(lost.wait(REPLY_TIMEOUT))
+        texts = [f'text {number}'.encode() for number in range(3)]
+        for text in texts:
+            self.assertFalse(self.transport.send_message('test2', text))
+        self.assertEqual(len(client_database().get_outbox()), 3)
+
+        # Сервер перезапускается на том же порту
+        self.server = MessageProcessor('127.0.0.1', port, server_database())
+        self.server.daemon = True
+        self.server.start()
+        self.assertTrue(restored.wait(RECONNECT_MAX_DELAY))
+        # Сообщение удаляется из очереди после ответа сервера, а получателю
+        # не в сети сервер отвечает после записи в почтовый ящик
+        deadline = time.monotonic() + REPLY_TIMEOUT
+        while client_database().get_outbox() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertEqual(client_database().get_outbox(), [])
+
+        # Получатель не был в сети: сообщения ждут его в почтовом ящике
+        sock, decoder, response = login(self.server, 'test2')
+        with sock:
+            self.assertEqual(response[RESPONSE], 200)
+            messages = [get_message(sock, decoder) for _ in texts]
+        self.assertEqual([(message[SENDER], message[DESTINATION]) for message in messages],
+                         [('test1', 'test2')] * 3)
+        # Клиенту JSON байты текста приходят строкой base64
+        self.assertEqual([base64.b64decode(message[MESSAGE_TEXT]) for message in messages], texts)
+
+    @mock.patch('client.transport.RECONNECT_MAX_DELAY', 1)
+    def test_dropped_during_handshake(self):
+        """ Соединение, закрытое сервером во время авторизации, не останавливает переподключение """
+        lost, restored = threading.Event(), threading.Event()
+        self.transport.connection_lost.connect(lost.set, Qt.DirectConnection)
+        self.transport.connection_restored.connect(restored.set, Qt.DirectConnection)
+        port = self.server.port
+        stop_server(self.server)
+        self.assertTrue(lost.wait(REPLY_TIMEOUT))
+
+        # Порт слушает сокет, закрывающий соединение сразу после подключения
+        with socket.create_server(('127.0.0.1', port)) as listener:
+            listener.settimeout(REPLY_TIMEOUT)
+            for _ in range(2):
+                connection, address = listener.accept()
+                connection.close()
+        self.assertTrue(self.transport.is_alive())
+
+        self.server = MessageProcessor('127.0.0.1', port, server_database())
+        self.server.daemon = True
+        self.server.start()
+        self.assertTrue(restored.wait(REPLY_TIMEOUT))
+
+
+if __name__ == '__main__':
+    unittest.main()
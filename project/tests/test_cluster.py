@@ -0,0 +1,40 @@
+""" Тестирование шины маршрутизации между рабочими процессами """
+import sys
+import os
+import socket
+import unittest
+from unittest import mock
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from helpers import TEMP_DIR
+from common.variables import EVENT_OFFLINE
+from common.utils import MessageDecoder
+from server.cluster import RoutingBus, BusPeer
+from server.outbound import OutboundQueue, POLICY_SPILL
+
+
+class TestRoutingBus(unittest.TestCase):
+    """ Тестирование RoutingBus """
+
+    def test_peer_lost(self):
+        """ Пользователи потерянного процесса удаляются из справочника, подписчики получают выход """
+        bus = RoutingBus(1, 3, TEMP_DIR)
+        bus.server = mock.Mock()
+        sock, other = socket.socketpair()
+        self.addCleanup(other.close)
+        peer = BusPeer(sock, bus.path, MessageDecoder(), OutboundQueue(100, 10, POLICY_SPILL), 0)
+        bus.connections.add(peer)
+        bus.peers[0] = peer
+        bus.directory = {'test1': 0, 'test2': 0, 'test3': 2}
+        bus.remove_peer(peer)
+        self.assertEqual(bus.directory, {'test3': 2})
+        self.assertEqual(bus.peers, {})
+        self.assertEqual(sorted(bus.server.notify.call_args_list),
+                         [mock.call('test1', EVENT_OFFLINE), mock.call('test2', EVENT_OFFLINE)])
+        bus.server.selector.unregister.assert_called_once_with(sock)
+
+
+if __name__ == '__main__':
+    unittest.main()
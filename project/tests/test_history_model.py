@@ -0,0 +1,68 @@
+""" Тестирование модели истории переписки клиента """
+import sys
+import os
+import unittest
+from unittest import mock
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from helpers import client_database
+from PyQt5.QtCore import Qt
+from client.history_model import HistoryModel, DIRECTION_ROLE
+
+DATABASE = client_database()
+
+
+class TestHistoryModel(unittest.TestCase):
+    """ Тестирование HistoryModel """
+
+    def setUp(self):
+        patcher = mock.patch('client.history_model.HISTORY_PAGE_SIZE', 3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        # У каждого теста свой собеседник: база общая для всех тестов
+        self.contact = f'history_{self.id().rsplit(".", 1)[-1]}'
+        DATABASE.save_messages([(self.contact, 'in' if number % 2 else 'out', f'message {number}')
+                                for number in range(8)])
+        self.model = HistoryModel(DATABASE, self.contact)
+        self.inserted = []
+        self.model.rowsInserted.connect(lambda parent, first, last: self.inserted.append((first, last)))
+
+    def messages(self):
+        """ Тексты загруженных сообщений """
+        return [row[2] for row in self.model.rows]
+
+    def test_first_page(self):
+        """ При открытии загружается только последняя страница """
+        self.assertEqual(self.model.rowCount(), 3)
+        self.assertEqual(self.messages(), ['message 5', 'message 6', 'message 7'])
+        index = self.model.index(0)
+        self.assertIn('message 5', self.model.data(index))
+        self.assertEqual(self.model.data(index, DIRECTION_ROLE), 'in')
+        self.assertIsNone(self.model.data(index, Qt.DecorationRole))
+
+    def test_fetch_more(self):
+        """ Ранние сообщения подгружаются страницами в начало, только когда окно прокручено к началу """
+        self.assertFalse(self.model.canFetchMore())
+        self.model.at_top = True
+        self.model.fetchMore()
+        self.assertEqual(self.messages(), [f'message {number}' for number in range(2, 8)])
+        self.model.fetchMore()
+        self.assertEqual(self.messages(), [f'message {number}' for number in range(8)])
+        self.assertEqual(self.inserted, [(0, 2), (0, 1)])
+        self.assertFalse(self.model.canFetchMore())
+
+    def test_append(self):
+        """ Новые сообщения добавляются в конец без перезагрузки модели """
+        rows = DATABASE.save_messages([(self.contact, 'in', 'new')])
+        with mock.patch.object(DATABASE, 'get_history_page') as get_page:
+            self.model.append_messages(rows)
+            self.model.append_messages([])
+        get_page.assert_not_called()
+        self.assertEqual(self.messages()[-1], 'new')
+        self.assertEqual(self.inserted, [(3, 3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,129 @@
+""" Тестирование очереди исходящих данных сервера """
+import sys
+import os
+import unittest
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+import helpers  # логи тестов пишутся во временный каталог
+from common.variables import CODEC_BINARY, LIST_INFO, RESPONSE
+from common.utils import encode_message, FrameCompressor, MessageDecoder
+from server.outbound import OutboundQueue, POLICY_DROP, POLICY_DISCONNECT, POLICY_SPILL
+
+
+class SlowSocket:
+    """ Тестовый неблокирующий сокет, принимающий не более limit байт за вызов send """
+
+    def __init__(self, limit, capacity):
+        self.limit = limit
+        self.capacity = capacity
+        self.data = bytearray()
+
+    def send(self, data):
+        if self.capacity <= 0:
+            raise BlockingIOError
+        count = min(len(data), self.limit, self.capacity)
+        self.capacity -= count
+        self.data += data[:count]
+        return count
+
+
+class TestOutboundQueue(unittest.TestCase):
+    """ Тестирование OutboundQueue """
+
+    def test_partial_send(self):
+        """ Частичная отправка не теряет и не перемешивает данные """
+        queue = OutboundQueue(100, 50)
+        queue.push(b'0123456789')
+        queue.push(b'abcdef')
+        sock = SlowSocket(limit=3, capacity=7)
+        self.assertFalse(queue.send(sock))
+        self.assertEqual(len(queue), 9)
+        sock.capacity = 100
+        self.assertTrue(queue.send(sock))
+        self.assertEqual(bytes(sock.data), b'0123456789abcdef')
+
+    def test_disconnect_policy(self):
+        """ Политика disconnect: push возвращает False при переполнении """
+        queue = OutboundQueue(10, 5, POLICY_DISCONNECT)
+        self.assertTrue(queue.push(b'x' * 8))
+        self.assertFalse(queue.push(b'x' * 8))
+
+    def test_big_message_in_empty_queue(self):
+        """ Сообщение больше верхней границы принимается в пустую очередь """
+        queue = OutboundQueue(10, 5, POLICY_DISCONNECT)
+        self.assertTrue(queue.push(b'x' * 100))
+
+    def test_drop_policy(self):
+        """ Политика drop: отбрасывание до опускания ниже нижней границы """
+        queue = OutboundQueue(10, 4, POLICY_DROP)
+        queue.push(b'a' * 8)
+        queue.push(b'b' * 8)
+        queue.push(b'c')
+        self.assertEqual(queue.dropped, 2)
+        sock = SlowSocket(limit=100, capacity=5)
+        queue.send(sock)
+        queue.push(b'd')
+        sock.capacity = 100
+        queue.send(sock)
+        self.assertEqual(bytes(sock.data), b'a' * 8 + b'd')
+
+    def test_drop_compressed(self):
+        """ Отбрасывание сжатых кадров не нарушает распаковку следующих """
+        queue = OutboundQueue(64 * 1024, 16 * 1024, POLICY_DROP)
+        compressor = FrameCompressor()
+        decoder = MessageDecoder()
+        sock = SlowSocket(limit=4096, capacity=0)
+        sent = []
+        for number in range(1000):
+            message = {RESPONSE: 202, LIST_INFO: [f'user{number}-{item}' for item in range(200)]}
+            dropped = queue.dropped
+            queue.push(encode_message(message, True, CODEC_BINARY, compressor), compressor)
+            if queue.dropped == dropped:
+                sent.append(message)
+            # Клиент принимает данные медленнее, чем они поступают
+            sock.capacity = 256
+            queue.send(sock)
+        sock.capacity = len(queue)
+        queue.send(sock)
+        decoder.feed(bytes(sock.data))
+        self.assertTrue(queue.dropped)
+        self.assertEqual([message[LIST_INFO][-1] for message in decoder.messages],
+                         [message[LIST_INFO][-1] for message in sent])
+        self.assertTrue(list(decoder.messages) == sent)
+
+    def test_spill_policy(self):
+        """ Политика spill: излишек уходит в файл, порядок сохраняется """
+        queue = OutboundQueue(10, 4, POLICY_SPILL)
+        expected = b''
+        for i in range(20):
+            chunk = bytes([65 + i]) * 3
+            expected += chunk
+            self.assertTrue(queue.push(chunk))
+        self.assertGreater(queue.spill_size, 0)
+        self.assertEqual(len(queue), len(expected))
+        sock = SlowSocket(limit=2, capacity=1000)
+        self.assertTrue(queue.send(sock))
+        self.assertEqual(bytes(sock.data), expected)
+        self.assertIsNone(queue.spill_file)
+
+    def test_spill_zero_low_watermark(self):
+        """ Политика spill с нижней границей 0: файл подгружается, когда очередь пуста """
+        queue = OutboundQueue(10, 0, POLICY_SPILL)
+        expected = b''
+        for i in range(10):
+            chunk = bytes([65 + i]) * 4
+            expected += chunk
+            queue.push(chunk)
+        self.assertGreater(queue.spill_size, 0)
+        sock = SlowSocket(limit=3, capacity=1000)
+        self.assertTrue(queue.send(sock))
+        self.assertEqual(bytes(sock.data), expected)
+        self.assertFalse(queue)
+        self.assertIsNone(queue.spill_file)
+
+
+# Запустить тестирование
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+""" Тестирование обработки входящих сообщений клиента """
+import base64
+import sys
+import os
+import threading
+import unittest
+from unittest import mock
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from helpers import client_database
+from Cryptodome.PublicKey import RSA
+from PyQt5.QtCore import Qt
+from common.variables import *
+from client.receiver import MessageReceiver
+from client.session_keys import SessionKeys
+
+DATABASE = client_database()
+# Генерация ключей RSA долгая, поэтому ключи общие для всех тестов
+SENDER_KEYS = RSA.generate(1024)
+RECIPIENT_KEYS = RSA.generate(1024)
+RECIPIENT_PUBKEY = RECIPIENT_KEYS.publickey().export_key().decode('ascii')
+
+
+class TestMessageReceiver(unittest.TestCase):
+    """ Тестирование MessageReceiver """
+
+    def setUp(self):
+        self.sender = SessionKeys(SENDER_KEYS)
+        self.receiver = MessageReceiver(DATABASE, SessionKeys(RECIPIENT_KEYS), workers=4)
+        self.signals = []
+        # Сигнал испускается потоком приёма, цикла событий Qt в тестах нет
+        self.receiver.messages_received.connect(
+            lambda rows, failed: self.signals.append((rows, failed)), Qt.DirectConnection)
+
+    def tearDown(self):
+        self.receiver.close()
+
+    def message(self, sender, text, binary=True):
+        """ Входящее сообщение: текст байтами (двоичный кодек) или строкой base64 (JSON) """
+        data = self.sender.encrypt('test1', RECIPIENT_PUBKEY, text.encode('utf8'))
+        if not binary:
+            data = base64.b64encode(data).decode('ascii')
+        return {ACTION: MESSAGE, SENDER: sender, DESTINATION: 'test1', MESSAGE_TEXT: data}
+
+    def test_batch(self):
+        """ Сообщения, накопившиеся за время обработки группы, сохраняются одной группой """
+        first_saved, release = threading.Event(), threading.Event()
+        save_messages = DATABASE.save_messages
+
+        def slow_save(rows):
+            first_saved.set()
+            release.wait(5)
+            return save_messages(rows)
+
+        with mock.patch.object(DATABASE, 'save_messages', side_effect=slow_save) as save:
+            self.receiver.submit(self.message('receiver1', 'first'))
+            self.assertTrue(first_saved.wait(5))
+            for number in range(10):
+                self.receiver.submit(self.message('receiver1', f'text {number}', number % 2))
+            release.set()
+            self.receiver.close()
+        self.assertEqual(save.call_count, 2)
+        self.assertEqual([(len(rows), failed) for rows, failed in self.signals], [(1, 0), (10, 0)])
+        self.assertEqual([row[2] for row in DATABASE.get_history('receiver1')],
+                         ['first'] + [f'text {number}' for number in range(10)])
+
+    def test_failed(self):
+        """ Нерасшифрованные сообщения не сохраняются, окно получает их число """
+        broken = {ACTION: MESSAGE, SENDER: 'receiver2', DESTINATION: 'test1', MESSAGE_TEXT: b'broken'}
+        self.receiver.submit(broken)
+        self.receiver.submit(self.message('receiver2', 'text'))
+        self.receiver.close()
+        rows = sum((rows for rows, failed in self.signals), [])
+        failed = sum(failed for rows, failed in self.signals)
+        self.assertEqual(([row[:3] for row in rows], failed), ([('receiver2', 'in', 'text')], 1))
+
+    def test_close(self):
+        """ Остановка обрабатывает уже принятые сообщения """
+        for number in range(3):
+            self.receiver.submit(self.message('receiver3', f'text {number}'))
+        self.receiver.close()
+        self.assertFalse(self.receiver.thread.is_alive())
+        self.assertEqual([row[2] for row in DATABASE.get_history('receiver3')],
+                         ['text 0', 'text 1', 'text 2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+""" Тестирование реестра подключений сервера """
+import sys
+import os
+import unittest
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+import helpers  # логи тестов пишутся во временный каталог
+from server.registry import ClientConnection, ConnectionRegistry
+
+
+class TestConnectionRegistry(unittest.TestCase):
+    """ Тестирование ConnectionRegistry """
+
+    def setUp(self):
+        self.registry = ConnectionRegistry()
+        self.first = ClientConnection(None, ('127.0.0.1', 1), None, None)
+        self.second = ClientConnection(None, ('127.0.0.1', 2), None, None)
+        self.registry.add(self.first)
+        self.registry.add(self.second)
+
+    def test_authenticate(self):
+        """ Авторизация добавляет подключение в индекс имён """
+        self.registry.authenticate(self.first, 'test1')
+        self.assertIs(self.registry.get('test1'), self.first)
+        self.assertTrue(self.first.authenticated)
+        self.assertFalse(self.second.authenticated)
+        self.assertEqual(len(self.registry), 2)
+
+    def test_remove(self):
+        """ Удаление подключения убирает и его имя, повторное удаление - False """
+        self.registry.authenticate(self.first, 'test1')
+        self.assertTrue(self.registry.remove(self.first))
+        self.assertNotIn(self.first, self.registry)
+        self.assertIsNone(self.registry.get('test1'))
+        self.assertFalse(self.first.authenticated)
+        self.assertFalse(self.registry.remove(self.first))
+
+    def test_remove_keeps_new_owner(self):
+        """ Удаление старого подключения не затирает новое с тем же именем """
+        self.registry.authenticate(self.first, 'test1')
+        self.registry.authenticate(self.second, 'test1')
+        self.registry.remove(self.first)
+        self.assertIs(self.registry.get('test1'), self.second)
+
+    def test_subscriptions(self):
+        """ Подписки доступны по имени и снимаются при удалении подключения """
+        self.registry.subscribe(self.first, ['test2', 'test3'])
+        self.registry.subscribe(self.second, ['test3'])
+        self.assertEqual(self.registry.watching('test2'), [self.first])
+        self.registry.unsubscribe(self.first, ['test2'])
+        self.assertEqual(self.registry.watching('test2'), [])
+        self.registry.remove(self.first)
+        self.assertEqual(self.registry.watching('test3'), [self.second])
+        self.registry.forget('test3')
+        self.assertEqual(self.registry.watching('test3'), [])
+        self.assertEqual(self.second.watching, set())
+
+    def test_iter_copy(self):
+        """ Реестр можно изменять во время обхода """
+        for connection in self.registry:
+            self.registry.remove(connection)
+        self.assertEqual(len(self.registry), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
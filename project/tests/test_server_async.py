@@ -0,0 +1,104 @@
+""" Тестирование сервера на asyncio """
+import sys
+import os
+import time
+import unittest
+from unittest import mock
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from helpers import start_server, stop_server, connect, login
+from common.variables import *
+from common.utils import MessageDecoder, get_message, send_message
+from server.async_core import AsyncMessageProcessor
+
+
+def wait_for(condition, timeout=5):
+    """ Ожидание выполнения условия в потоке сервера """
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError('Условие не выполнено')
+        time.sleep(0.01)
+
+
+class TestAsyncMessageProcessor(unittest.TestCase):
+    """ Тестирование AsyncMessageProcessor """
+
+    def setUp(self):
+        self.server = start_server(AsyncMessageProcessor)
+
+    def tearDown(self):
+        if self.server.is_alive():
+            stop_server(self.server)
+
+    def test_login(self):
+        """ Авторизация и запрос через сопрограмму подключения """
+        sock, decoder, response = login(self.server, 'test1')
+        with sock:
+            self.assertEqual(response[RESPONSE], 200)
+            send_message(sock, {ACTION: USERS_REQUEST, TIME: time.time(), ACCOUNT_NAME: 'test1'})
+            response = get_message(sock, decoder)
+            self.assertEqual(response[RESPONSE], 202)
+            self.assertIn('test2', response[LIST_INFO])
+
+    def test_unknown_user(self):
+        """ Незарегистрированный пользователь получает 400 и отключается """
+        sock, decoder, response = login(self.server, 'test9')
+        with sock:
+            self.assertEqual(response[RESPONSE], 400)
+            self.assertEqual(sock.recv(RECV_BUFFER_SIZE), b'')
+        wait_for(lambda: not self.server.tasks)
+
+    @mock.patch('server.core.AUTH_TIMEOUT', 1)
+    def test_deadline_queued(self):
+        """ Ответ 400, оставшийся в очереди клиента, отправляется до закрытия соединения """
+        sock = connect(self.server)
+        decoder = MessageDecoder()
+        with sock:
+            send_message(sock, {ACTION: PRESENCE, TIME: time.time(),
+                                USER: {ACCOUNT_NAME: 'test1', PUBLIC_KEY: 'KEY'}})
+            self.assertEqual(get_message(sock, decoder)[RESPONSE], 511)
+            # Очередь не передаётся в транспорт, пока клиент не отключается
+            with mock.patch.object(self.server, 'flush_client'):
+                response = get_message(sock, decoder)
+                self.assertEqual(response, {RESPONSE: 400, ERROR: 'Превышено время авторизации.'})
+                self.assertEqual(sock.recv(RECV_BUFFER_SIZE), b'')
+        wait_for(lambda: not self.server.tasks)
+
+    def test_unexpected_error(self):
+        """ Непредвиденная ошибка обработки отключает клиента и удаляет его из реестра """
+        with mock.patch.object(self.server, 'dispatch_message', side_effect=KeyError(ACTION)):
+            with connect(self.server) as sock:
+                send_message(sock, {ACTION: PRESENCE, TIME: time.time()})
+                self.assertEqual(sock.recv(RECV_BUFFER_SIZE), b'')
+        wait_for(lambda: not list(self.server.clients))
+        wait_for(lambda: not self.server.tasks)
+
+    def test_shutdown(self):
+        """ При остановке задачи подключений отменяются и завершаются до закрытия цикла """
+        sock, decoder, response = login(self.server, 'test1')
+        other = connect(self.server)
+        with sock, other:
+            # Неполное сообщение: сопрограмма подключения ждёт продолжения
+            other.sendall(b'{"action": ')
+            wait_for(lambda: len(self.server.tasks) == 2)
+            tasks = list(self.server.tasks)
+            stop_server(self.server)
+            self.assertTrue(all(task.done() for task in tasks))
+            self.assertEqual(self.server.tasks, set())
+            self.assertTrue(self.server.loop.is_closed())
+            self.assertEqual(other.recv(RECV_BUFFER_SIZE), b'')
+        self.assertEqual(self.server.database.active_users_list(), [])
+
+    def test_no_selector(self):
+        """ Пара сокетов и селектор движка thread не создаются """
+        login(self.server, 'test1')[0].close()
+        self.assertIsNone(self.server.selector)
+        self.assertIsNone(self.server.wakeup_sender)
+        self.assertIsNone(self.server.wakeup_receiver)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,170 @@
+""" Тестирование цикла сервера (движок thread) """
+import sys
+import os
+import threading
+import time
+import unittest
+from unittest import mock
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from helpers import server_database, start_server, stop_server, connect, login, free_port, \
+    password_hash, auth_digest
+from common.variables import *
+from common.utils import MessageDecoder, FRAME_HEADER, encode_message, get_message, send_message
+from common.responses import auth_511
+from server.core import MessageProcessor
+
+
+class TestMessageProcessor(unittest.TestCase):
+    """ Тестирование цикла selectors и передачи вызовов в поток сервера """
+
+    def setUp(self):
+        self.server = start_server(MessageProcessor)
+
+    def tearDown(self):
+        if self.server.is_alive():
+            stop_server(self.server)
+
+    def test_pipelined(self):
+        """ Запросы, пришедшие одним пакетом, обрабатываются по порядку без ожидания """
+        sock, decoder, response = login(self.server, 'test1')
+        with sock:
+            self.assertEqual(response[RESPONSE], 200)
+            request = {ACTION: USERS_REQUEST, TIME: time.time(), ACCOUNT_NAME: 'test1'}
+            sock.sendall(encode_message(request) * 3)
+            started = time.monotonic()
+            responses = [get_message(sock, decoder) for _ in range(3)]
+            # Ответ не ждёт таймаута цикла сервера
+            self.assertLess(time.monotonic() - started, CONNECTION_TIMEOUT)
+        self.assertEqual([response[RESPONSE] for response in responses], [202] * 3)
+
+    def test_accept_backlog(self):
+        """ Все ожидающие подключения принимаются и обслуживаются """
+        sockets = [connect(self.server) for _ in range(20)]
+        try:
+            request = {ACTION: PRESENCE, TIME: time.time(),
+                       USER: {ACCOUNT_NAME: 'test9', PUBLIC_KEY: 'KEY'}}
+            for sock in sockets:
+                send_message(sock, request)
+            for sock in sockets:
+                self.assertEqual(get_message(sock, MessageDecoder())[RESPONSE], 400)
+        finally:
+            for sock in sockets:
+                sock.close()
+
+    def test_too_deep(self):
+        """ Слишком глубоко вложенное сообщение закрывает только своё соединение """
+        payload = b'{"a":' + b'[' * 100000 + b']' * 100000 + b'}'
+        with connect(self.server) as sock:
+            sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+            self.assertEqual(sock.recv(RECV_BUFFER_SIZE), b'')
+        sock, decoder, response = login(self.server, 'test1')
+        sock.close()
+        self.assertEqual(response[RESPONSE], 200)
+
+    def test_call_in_loop(self):
+        """ Вызов из другого потока выполняется в потоке сервера """
+        connect(self.server).close()
+        done = threading.Event()
+        threads = []
+
+        def callback(value):
+            threads.append((threading.current_thread(), value))
+            done.set()
+
+        # Цикл сервера ждёт событий до CONNECTION_TIMEOUT - вызов его будит
+        self.server.call_in_loop(callback, 1)
+        self.assertTrue(done.wait(CONNECTION_TIMEOUT / 2))
+        self.assertEqual(threads, [(self.server, 1)])
+
+    def test_removed_while_connected(self):
+        """ Запросы пользователя, удалённого из базы до отключения его клиента, не роняют сервер """
+        database = self.server.database
+        database.add_user('test10', password_hash('test10', 'test10')).result()
+        sock, decoder, response = login(self.server, 'test10')
+        with sock:
+            self.assertEqual(response[RESPONSE], 200)
+            database.remove_user('test10').result()
+            send_message(sock, {ACTION: SYNC_REQUEST, TIME: time.time(),
+                                ACCOUNT_NAME: 'test10', VERSION: 0})
+            self.assertEqual(get_message(sock, decoder)[RESPONSE], 400)
+            send_message(sock, {ACTION: GET_CONTACTS, TIME: time.time(), USER: 'test10'})
+            self.assertEqual(get_message(sock, decoder), {RESPONSE: 202, LIST_INFO: []})
+        self.assertTrue(self.server.is_alive())
+
+
+class TestAuthentication(unittest.TestCase):
+    """ Тестирование авторизации, не блокирующей цикл сервера """
+
+    def setUp(self):
+        self.server = start_server(MessageProcessor)
+
+    def tearDown(self):
+        stop_server(self.server)
+
+    def presence(self, name):
+        """ Подключение и приветствие: возвращает сокет, декодер и ответ 511 """
+        sock = connect(self.server)
+        decoder = MessageDecoder()
+        send_message(sock, {ACTION: PRESENCE, TIME: time.time(),
+                            USER: {ACCOUNT_NAME: name, PUBLIC_KEY: 'KEY'}})
+        return sock, decoder, get_message(sock, decoder)
+
+    @mock.patch('server.core.AUTH_TIMEOUT', 1)
+    def test_deadline(self):
+        """ Клиент, не ответивший на 511, не задерживает других и отключается по сроку """
+        sock, decoder, challenge = self.presence('test1')
+        with sock:
+            self.assertEqual(challenge[RESPONSE], 511)
+            started = time.monotonic()
+            other, other_decoder, response = login(self.server, 'test2')
+            other.close()
+            self.assertEqual(response[RESPONSE], 200)
+            self.assertLess(time.monotonic() - started, 1)
+            response = get_message(sock, decoder)
+            self.assertEqual(response, {RESPONSE: 400, ERROR: 'Превышено время авторизации.'})
+            self.assertGreaterEqual(time.monotonic() - started, 1)
+            self.assertEqual(sock.recv(RECV_BUFFER_SIZE), b'')
+
+    def test_concurrent(self):
+        """ Клиенты проходят авторизацию одновременно """
+        names = [f'test{number}' for number in range(20, 30)]
+        for name in names:
+            self.server.database.add_user(name, password_hash(name, name)).result()
+        clients = [(name,) + self.presence(name) for name in names]
+        try:
+            for name, sock, decoder, challenge in clients:
+                send_message(sock, auth_511(auth_digest(name, challenge)))
+            for name, sock, decoder, challenge in clients:
+                self.assertEqual(get_message(sock, decoder)[RESPONSE], 200)
+            self.assertEqual(sorted(self.server.names), names)
+        finally:
+            for name, sock, decoder, challenge in clients:
+                sock.close()
+            for name in names:
+                self.server.database.remove_user(name).result()
+
+
+class TestMessageProcessorStart(unittest.TestCase):
+    """ Тестирование вызовов, переданных до запуска потока сервера """
+
+    def test_call_before_start(self):
+        """ Вызов, переданный до запуска, выполняется сразу после запуска """
+        server = MessageProcessor('127.0.0.1', free_port(), server_database())
+        done = threading.Event()
+        server.call_in_loop(done.set)
+        server.daemon = True
+        server.start()
+        try:
+            self.assertTrue(done.wait(CONNECTION_TIMEOUT / 2))
+        finally:
+            stop_server(server)
+        # Пара сокетов пробуждения закрыта вместе с сервером
+        self.assertEqual(server.wakeup_sender.fileno(), -1)
+        self.assertEqual(server.wakeup_receiver.fileno(), -1)
+
+
+if __name__ == '__main__':
+    unittest.main()
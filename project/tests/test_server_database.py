@@ -0,0 +1,249 @@
+""" Тестирование базы данных сервера """
+import contextlib
+import io
+import sqlite3
+import sys
+import os
+import threading
+import unittest
+from unittest import mock
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+from helpers import TEMP_DIR, server_database, password_hash
+from common.storage import check_profile
+from server.database import INDEXES
+from migrate_storage import migrate
+
+# Схема базы сервера до добавления индексов, почтового ящика и журнала изменений
+BASELINE_SCHEMA = """
+CREATE TABLE "Users" (id INTEGER PRIMARY KEY, name VARCHAR UNIQUE, last_login DATETIME,
+                      passwd_hash VARCHAR, pubkey TEXT);
+CREATE TABLE "Active_users" (id INTEGER PRIMARY KEY, user INTEGER UNIQUE REFERENCES "Users" (id),
+                             ip_address VARCHAR, port INTEGER, login_time DATETIME);
+CREATE TABLE "Login_history" (id INTEGER PRIMARY KEY, name INTEGER REFERENCES "Users" (id),
+                              date_time DATETIME, ip VARCHAR, port VARCHAR);
+CREATE TABLE "Contacts" (id INTEGER PRIMARY KEY, user INTEGER REFERENCES "Users" (id),
+                         contact INTEGER REFERENCES "Users" (id));
+CREATE TABLE "History" (id INTEGER PRIMARY KEY, user INTEGER REFERENCES "Users" (id),
+                        sent INTEGER, accepted INTEGER);
+"""
+
+# Классические отображения создаются один раз на процесс,
+# поэтому все тесты работают с одной базой.
+DATABASE = server_database()
+
+
+def wait_writes():
+    """ Ожидание выполнения всех поставленных в очередь изменений """
+    DATABASE.submit(lambda: None).result()
+
+
+class TestServerStorage(unittest.TestCase):
+    """ Тестирование ServerStorage """
+
+    def setUp(self):
+        DATABASE.flush_counters(force=True)
+        wait_writes()
+        self.start = self.stored()
+
+    def stored(self):
+        """ Счётчики, записанные в базу """
+        query = DATABASE.session.query(
+            DATABASE.AllUsers.name,
+            DATABASE.UsersHistory.sent,
+            DATABASE.UsersHistory.accepted
+        ).join(DATABASE.AllUsers)
+        return {name: (sent, accepted) for name, sent, accepted in query.all()}
+
+    def history(self):
+        """ Статистика, которую видит окно сервера """
+        return {row[0]: (row[2], row[3]) for row in DATABASE.message_history()}
+
+    def test_counters_pending(self):
+        """ Счётчики копятся в памяти, но видны в message_history """
+        DATABASE.process_message('test1', 'test2')
+        self.assertEqual(self.stored(), self.start)
+        sent, accepted = self.start['test1']
+        self.assertEqual(self.history()['test1'], (sent + 1, accepted))
+
+    def test_counters_flush_count(self):
+        """ После counters_flush_count сообщений счётчики записываются в базу """
+        for _ in range(3):
+            DATABASE.process_message('test1', 'test2')
+        wait_writes()
+        sent, accepted = self.start['test2']
+        self.assertEqual(self.stored()['test2'], (sent, accepted + 3))
+        self.assertEqual(self.history(), self.stored())
+
+    def test_counters_flush_interval(self):
+        """ Без force запись выполняется только по истечении интервала """
+        DATABASE.process_message('test2', 'test1')
+        self.assertIsNone(DATABASE.flush_counters())
+        self.assertEqual(self.stored(), self.start)
+        DATABASE.counters_flush_time = 0
+        DATABASE.flush_counters().result()
+        sent, accepted = self.start['test2']
+        self.assertEqual(self.stored()['test2'], (sent + 1, accepted))
+
+    def test_counters_while_writing(self):
+        """ Пачка, уже записанная в базу, но ещё не снятая с ожидания, не учитывается дважды """
+        committed, release = threading.Event(), threading.Event()
+        commit_writes = DATABASE.commit_writes
+
+        def slow_commit():
+            commit_writes()
+            committed.set()
+            release.wait(5)
+
+        history = []
+        with mock.patch.object(DATABASE, 'commit_writes', side_effect=slow_commit):
+            DATABASE.process_message('test1', 'test2')
+            future = DATABASE.flush_counters(force=True)
+            self.assertTrue(committed.wait(5))
+            reader = threading.Thread(target=lambda: history.append(self.history()))
+            reader.start()
+            reader.join(0.2)
+            release.set()
+            reader.join()
+            future.result()
+        sent, accepted = self.start['test1']
+        self.assertEqual(history[0]['test1'], (sent + 1, accepted))
+
+    def test_contacts_future(self):
+        """ Изменение видно при чтении после завершения Future """
+        DATABASE.add_contact('test1', 'test2').result()
+        self.assertEqual(DATABASE.get_contacts('test1'), ['test2'])
+        DATABASE.remove_contact('test1', 'test2').result()
+        self.assertEqual(DATABASE.get_contacts('test1'), [])
+
+    def test_write_error_isolated(self):
+        """ Ошибка одного изменения группы не отменяет остальные """
+        failed = DATABASE.submit(lambda: 1 / 0)
+        added = DATABASE.add_contact('test2', 'test1')
+        self.assertIsNone(added.result())
+        self.assertIsInstance(failed.exception(), ZeroDivisionError)
+        self.assertEqual(DATABASE.get_contacts('test2'), ['test1'])
+        DATABASE.remove_contact('test2', 'test1').result()
+
+    def test_login_logout(self):
+        """ Вход обновляет ключ и список активных пользователей """
+        DATABASE.user_login('test1', '127.0.0.1', 7777, 'KEY').result()
+        self.assertEqual(DATABASE.get_pubkey('test1'), 'KEY')
+        self.assertEqual([row[0] for row in DATABASE.active_users_list()], ['test1'])
+        DATABASE.user_logout('test1').result()
+        self.assertEqual(DATABASE.active_users_list(), [])
+
+    def test_key_change(self):
+        """ Смена ключа при входе попадает в журнал изменений списка пользователей """
+        version = DATABASE.get_changes('test1', 0)[0]
+        DATABASE.user_login('test2', '127.0.0.1', 7778, 'KEY2').result()
+        DATABASE.user_logout('test2').result()
+        DATABASE.user_login('test2', '127.0.0.1', 7778, 'KEY2').result()
+        DATABASE.user_logout('test2').result()
+        # Справочник обновлён до записи входа - ключ всё равно сохраняется
+        DATABASE.cache_pubkey('test2', 'KEY3')
+        DATABASE.user_login('test2', '127.0.0.1', 7778, 'KEY3').result()
+        DATABASE.user_logout('test2').result()
+        self.assertEqual(DATABASE.get_changes('test1', version),
+                         (version + 2, False, (['test2'], []), ([], [])))
+        self.assertEqual(DATABASE.session.query(DATABASE.AllUsers.pubkey).filter_by(
+            name='test2').scalar(), 'KEY3')
+
+    def test_user_directory(self):
+        """ Справочник пользователей обновляется после записи в базу """
+        self.assertTrue(DATABASE.check_user('test1'))
+        self.assertEqual(DATABASE.get_hash('test1'), password_hash('test1', 'test1'))
+        DATABASE.add_user('test3', b'hash3').result()
+        self.assertTrue(DATABASE.check_user('test3'))
+        self.assertEqual(DATABASE.get_hash('test3'), b'hash3')
+        self.assertIn('test3', [row[0] for row in DATABASE.users_list()])
+        DATABASE.remove_user('test3').result()
+        self.assertFalse(DATABASE.check_user('test3'))
+        self.assertIsNone(DATABASE.get_pubkey('test3'))
+        self.assertNotIn('test3', [row[0] for row in DATABASE.users_list()])
+
+    def test_user_directory_rollback(self):
+        """ Неудачная запись не меняет справочник """
+        self.assertRaises(ValueError, DATABASE.user_login('test9', '127.0.0.1', 1).result)
+        self.assertFalse(DATABASE.check_user('test9'))
+
+    def test_mailbox(self):
+        """ Почтовый ящик отдаёт сообщения по порядку и соблюдает квоту и срок хранения """
+        messages = [{'action': 'message', 'to': 'test2', 'mess_text': str(number).encode()}
+                    for number in range(3)]
+        for message in messages:
+            DATABASE.store_message('test2', message).result()
+        stored = DATABASE.get_mailbox('test2').result()
+        self.assertEqual([message for message_id, message in stored], messages)
+        DATABASE.mailbox_quota = 3
+        self.assertRaises(ValueError, DATABASE.store_message('test2', messages[0]).result)
+        self.assertRaises(ValueError, DATABASE.store_message('test9', messages[0]).result)
+        DATABASE.mailbox_ttl = -1
+        self.assertEqual(DATABASE.get_mailbox('test2').result(), [])
+        DATABASE.store_message('test2', messages[0]).result()
+        DATABASE.mailbox_ttl, DATABASE.mailbox_quota = 3600, 1000
+        stored = DATABASE.get_mailbox('test2').result()
+        self.assertEqual([message for message_id, message in stored], [messages[0]])
+        DATABASE.remove_mailbox([message_id for message_id, message in stored]).result()
+        self.assertEqual(DATABASE.get_mailbox('test2').result(), [])
+
+    def test_changes(self):
+        """ Клиент с версией получает только изменения после неё """
+        version, full, users, contacts = DATABASE.get_changes('test1', 0)
+        self.assertTrue(full)
+        self.assertIn('test2', users[0])
+        DATABASE.add_user('test4', b'hash4').result()
+        DATABASE.add_contact('test1', 'test2').result()
+        DATABASE.add_contact('test1', 'test4').result()
+        DATABASE.remove_contact('test1', 'test2').result()
+        self.assertEqual(DATABASE.get_changes('test1', version),
+                         (version + 4, False, (['test4'], []), (['test4'], ['test2'])))
+        DATABASE.remove_user('test4').result()
+        newest, full, users, contacts = DATABASE.get_changes('test1', version + 4)
+        self.assertEqual((full, users, contacts), (False, ([], ['test4']), ([], ['test4'])))
+        self.assertEqual(DATABASE.get_changes('test2', newest), (newest, False, ([], []), ([], [])))
+        self.assertTrue(DATABASE.get_changes('test1', newest + 1)[1])
+
+    def test_removed_user(self):
+        """ Удалённый, но ещё подключённый пользователь не роняет запросы списков """
+        DATABASE.add_user('test5', b'hash5').result()
+        DATABASE.add_contact('test5', 'test1').result()
+        DATABASE.remove_user('test5').result()
+        self.assertEqual(DATABASE.get_contacts('test5'), [])
+        self.assertRaises(ValueError, DATABASE.get_changes, 'test5', 0)
+
+    def test_storage_profile(self):
+        """ База открыта в режиме WAL, индексы созданы """
+        with DATABASE.database_engine.connect() as connection:
+            self.assertEqual(connection.exec_driver_sql('PRAGMA journal_mode').scalar(), 'wal')
+            indexes = {row[0] for row in connection.exec_driver_sql(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertTrue({index[0] for index in INDEXES} <= indexes)
+
+    def test_migrate_baseline(self):
+        """ Миграция базы старой схемы создаёт индексы существующих таблиц """
+        path = os.path.join(TEMP_DIR, 'baseline_server.db3')
+        with sqlite3.connect(path) as connection:
+            connection.executescript(BASELINE_SCHEMA)
+        with contextlib.redirect_stdout(io.StringIO()):
+            migrate(path)
+        with sqlite3.connect(path) as connection:
+            tables = {row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table'")}
+            indexes = {row[0] for row in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertEqual(indexes & {index[0] for index in INDEXES},
+                         {name for name, table, columns in INDEXES if table in tables})
+        self.assertIn('ix_contacts_user_contact', indexes)
+
+    def test_check_profile(self):
+        """ Профиль принимает только известные PRAGMA и простые значения """
+        self.assertEqual(check_profile({'cache_size': -2000}), {'cache_size': -2000})
+        self.assertRaises(ValueError, check_profile, {'foreign_keys': 'ON'})
+        self.assertRaises(ValueError, check_profile, {'synchronous': 'OFF; DROP TABLE Users'})
+
+
+if __name__ == '__main__':
+    unittest.main()
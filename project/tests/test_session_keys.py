@@ -0,0 +1,71 @@
+""" Тестирование гибридного шифрования сообщений клиента """
+import sys
+import os
+import unittest
+from unittest import mock
+
+# для корректных импортов
+sys.path.append(os.path.join(os.getcwd(), '..'))
+
+import helpers  # логи тестов пишутся во временный каталог
+from Cryptodome.Cipher import PKCS1_OAEP
+from Cryptodome.PublicKey import RSA
+from client import session_keys
+from client.session_keys import SessionKeys
+
+# Генерация ключей RSA долгая, поэтому ключи общие для всех тестов
+SENDER_KEYS = RSA.generate(1024)
+RECIPIENT_KEYS = RSA.generate(1024)
+RECIPIENT_PUBKEY = RECIPIENT_KEYS.publickey().export_key().decode('ascii')
+
+
+class TestSessionKeys(unittest.TestCase):
+    """ Тестирование SessionKeys """
+
+    def setUp(self):
+        self.sender = SessionKeys(SENDER_KEYS)
+        self.recipient = SessionKeys(RECIPIENT_KEYS)
+
+    def test_long_message(self):
+        """ Длина сообщения не ограничена размером ключа RSA """
+        text = 'Длинное сообщение. ' * 1000
+        data = self.sender.encrypt('test2', RECIPIENT_PUBKEY, text.encode('utf8'))
+        self.assertEqual(self.recipient.decrypt('test1', data).decode('utf8'), text)
+
+    def test_session_key_cached(self):
+        """ RSA расшифровывает только первое сообщение сеанса """
+        messages = [self.sender.encrypt('test2', RECIPIENT_PUBKEY, f'{number}'.encode())
+                    for number in range(3)]
+        with mock.patch.object(self.recipient, 'decrypter', wraps=self.recipient.decrypter) as rsa:
+            self.assertEqual([self.recipient.decrypt('test1', data) for data in messages],
+                             [b'0', b'1', b'2'])
+        self.assertEqual(rsa.call_count, 1)
+
+    def test_rotation(self):
+        """ Ключ сменяется после SESSION_KEY_MESSAGES сообщений и при смене ключа собеседника """
+        with mock.patch.object(session_keys, 'SESSION_KEY_MESSAGES', 2):
+            first = self.sender.session('test2', RECIPIENT_PUBKEY)
+            self.sender.encrypt('test2', RECIPIENT_PUBKEY, b'1')
+            self.assertIs(self.sender.session('test2', RECIPIENT_PUBKEY), first)
+            self.sender.encrypt('test2', RECIPIENT_PUBKEY, b'2')
+            data = self.sender.encrypt('test2', RECIPIENT_PUBKEY, b'3')
+            second = self.sender.session('test2', RECIPIENT_PUBKEY)
+            self.assertIsNot(second, first)
+        self.assertEqual(self.recipient.decrypt('test1', data), b'3')
+        other_pubkey = SENDER_KEYS.publickey().export_key().decode('ascii')
+        self.assertIsNot(self.sender.session('test2', other_pubkey), second)
+
+    def test_tampered(self):
+        """ Изменённое сообщение не расшифровывается """
+        data = bytearray(self.sender.encrypt('test2', RECIPIENT_PUBKEY, b'text'))
+        data[-1] ^= 1
+        self.assertRaises(ValueError, self.recipient.decrypt, 'test1', bytes(data))
+
+    def test_legacy(self):
+        """ Сообщения, зашифрованные RSA целиком, расшифровываются """
+        data = PKCS1_OAEP.new(RECIPIENT_KEYS.publickey()).encrypt(b'text')
+        self.assertEqual(self.recipient.decrypt('test1', data), b'text')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,19 @@
 """ Тестирование клиентского модуля """
+import base64
 import json
 import sys
 import os
 import unittest
+from unittest import mock
 
 # для корректных импортов
 sys.path.append(os.path.join(os.getcwd(), '..'))
 
+import helpers  # логи тестов пишутся во временный каталог
 from common.variables import *
+from common import utils
 from common.utils import *
+from common.codec import TAG_LIST, TAG_NONE
 
 
 class TestSocket:
@@ -67,6 +72,232 @@ class TestClientClass(unittest.TestCase):
         self.assertEqual(get_message(test_socket), self.test_dict_recv_error)
 
 
+class TestMessageDecoder(unittest.TestCase):
+    """ Тестирование потокового декодера MessageDecoder """
+
+    messages = [{ACTION: PRESENCE, TIME: 1.5, USER: {ACCOUNT_NAME: 'Stuff'}},
+                {RESPONSE: 200},
+                {RESPONSE: 202, LIST_INFO: ['Привет'] * 500}]
+
+    def test_framed_split_and_merged(self):
+        """ Кадры, склеенные в один поток и порезанные на куски по 7 байт """
+        stream = b''.join(encode_message(msg, framed=True) for msg in self.messages)
+        decoder = MessageDecoder()
+        for i in range(0, len(stream), 7):
+            decoder.feed(stream[i:i + 7])
+        self.assertTrue(decoder.framed)
+        self.assertEqual(list(decoder.messages), self.messages)
+
+    def test_legacy_merged(self):
+        """ Старый режим: несколько JSON объектов в одном чтении и разрыв посередине """
+        stream = b''.join(encode_message(msg) for msg in self.messages)
+        decoder = MessageDecoder()
+        decoder.feed(stream[:-10])
+        self.assertFalse(decoder.framed)
+        self.assertEqual(list(decoder.messages), self.messages[:2])
+        decoder.feed(stream[-10:])
+        self.assertEqual(list(decoder.messages), self.messages)
+
+    def test_legacy_byte_by_byte(self):
+        """ Старый режим: по байту, со скобками, кавычками и экранированием внутри строк """
+        messages = self.messages + [{MESSAGE_TEXT: 'скобки {[ ]} и \\"кавычки\\" \\\\'}]
+        stream = b' '.join(encode_message(msg) for msg in messages)
+        decoder = MessageDecoder()
+        with mock.patch.object(json, 'loads', wraps=json.loads) as loads:
+            for i in range(len(stream)):
+                decoder.feed(stream[i:i + 1])
+        self.assertEqual(list(decoder.messages), messages)
+        # Каждый объект разбирается один раз, когда он закрыт
+        self.assertEqual(loads.call_count, len(messages))
+
+    def test_legacy_too_long(self):
+        """ Старый режим: длина проверяется до того, как объект дочитан """
+        decoder = MessageDecoder()
+        with mock.patch.object(utils, 'MAX_MESSAGE_LENGTH', 100):
+            decoder.feed(b'{"' + b'a' * 50)
+            self.assertRaises(ValueError, decoder.feed, b'a' * 50)
+
+    def test_framed_too_long(self):
+        """ Кадр с длиной больше допустимой отклоняется по заголовку, до приёма тела """
+        decoder = MessageDecoder()
+        with mock.patch.object(utils, 'MAX_MESSAGE_LENGTH', 100):
+            self.assertRaises(ValueError, decoder.feed, FRAME_HEADER.pack(101))
+
+    def test_too_deep(self):
+        """ Слишком глубоко вложенный JSON отклоняется ValueError, а не RecursionError """
+        payload = b'{"a":' + b'[' * 100000 + b']' * 100000 + b'}'
+        self.assertRaises(ValueError, MessageDecoder().feed, FRAME_HEADER.pack(len(payload)) + payload)
+        self.assertRaises(ValueError, MessageDecoder().feed, payload)
+
+    def test_legacy_not_dict(self):
+        """ Старый режим: объект, не являющийся словарём """
+        self.assertRaises(ValueError, MessageDecoder().feed, b' [1, 2]')
+
+    def test_framed_not_dict(self):
+        """ Кадр с телом, не являющимся словарём """
+        payload = json.dumps([1, 2]).encode(ENCODING)
+        decoder = MessageDecoder()
+        self.assertRaises(ValueError, decoder.feed, FRAME_HEADER.pack(len(payload)) + payload)
+
+    def test_get_message_pipelined(self):
+        """ get_message() с декодером отдаёт сообщения из одного чтения по очереди """
+        stream = b''.join(encode_message(msg, framed=True) for msg in self.messages)
+        test_socket = TestSocket({})
+        test_socket.recv = lambda max_len: stream
+        decoder = MessageDecoder()
+        self.assertEqual([get_message(test_socket, decoder) for _ in self.messages], self.messages)
+
+
+class TestEncodedMessage(unittest.TestCase):
+    """ Тестирование заранее закодированных ответов """
+
+    def test_encode_same_bytes(self):
+        """ Байты совпадают с обычным кодированием в обоих режимах """
+        message = EncodedMessage(RESPONSE_200)
+        for framed in (False, True):
+            self.assertEqual(encode_message(message, framed), encode_message(RESPONSE_200, framed))
+        self.assertIs(message.encode(True), message.encode(True))
+
+    def test_not_linked_to_source(self):
+        """ Изменение исходного словаря не меняет сообщение """
+        source = {RESPONSE: 400, ERROR: 'первая'}
+        message = EncodedMessage(source)
+        source[ERROR] = 'вторая'
+        self.assertEqual(message[ERROR], 'первая')
+        self.assertEqual(message, {RESPONSE: 400, ERROR: 'первая'})
+
+    def test_responses(self):
+        """ Ответы с параметрами не изменяют общие словари """
+        from common.responses import error_400, list_202
+        self.assertEqual(error_400('ошибка'), {RESPONSE: 400, ERROR: 'ошибка'})
+        self.assertIs(error_400('ошибка'), error_400('ошибка'))
+        self.assertEqual(list_202(['test1']), {RESPONSE: 202, LIST_INFO: ['test1']})
+        self.assertEqual(RESPONSE_400, {RESPONSE: 400, ERROR: None})
+        self.assertEqual(RESPONSE_202, {RESPONSE: 202, LIST_INFO: None})
+
+    def test_reply_to(self):
+        """ Номер запроса добавляется в копию ответа """
+        from common.responses import OK_200, reply_to
+        self.assertIs(reply_to(None, OK_200), OK_200)
+        self.assertEqual(reply_to(7, OK_200), {RESPONSE: 200, REQUEST_ID: 7})
+        self.assertEqual(OK_200, RESPONSE_200)
+
+    def test_reply_to_encoded(self):
+        """ Номер запроса дописывается к готовым байтам ответа без повторного кодирования """
+        from common.responses import error_400, reply_to
+        response = error_400('Ошибка')
+        expected = {RESPONSE: 400, ERROR: 'Ошибка', REQUEST_ID: 7}
+        modes = [(False, CODEC_JSON), (True, CODEC_JSON), (True, CODEC_BINARY)]
+        encoded = [encode_message(expected, framed, codec) for framed, codec in modes]
+        for framed, codec in modes:
+            response.encode(framed, codec)
+        with mock.patch.object(utils, 'encode_body', wraps=utils.encode_body) as encode_body:
+            reply = reply_to(7, response)
+            self.assertEqual([reply.encode(framed, codec) for framed, codec in modes], encoded)
+        encode_body.assert_not_called()
+        self.assertEqual(reply, expected)
+        self.assertNotIn(REQUEST_ID, response)
+        decoder = MessageDecoder()
+        decoder.feed(reply.encode(True, CODEC_BINARY))
+        self.assertEqual(decoder.messages.popleft(), expected)
+
+
+class TestCodec(unittest.TestCase):
+    """ Тестирование кодеков тела сообщения """
+    message = {
+        ACTION: MESSAGE, SENDER: 'test1', DESTINATION: 'test2', TIME: 1.5,
+        MESSAGE_TEXT: bytes(range(256)), 'extra': [None, True, False, -300, 'тест', {}]
+    }
+
+    def test_binary_round_trip(self):
+        """ Двоичный кодек восстанавливает все типы, байты остаются байтами """
+        decoder = MessageDecoder()
+        decoder.feed(encode_message(self.message, True, CODEC_BINARY))
+        self.assertEqual(decoder.messages.popleft(), self.message)
+
+    def test_binary_smaller(self):
+        """ Двоичное сообщение короче JSON """
+        self.assertLess(len(encode_message(self.message, True, CODEC_BINARY)),
+                        len(encode_message(self.message, True)))
+
+    def test_json_bytes_base64(self):
+        """ В JSON байты передаются строкой base64, кодеки можно чередовать """
+        decoder = MessageDecoder()
+        decoder.feed(encode_message(self.message, True) + encode_message(RESPONSE_200, True, CODEC_BINARY))
+        message = decoder.messages.popleft()
+        self.assertEqual(base64.b64decode(message[MESSAGE_TEXT]), self.message[MESSAGE_TEXT])
+        self.assertEqual(decoder.messages.popleft(), RESPONSE_200)
+
+    def test_binary_errors(self):
+        """ Повреждённые кадры и двоичный кодек без кадров """
+        data = encode_message(self.message, True, CODEC_BINARY)
+        broken = FRAME_HEADER.pack(FRAME_FLAG_BINARY | 10) + data[FRAME_HEADER.size:][:10]
+        self.assertRaises(ValueError, MessageDecoder().feed, broken)
+        self.assertRaises(ValueError, MessageDecoder().feed, FRAME_HEADER.pack(0x80000000))
+        self.assertRaises(ValueError, encode_message, self.message, False, CODEC_BINARY)
+
+    def test_binary_nesting(self):
+        """ Слишком глубоко вложенные списки отклоняются ValueError, а не RecursionError """
+        body = bytes([TAG_LIST, 1]) * 5000 + bytes([TAG_NONE])
+        frame = FRAME_HEADER.pack(FRAME_FLAG_BINARY | len(body)) + body
+        self.assertRaises(ValueError, MessageDecoder().feed, frame)
+        nested = {LIST_INFO: [[[]]]}
+        decoder = MessageDecoder()
+        decoder.feed(encode_message(nested, True, CODEC_BINARY))
+        self.assertEqual(decoder.messages.popleft(), nested)
+
+
+class TestFrameCompressor(unittest.TestCase):
+    """ Тестирование сжатия кадров """
+    users = {RESPONSE: 202, LIST_INFO: [f'user{number}' for number in range(10000)]}
+
+    def test_small_not_compressed(self):
+        """ Кадры короче порога передаются как есть """
+        frame = encode_message(RESPONSE_200, True)
+        self.assertEqual(encode_message(RESPONSE_200, True, compressor=FrameCompressor()), frame)
+
+    def test_stream_round_trip(self):
+        """ Сжатые и обычные кадры одного потока распаковываются по порядку """
+        compressor = FrameCompressor()
+        messages = [self.users, RESPONSE_200, self.users]
+        frames = [encode_message(message, True, CODEC_BINARY, compressor) for message in messages]
+        raw = len(encode_message(self.users, True, CODEC_BINARY))
+        self.assertLess(len(frames[0]) * 4, raw)
+        decoder = MessageDecoder()
+        for frame in frames:
+            decoder.feed(frame)
+        self.assertEqual(list(decoder.messages), messages)
+
+    def test_reset(self):
+        """ После сброса потока кадры распаковываются без пропущенного кадра """
+        compressor = FrameCompressor()
+        first = encode_message(self.users, True, CODEC_BINARY, compressor)
+        encode_message(self.users, True, CODEC_BINARY, compressor)
+        compressor.reset()
+        third = encode_message(self.users, True, CODEC_BINARY, compressor)
+        decoder = MessageDecoder()
+        decoder.feed(first + third)
+        self.assertEqual(list(decoder.messages), [self.users, self.users])
+
+    def test_incompressible(self):
+        """ Несжимаемый кадр передаётся без сжатия, поток остаётся согласованным """
+        compressor = FrameCompressor()
+        noise = {DATA: os.urandom(4096)}
+        frames = [encode_message(message, True, CODEC_BINARY, compressor)
+                  for message in (self.users, noise, self.users)]
+        self.assertEqual(frames[1], encode_message(noise, True, CODEC_BINARY))
+        decoder = MessageDecoder()
+        decoder.feed(b''.join(frames))
+        self.assertEqual(list(decoder.messages), [self.users, noise, self.users])
+
+    def test_corrupted(self):
+        """ Повреждённый сжатый кадр и сжатие без кадров """
+        frame = bytearray(encode_message(self.users, True, compressor=FrameCompressor()))
+        frame[FRAME_HEADER.size:FRAME_HEADER.size + 8] = b'\xff' * 8
+        self.assertRaises(ValueError, MessageDecoder().feed, bytes(frame))
+        self.assertRaises(ValueError, encode_message, self.users, False, CODEC_JSON, FrameCompressor())
+
+
 # Запустить тестирование
 if __name__ == '__main__':
     unittest.main()